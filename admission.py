@@ -0,0 +1,112 @@
+"""
+Kiểm soát tải (admission control) cho hàng đợi inference
+- Từ chối nhanh khi hàng đợi vượt độ sâu tối đa (429) hoặc thời gian chờ ước tính vượt ngưỡng (503)
+- Retry-After tính từ thời gian phục vụ gần đây của mỗi request
+- RequestQueue: hàng đợi bỏ được các request quá hạn đang chờ để nhường chỗ cho request mới
+"""
+import math
+import queue
+import threading
+
+class RequestQueue(queue.Queue):
+    """queue.Queue có thêm remove_if: bỏ các phần tử đang chờ thỏa điều kiện.
+
+    Phần tử bị bỏ được tính như đã get + task_done (join() không chờ chúng), thread đang chờ put
+    được đánh thức khi có chỗ trống.
+    """
+
+    def remove_if(self, predicate):
+        """Bỏ các phần tử predicate(item) đúng (giữ thứ tự phần còn lại). Trả về list phần tử đã bỏ."""
+        with self.mutex:
+            removed = [item for item in self.queue if predicate(item)]
+            if not removed:
+                return removed
+            kept = [item for item in self.queue if not predicate(item)]
+            self.queue.clear()
+            self.queue.extend(kept)
+            self.unfinished_tasks -= len(removed)
+            if self.unfinished_tasks == 0:
+                self.all_tasks_done.notify_all()
+            self.not_full.notify(len(removed))
+        return removed
+
+class AdmissionRejected(Exception):
+    """Request bị từ chối vì server đang quá tải."""
+
+    def __init__(self, status_code, reason, retry_after, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """Quyết định nhận/từ chối request mới dựa trên độ sâu hàng đợi và thời gian chờ ước tính.
+
+    depth: số request đang chờ trong hàng đợi (so với max_depth),
+    in_pipeline: số request đã rời hàng đợi nhưng chưa xong (tiền xử lý / chờ model / đang chạy),
+    service_s: thời gian phục vụ gần đây của một request (None nếu chưa đo được).
+    """
+
+    def __init__(self, max_depth, max_wait_s, default_service_s=5.0):
+        self.max_depth = max_depth
+        self.max_wait_s = max_wait_s
+        self.default_service_s = default_service_s
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = {"queue_full": 0, "wait_too_long": 0}
+
+    def service_time(self, service_s):
+        """Thời gian phục vụ dùng để ước tính (mặc định khi chưa có số đo)."""
+        return service_s if service_s else self.default_service_s
+
+    def estimate_wait(self, depth, service_s, in_pipeline=0):
+        """Thời gian chờ ước tính (giây) của request mới khi đứng sau depth + in_pipeline request."""
+        return (depth + in_pipeline) * self.service_time(service_s)
+
+    @staticmethod
+    def retry_after(seconds):
+        """Giá trị header Retry-After (số giây nguyên, tối thiểu 1)."""
+        return max(1, int(math.ceil(seconds)))
+
+    def check(self, depth, service_s, in_pipeline=0):
+        """Raise AdmissionRejected nếu không nhận thêm request."""
+        service = self.service_time(service_s)
+        if depth >= self.max_depth:
+            self.reject_full(depth, service_s)
+        estimated_wait = self.estimate_wait(depth, service_s, in_pipeline)
+        if self.max_wait_s > 0 and estimated_wait > self.max_wait_s:
+            with self._lock:
+                self.rejected["wait_too_long"] += 1
+            raise AdmissionRejected(
+                503, "wait_too_long",
+                # Chờ đến khi thời gian chờ ước tính giảm xuống dưới ngưỡng
+                self.retry_after(estimated_wait - self.max_wait_s + service),
+                f"Thời gian chờ ước tính {estimated_wait:.0f}s vượt ngưỡng {self.max_wait_s:.0f}s"
+            )
+        with self._lock:
+            self.admitted += 1
+
+    def reject_full(self, depth, service_s):
+        """Raise AdmissionRejected (429) vì hàng đợi đã đầy."""
+        with self._lock:
+            self.rejected["queue_full"] += 1
+        raise AdmissionRejected(
+            429, "queue_full",
+            # Chờ đến khi hàng đợi còn chỗ cho 1 request
+            self.retry_after((depth - self.max_depth + 1) * self.service_time(service_s)),
+            f"Hàng đợi đã đầy ({depth}/{self.max_depth} request)"
+        )
+
+    def stats(self, depth, service_s, in_pipeline=0):
+        """Thống kê cho /health."""
+        with self._lock:
+            return {
+                "max_depth": self.max_depth,
+                "max_estimated_wait_s": self.max_wait_s,
+                "depth": depth,
+                "in_pipeline": in_pipeline,
+                "service_time_s": service_s,
+                "estimated_wait_s": self.estimate_wait(depth, service_s, in_pipeline),
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected)
+            }
@@ -1,101 +1,35 @@
 import os
-import io
-import uuid
+import glob
+import hashlib
+import contextlib
+import json
+import time
 import threading
 import queue
-import torch
-import torchvision.transforms as T
-from PIL import Image
-from torchvision.transforms.functional import InterpolationMode
-from transformers import AutoModel, AutoTokenizer
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import requests
+from job_store import JobStore, JobStoreFull, JOB_DONE
+from result_cache import ResultCache, make_cache_key
+from feature_cache import FeatureCache, hash_image
+from admission import AdmissionController, AdmissionRejected, RequestQueue
+from image_fetcher import ImageFetcher, ImageTooLarge
+from replicas import ReplicaPool
+from batch_upload import spool_uploads, iter_uploaded_images
+from quantization import QUANTIZE_MODES, quantize_model
+from metrics import Registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from generation import GENERATION_PROFILES, DEFAULT_PROFILE, INVOICE_SCHEMA, get_profile_config, parse_partial_fields
 
-# --- CÁC HÀM TIỀN XỬ LÝ ẢNH ---
-IMAGENET_MEAN = (0.485, 0.456, 0.406)
-IMAGENET_STD = (0.229, 0.224, 0.225)
-
-def build_transform(input_size):
-    """Xây dựng pipeline chuyển đổi ảnh."""
-    transform = T.Compose([
-        T.Lambda(lambda img: img.convert('RGB') if img.mode != 'RGB' else img),
-        T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
-        T.ToTensor(),
-        T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
-    ])
-    return transform
-
-def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    """Tìm tỷ lệ khung hình gần nhất với ảnh gốc."""
-    best_ratio_diff = float('inf')
-    best_ratio = (1, 1)
-    area = width * height
-    for ratio in target_ratios:
-        target_aspect_ratio = ratio[0] / ratio[1]
-        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-        if ratio_diff < best_ratio_diff:
-            best_ratio_diff = ratio_diff
-            best_ratio = ratio
-        elif ratio_diff == best_ratio_diff:
-            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                best_ratio = ratio
-    return best_ratio
-
-def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=False):
-    """Tiền xử lý ảnh động, chia ảnh thành các patches."""
-    orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
-
-    # Tính toán các tỷ lệ khung hình mục tiêu
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
-
-    # Tìm tỷ lệ khung hình gần nhất
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
-
-    # Tính toán kích thước mục tiêu
-    target_width = image_size * target_aspect_ratio[0]
-    target_height = image_size * target_aspect_ratio[1]
-    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
-
-    # Resize ảnh
-    resized_img = image.resize((target_width, target_height))
-    processed_images = []
-    for i in range(blocks):
-        box = (
-            (i % (target_width // image_size)) * image_size,
-            (i // (target_width // image_size)) * image_size,
-            ((i % (target_width // image_size)) + 1) * image_size,
-            ((i // (target_width // image_size)) + 1) * image_size
-        )
-        # Chia ảnh thành các phần
-        split_img = resized_img.crop(box)
-        processed_images.append(split_img)
-    assert len(processed_images) == blocks
-    if use_thumbnail and len(processed_images) != 1:
-        thumbnail_img = image.resize((image_size, image_size))
-        processed_images.append(thumbnail_img)
-    return processed_images
-
-def load_image(image_data, input_size=448, max_num=6):
-    """Tải và tiền xử lý ảnh từ bytes data."""
-    
-    # Chuyển đổi bytes thành PIL Image
-    if isinstance(image_data, bytes):
-        image = Image.open(io.BytesIO(image_data)).convert('RGB')
-    else:
-        image = Image.open(image_data).convert('RGB')
-    
-    transform = build_transform(input_size=input_size)
-    images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
-    pixel_values = [transform(img) for img in images]
-    pixel_values = torch.stack(pixel_values)
-    return pixel_values
+# torch / transformers / torchvision import mất nhiều giây: import trong thread load model (import_runtime)
+# để server nhận kết nối và trả /health ngay khi khởi động
+torch = None
+AutoModel = AutoTokenizer = None
+open_image = tile_image = tile_image_adaptive = normalize_tiles = None
+to_generate_kwargs = QueueTextStreamer = None
+PrefixCache = None
+SchemaDecoder = open_session = None
+NgramIndex = SpeculativeDecoder = None
 
 # --- CẤU HÌNH GLOBAL ---
 # ĐƯỜNG DẪN MODEL - Tự động phát hiện môi trường
@@ -118,55 +52,328 @@ LOCAL_MODEL_PATH = os.path.abspath(LOCAL_MODEL_PATH)
 model = None
 tokenizer = None
 
-# Tự động phát hiện device (GPU hoặc CPU)
-device = "cuda" if torch.cuda.is_available() else "cpu"
-print(f"🔍 Sử dụng device: {device}")
+# STAND_IN_MODEL=1: dùng model thay thế nhỏ khởi tạo ngẫu nhiên (stand_in_model.py) thay cho checkpoint,
+# để benchmark/kiểm thử pipeline trên máy chỉ có CPU, không cần tải model
+STAND_IN_MODEL = os.environ.get('STAND_IN_MODEL', '0') == '1'
+
+# Lượng tử hóa động int8 trên CPU (QUANTIZE=int8 hoặc --quantize int8): Linear của language model,
+# QUANTIZE_VISION_PROJECTOR=1 lượng tử hóa thêm MLP projector của vision
+QUANTIZE = os.environ.get('QUANTIZE', 'none').strip().lower() or 'none'
+QUANTIZE_VISION_PROJECTOR = os.environ.get('QUANTIZE_VISION_PROJECTOR', '0') == '1'
+quantization_info = {"mode": "none"}
+
+# KV cache của phần prompt cố định trước ảnh (system message + đầu lượt user), tính 1 lần khi load model:
+# request 1 ảnh chỉ prefill phần còn lại của prompt (PREFIX_CACHE=0 để tắt)
+PREFIX_CACHE = os.environ.get('PREFIX_CACHE', '1') == '1'
+prefix_cache = None
+
+# Cách decode mặc định: free = model sinh cả chuỗi JSON, schema = chỉ sinh giá trị theo INVOICE_SCHEMA,
+# phần cấu trúc (key, ngoặc, dấu nháy) đưa vào model theo cụm (ít lượt forward hơn, output luôn là JSON hợp lệ),
+# speculative = greedy có draft lấy từ các kết quả gần đây, kiểm tra nhiều token draft mỗi lượt forward
+DECODING_MODES = ("free", "schema", "speculative")
+DECODING = os.environ.get('DECODING', 'free').strip().lower()
+if DECODING not in DECODING_MODES:
+    raise ValueError(f"DECODING không hợp lệ: '{DECODING}'. Chọn một trong: {', '.join(DECODING_MODES)}")
+schema_decoder = None
+
+# Speculative decoding: index n-gram (SPECULATIVE_NGRAM token) trên SPECULATIVE_INDEX_SIZE kết quả gần nhất do
+# process chạy model sinh ra (mỗi replica có index riêng), tối đa SPECULATIVE_DRAFT_TOKENS token draft mỗi lượt;
+# tỉ lệ chấp nhận dưới SPECULATIVE_MIN_ACCEPTANCE thì request đó decode tiếp như greedy thường
+SPECULATIVE_DRAFT_TOKENS = max(1, int(os.environ.get('SPECULATIVE_DRAFT_TOKENS', 8)))
+SPECULATIVE_NGRAM = max(1, int(os.environ.get('SPECULATIVE_NGRAM', 3)))
+SPECULATIVE_INDEX_SIZE = max(1, int(os.environ.get('SPECULATIVE_INDEX_SIZE', 256)))
+SPECULATIVE_MIN_ACCEPTANCE = float(os.environ.get('SPECULATIVE_MIN_ACCEPTANCE', 0.3))
+draft_index = speculative_decoder = None
+
+# Device (GPU hoặc CPU) được phát hiện khi load model
+device = None
+
+# Trạng thái khởi động cho /health: loading -> warming_up -> ready (failed nếu lỗi),
+# thời gian (giây) từng phase: imports, tokenizer, weights, device_move, quantize, replicas, warm_up
+WARMUP = os.environ.get('WARMUP', '1') == '1'
+WARMUP_MAX_NEW_TOKENS = max(1, int(os.environ.get('WARMUP_MAX_NEW_TOKENS', 16)))
+startup_state = {"status": "loading", "phases": {}, "error": None}
+startup_started_at = time.perf_counter()
 
 # Queue system để xử lý request tuần tự (vì chỉ có 1 CPU)
 # Cải thiện: Dùng Event thay vì polling
-request_queue = queue.Queue()
+# Hàng đợi có giới hạn: khi đầy hoặc thời gian chờ ước tính vượt MAX_ESTIMATED_WAIT_S,
+# request mới bị từ chối ngay (429/503 kèm Retry-After) thay vì chờ đến timeout
+REQUEST_QUEUE_MAX_SIZE = max(1, int(os.environ.get('REQUEST_QUEUE_MAX_SIZE', 64)))
+MAX_ESTIMATED_WAIT_S = float(os.environ.get('MAX_ESTIMATED_WAIT_S', 240))
+request_queue = RequestQueue(maxsize=REQUEST_QUEUE_MAX_SIZE)
+admission = AdmissionController(max_depth=REQUEST_QUEUE_MAX_SIZE, max_wait_s=MAX_ESTIMATED_WAIT_S)
 processing_lock = threading.Lock()
-result_store = {}  # Lưu kết quả theo request_id
-result_lock = threading.Lock()
-request_events = {}  # Event để signal khi request xong
-event_lock = threading.Lock()
+
+# Kho job có giới hạn: job quá TTL hoặc vượt kích thước sẽ bị loại bỏ,
+# kết quả của job đã bị client bỏ (timeout) không còn bị giữ mãi trong bộ nhớ
+JOB_STORE_MAX_SIZE = int(os.environ.get('JOB_STORE_MAX_SIZE', 10000))
+JOB_TTL_S = float(os.environ.get('JOB_TTL_S', 900))
+JOB_LONG_POLL_MAX_S = float(os.environ.get('JOB_LONG_POLL_MAX_S', 30))
+job_store = JobStore(max_size=JOB_STORE_MAX_SIZE, ttl=JOB_TTL_S)
+
+# Cache kết quả theo hash nội dung ảnh + question + generation config
+# RESULT_CACHE_DB: đường dẫn file SQLite để bật tầng cache trên đĩa (dùng chung giữa các replica)
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 1024)),
+    max_bytes=int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+    db_path=os.environ.get('RESULT_CACHE_DB') or None,
+    disk_max_entries=int(os.environ.get('RESULT_CACHE_DISK_MAX_ENTRIES', 100000))
+)
+
+# Cache đặc trưng ảnh (đầu ra vision encoder) theo hash ảnh cho /extract_invoice/questions:
+# câu hỏi tiếp theo về cùng ảnh (gửi lại ảnh hoặc image_id) không chạy lại vision encoder
+feature_cache = FeatureCache(
+    max_entries=int(os.environ.get('FEATURE_CACHE_MAX_ENTRIES', 64)),
+    max_bytes=int(os.environ.get('FEATURE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+)
+MAX_QUESTIONS_PER_REQUEST = max(1, int(os.environ.get('MAX_QUESTIONS_PER_REQUEST', 16)))
+
+# Upload nhiều ảnh (/extract_invoice/batch): tối đa BATCH_UPLOAD_MAX_IMAGES ảnh mỗi request, mỗi ảnh tối đa
+# BATCH_UPLOAD_MAX_IMAGE_BYTES; tối đa BATCH_UPLOAD_WINDOW ảnh của request nằm trong pipeline cùng lúc
+# (0 = 2 x BATCH_MAX_SIZE x số worker inference: đủ để gom batch mà không chiếm hết hàng đợi của request khác)
+BATCH_UPLOAD_MAX_IMAGES = max(1, int(os.environ.get('BATCH_UPLOAD_MAX_IMAGES', 1000)))
+BATCH_UPLOAD_MAX_IMAGE_BYTES = int(os.environ.get('BATCH_UPLOAD_MAX_IMAGE_BYTES', 20 * 1024 * 1024))
+BATCH_UPLOAD_WINDOW = max(0, int(os.environ.get('BATCH_UPLOAD_WINDOW', 0)))
+
+# Tải ảnh từ image_url: connection pool dùng chung, giới hạn dung lượng khi stream,
+# IMAGE_CACHE_DIR: thư mục cache ảnh theo URL (revalidate bằng ETag/Last-Modified)
+image_fetcher = ImageFetcher(
+    max_bytes=int(os.environ.get('IMAGE_FETCH_MAX_BYTES', 20 * 1024 * 1024)),
+    timeout=float(os.environ.get('IMAGE_FETCH_TIMEOUT_S', 10)),
+    pool_size=int(os.environ.get('IMAGE_FETCH_POOL_SIZE', 16)),
+    max_concurrent=int(os.environ.get('IMAGE_FETCH_MAX_CONCURRENT', 8)),
+    cache_dir=os.environ.get('IMAGE_CACHE_DIR') or None,
+    cache_max_bytes=int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+)
+
+# Cấu hình micro-batching: worker gom nhiều request rồi chạy chung một lượt forward
+# BATCH_MAX_SIZE=1 tương đương xử lý tuần tự như trước
+BATCH_MAX_SIZE = max(1, int(os.environ.get('BATCH_MAX_SIZE', 4)))
+BATCH_MAX_WAIT_MS = max(0.0, float(os.environ.get('BATCH_MAX_WAIT_MS', 50)))
+
+# Nhiều replica inference trên CPU: load model 1 lần rồi fork INFERENCE_REPLICAS process dùng chung weights
+# (copy-on-write), mỗi replica REPLICA_THREADS thread torch. 1 = chạy model ngay trong process server
+INFERENCE_REPLICAS = max(1, int(os.environ.get('INFERENCE_REPLICAS', 1)))
+REPLICA_THREADS = max(1, int(os.environ.get('REPLICA_THREADS', (os.cpu_count() or 1) // INFERENCE_REPLICAS)))
+replica_pool = None
+
+# Pipeline 2 tầng: các thread tiền xử lý (decode + chia tile, PIL/numpy nhả GIL) chạy song song
+# với worker inference. ready_queue có giới hạn để tiền xử lý không chạy quá xa model
+PREPROCESS_WORKERS = max(1, int(os.environ.get('PREPROCESS_WORKERS', 2)))
+PREPROCESS_QUEUE_SIZE = max(1, int(os.environ.get('PREPROCESS_QUEUE_SIZE', 2 * BATCH_MAX_SIZE * INFERENCE_REPLICAS)))
+ready_queue = queue.Queue(maxsize=PREPROCESS_QUEUE_SIZE)
+
+class StageStats:
+    """Thống kê thời gian từng tầng của pipeline (số lần, trung bình, EWMA, lớn nhất)."""
+
+    def __init__(self, stages, alpha=0.1):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._stats = {stage: {"count": 0, "total": 0.0, "ewma": None, "max": 0.0} for stage in stages}
+        self.in_flight = {stage: 0 for stage in stages}
+
+    def record(self, stage, seconds):
+        """Ghi nhận một lần đo của tầng stage."""
+        with self._lock:
+            stat = self._stats[stage]
+            stat["count"] += 1
+            stat["total"] += seconds
+            stat["max"] = max(stat["max"], seconds)
+            stat["ewma"] = seconds if stat["ewma"] is None else (
+                self.alpha * seconds + (1 - self.alpha) * stat["ewma"])
+
+    def enter(self, stage, count=1):
+        """Tăng số item đang nằm trong tầng stage."""
+        with self._lock:
+            self.in_flight[stage] += count
+
+    def leave(self, stage, count=1):
+        """Giảm số item đang nằm trong tầng stage."""
+        with self._lock:
+            self.in_flight[stage] -= count
+
+    def ewma(self, stage):
+        """Thời gian gần đây (EWMA, giây) của tầng stage, None nếu chưa có."""
+        with self._lock:
+            return self._stats[stage]["ewma"]
+
+    def snapshot(self):
+        """Thống kê (ms) của tất cả các tầng cho /health."""
+        with self._lock:
+            return {
+                stage: {
+                    "count": stat["count"],
+                    "avg_ms": 1000 * stat["total"] / stat["count"] if stat["count"] else 0.0,
+                    "recent_ms": 1000 * stat["ewma"] if stat["ewma"] is not None else 0.0,
+                    "max_ms": 1000 * stat["max"]
+                }
+                for stage, stat in self._stats.items()
+            }
+
+# queue_wait: chờ trong request_queue, preprocess: decode + chia tile,
+# handoff_wait: chờ trong ready_queue, inference: thời gian chạy model của batch,
+# service: thời gian model trên mỗi request (inference / kích thước batch) - dùng để ước tính thời gian chờ
+pipeline_stats = StageStats(["queue_wait", "preprocess", "handoff_wait", "inference", "service"])
+
+# Metrics Prometheus cho /metrics (chi phí mỗi lần ghi ~ vài µs, có thể bật thường xuyên trên production)
+metrics_registry = Registry()
+STAGE_SECONDS = metrics_registry.histogram(
+    "invoice_stage_seconds",
+    "Thời gian từng tầng xử lý (giây): download, queue_wait, decode, preprocess, h2d, vision, generate",
+    labels=("stage",))
+TILES_PER_IMAGE = metrics_registry.histogram(
+    "invoice_tiles_per_image", "Số tile 448x448 mỗi ảnh (gồm thumbnail)",
+    buckets=(1, 2, 3, 4, 5, 6, 7, 9, 13))
+BATCH_SIZE = metrics_registry.histogram(
+    "invoice_batch_size", "Số request trong mỗi lượt forward", buckets=(1, 2, 4, 8, 16, 32))
+GENERATED_TOKENS = metrics_registry.counter(
+    "invoice_generated_tokens_total", "Tổng số token model đã sinh")
+PREFIX_TOKENS_REUSED = metrics_registry.counter(
+    "invoice_prefix_tokens_reused_total", "Tổng số token prompt lấy từ KV cache của prefix thay vì prefill lại")
+DRAFT_TOKENS = metrics_registry.counter(
+    "invoice_draft_tokens_total", "Số token draft của speculative decoding theo kết quả kiểm tra", labels=("result",))
+TOKENS_PER_SECOND = metrics_registry.histogram(
+    "invoice_tokens_per_second", "Tốc độ sinh token của từng request (token/giây)",
+    buckets=(0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+ERRORS = metrics_registry.counter(
+    "invoice_errors_total", "Số lỗi theo tầng và loại exception", labels=("stage", "type"))
+TIMEOUTS = metrics_registry.counter(
+    "invoice_timeouts_total", "Số request bị timeout khi chờ kết quả")
+REJECTED = metrics_registry.counter(
+    "invoice_rejected_total", "Số request bị từ chối do quá tải", labels=("reason",))
+EXPIRED = metrics_registry.counter(
+    "invoice_expired_total", "Số request hết hạn trong hàng đợi, bị bỏ trước khi chạy", labels=("stage",))
+HTTP_REQUESTS = metrics_registry.counter(
+    "invoice_http_requests_total", "Số HTTP request theo endpoint và status code", labels=("endpoint", "status"))
+
+def count_generated_tokens(responses):
+    """Số token của từng response, tính lại bằng tokenizer (model.chat/batch_chat chỉ trả về text).
+
+    Decode schema/speculative đã có số token trong thống kê decode, không cần gọi hàm này.
+    """
+    counts = []
+    for response in responses:
+        try:
+            counts.append(len(tokenizer.encode(response, add_special_tokens=False)))
+        except Exception:
+            counts.append(None)
+    return counts
+
+def record_generation(token_counts, seconds):
+    """Ghi nhận số token sinh ra và tốc độ sinh token của một lượt generate (None: không đếm được)."""
+    for tokens in token_counts:
+        if tokens is None:
+            continue
+        GENERATED_TOKENS.inc(tokens)
+        if seconds > 0:
+            TOKENS_PER_SECOND.observe(tokens / seconds)
 
 # Khởi tạo Flask app với CORS
 app = Flask(__name__)
 CORS(app)  # Cho phép tất cả origins, có thể cấu hình chi tiết hơn nếu cần
 
+@contextlib.contextmanager
+def startup_phase(name):
+    """Đo thời gian một phase khởi động, ghi vào startup_state cho /health."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_state["phases"][name] = round(time.perf_counter() - started_at, 3)
+
+def import_runtime():
+    """Import torch, transformers và các module phụ thuộc (gọi lại nhiều lần không tốn thêm)."""
+    global torch, AutoModel, AutoTokenizer, open_image, tile_image, tile_image_adaptive, normalize_tiles
+    global to_generate_kwargs, QueueTextStreamer, PrefixCache, SchemaDecoder, open_session
+    global NgramIndex, SpeculativeDecoder
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    from image_preprocess import open_image, tile_image, tile_image_adaptive, normalize_tiles
+    from generation_runtime import to_generate_kwargs, QueueTextStreamer
+    from prefix_cache import PrefixCache
+    from decode_session import open_session
+    from schema_decoding import SchemaDecoder
+    from speculative import NgramIndex, SpeculativeDecoder
+
 def load_model():
     """Tải mô hình lên device (GPU hoặc CPU) một lần duy nhất khi server khởi động."""
-    global model, tokenizer, device
+    global model, tokenizer, device, quantization_info, prefix_cache, schema_decoder
+    global draft_index, speculative_decoder
     
-    # Đảm bảo device được phát hiện lại (phòng trường hợp thay đổi sau khi import)
+    with startup_phase("imports"):
+        import_runtime()
+    
+    # Tự động phát hiện device (GPU hoặc CPU)
     device = "cuda" if torch.cuda.is_available() else "cpu"
     print(f"🔍 Đang tải model lên device: {device}")
     if device == "cuda":
         print(f"   GPU: {torch.cuda.get_device_name(0) if torch.cuda.is_available() else 'N/A'}")
     
     try:
-        tokenizer = AutoTokenizer.from_pretrained(
-            LOCAL_MODEL_PATH, 
-            trust_remote_code=True,
-            local_files_only=True
-        )
-        
         # Chọn dtype phù hợp với device
         # GPU: dùng bfloat16 (nhanh, tiết kiệm VRAM)
         # CPU: dùng float32 (tương thích tốt)
         dtype = torch.bfloat16 if device == "cuda" else torch.float32
-        print(f"   Sử dụng dtype: {dtype}")
         
-        # Load model
-        model = AutoModel.from_pretrained(
-            LOCAL_MODEL_PATH,
-            torch_dtype=dtype,
-            low_cpu_mem_usage=True,
-            trust_remote_code=True,
-            use_flash_attn=False,
-            local_files_only=True
-        ).eval().to(device)
+        if STAND_IN_MODEL:
+            print("   ⚠️  STAND_IN_MODEL=1: dùng model thay thế khởi tạo ngẫu nhiên (chỉ để benchmark/kiểm thử)")
+            from stand_in_model import StandInModel, StandInTokenizer
+            with startup_phase("tokenizer"):
+                tokenizer = StandInTokenizer()
+            with startup_phase("weights"):
+                loaded_model = StandInModel().to(dtype)
+        else:
+            with startup_phase("tokenizer"):
+                tokenizer = AutoTokenizer.from_pretrained(
+                    LOCAL_MODEL_PATH, 
+                    trust_remote_code=True,
+                    local_files_only=True
+                )
+            print(f"   Sử dụng dtype: {dtype}")
+            
+            # Load model
+            with startup_phase("weights"):
+                loaded_model = AutoModel.from_pretrained(
+                    LOCAL_MODEL_PATH,
+                    torch_dtype=dtype,
+                    low_cpu_mem_usage=True,
+                    trust_remote_code=True,
+                    use_flash_attn=False,
+                    local_files_only=True
+                )
+        with startup_phase("device_move"):
+            model = loaded_model.eval().to(device)
+        
+        if QUANTIZE != "none":
+            if device == "cpu":
+                with startup_phase("quantize"):
+                    quantization_info = quantize_model(model, QUANTIZE, vision_projector=QUANTIZE_VISION_PROJECTOR)
+                print(f"   Lượng tử hóa {QUANTIZE}: {quantization_info['quantized_linear']} Linear, "
+                      f"{quantization_info['fp32_size_mb']:.0f} MB -> {quantization_info['model_size_mb']:.0f} MB")
+            else:
+                print(f"⚠️  QUANTIZE={QUANTIZE} chỉ hỗ trợ CPU, giữ nguyên {dtype} trên {device}")
+        
+        if PREFIX_CACHE:
+            # Sau lượng tử hóa (KV phải khớp weights đang dùng) và trước khi fork replica (các replica dùng chung)
+            with startup_phase("prefix_cache"):
+                try:
+                    prefix_cache = PrefixCache.build(model, tokenizer, DEFAULT_QUESTION)
+                except Exception as e:
+                    print(f"⚠️  Không tạo được KV cache của prefix prompt ({type(e).__name__}: {e}), bỏ qua")
+                    prefix_cache = None
+            if prefix_cache is not None:
+                print(f"   KV cache prefix prompt: {len(prefix_cache)} token "
+                      f"(prefill {1000 * prefix_cache.prefill_seconds:.1f} ms)")
+        
+        schema_decoder = SchemaDecoder(tokenizer, INVOICE_SCHEMA)
+        if DECODING == "schema":
+            # Phân loại token của vocab trước khi fork replica (không thì tính lười ở request schema đầu tiên)
+            with startup_phase("schema_decoder"):
+                schema_decoder.prepare()
+        draft_index = NgramIndex(n=SPECULATIVE_NGRAM, max_sequences=SPECULATIVE_INDEX_SIZE)
+        speculative_decoder = SpeculativeDecoder(tokenizer, draft_index, draft_tokens=SPECULATIVE_DRAFT_TOKENS,
+                                                 min_acceptance=SPECULATIVE_MIN_ACCEPTANCE)
         
         print(f"✅ Model đã được tải thành công lên {device}")
 
@@ -175,7 +382,90 @@ def load_model():
         traceback.print_exc()
         raise
 
-# Load model sẽ được gọi trong __main__ block
+def warm_up():
+    """Chạy 1 lượt inference giả lập (ảnh trắng, vài token) để request đầu tiên không phải chịu
+    chi phí khởi tạo lười của torch/allocator. Chế độ replica: warm-up song song từng replica."""
+    from PIL import Image
+    
+    dtype = torch.bfloat16 if device == "cuda" else torch.float32
+    pixel_values = normalize_tiles(tile_image(Image.new('RGB', (448, 448), 'white'))).to(dtype)
+    if replica_pool is None:
+        generate_responses([pixel_values], "fast", max_new_tokens=WARMUP_MAX_NEW_TOKENS)
+        return
+    errors = []
+    
+    def warm_up_replica(replica):
+        try:
+            replica.call([pixel_values], "fast", max_new_tokens=WARMUP_MAX_NEW_TOKENS)
+        except Exception as e:
+            errors.append(e)
+    
+    threads = [threading.Thread(target=warm_up_replica, args=(replica,)) for replica in replica_pool]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def startup_failed(e):
+    """Ghi lỗi khởi động rồi thoát để orchestrator (Docker/Vast.ai) khởi động lại thay vì trả 503 mãi mãi."""
+    startup_state["status"] = "failed"
+    startup_state["error"] = str(e)
+    import traceback
+    traceback.print_exc()
+    os._exit(1)
+
+def load_model_and_fork():
+    """Load model rồi fork replica (INFERENCE_REPLICAS > 1).
+
+    Fork phải xảy ra trước khi có thread nào khác (server HTTP, worker): process con chỉ giữ lại thread gọi fork,
+    lock đang bị thread khác giữ lúc fork (metrics, job_store, hàng đợi) sẽ bị khóa mãi trong replica.
+    Fork trước warm-up: process chính chưa chạy inference (OpenMP) khi fork.
+    """
+    load_model()
+    if INFERENCE_REPLICAS > 1:
+        with startup_phase("replicas"):
+            start_replicas()
+
+def start_server_runtime(model_loaded=False):
+    """Load model, fork replica (nếu chưa làm), khởi động worker, warm-up rồi chuyển /health sang ready.
+
+    Chạy trong thread nền khi khởi động server (trong __main__) để server nhận kết nối ngay.
+    model_loaded: __main__ đã gọi load_model_and_fork trước khi có thread (chế độ nhiều replica).
+    """
+    try:
+        if not model_loaded:
+            load_model_and_fork()
+        
+        # Khởi động các thread tiền xử lý và worker thread để xử lý queue
+        start_workers()
+        print("✅ Queue worker thread đã khởi động")
+        print(f"   Tiền xử lý: {PREPROCESS_WORKERS} thread, hàng đợi sẵn sàng tối đa {PREPROCESS_QUEUE_SIZE}")
+        print(f"   Queue system: Micro-batching (tối đa {BATCH_MAX_SIZE} request, chờ {BATCH_MAX_WAIT_MS:.0f} ms)")
+        
+        if WARMUP:
+            startup_state["status"] = "warming_up"
+            with startup_phase("warm_up"):
+                warm_up()
+        startup_state["phases"]["total"] = round(time.perf_counter() - startup_started_at, 3)
+        startup_state["status"] = "ready"
+        print(f"✅ Server sẵn sàng sau {startup_state['phases']['total']:.1f}s ({startup_state['phases']})")
+    except Exception as e:
+        startup_failed(e)
+
+def is_ready():
+    """Model đã load và warm-up xong, nhận request."""
+    return startup_state["status"] == "ready"
+
+def not_ready_response():
+    """Response 503 khi model chưa sẵn sàng."""
+    response = jsonify({
+        "status": "error",
+        "message": f"Model chưa sẵn sàng ({startup_state['status']})."
+    })
+    response.headers["Retry-After"] = "5"
+    return response, 503
 
 # Endpoint root
 @app.route('/', methods=['GET'])
@@ -187,7 +477,13 @@ def root():
         "version": "1.0",
         "endpoints": {
             "health": "/health",
-            "extract_invoice": "/extract_invoice"
+            "metrics": "/metrics",
+            "extract_invoice": "/extract_invoice",
+            "extract_invoice_stream": "/extract_invoice/stream",
+            "extract_invoice_questions": "/extract_invoice/questions",
+            "extract_invoice_batch": "/extract_invoice/batch",
+            "jobs": "/jobs",
+            "job_status": "/jobs/<job_id>?wait=<giây>"
         }
     }), 200
 
@@ -195,31 +491,88 @@ def root():
 @app.route('/health', methods=['GET'])
 def health():
     """Kiểm tra trạng thái server và model."""
-    model_status = "ready" if (model is not None and tokenizer is not None) else "not_ready"
+    model_status = startup_state["status"]
     
-    # Thông tin device
+    # Thông tin device (torch chưa import khi đang loading)
+    cuda_available = torch.cuda.is_available() if torch is not None else None
     device_info = {
         "device": device,
-        "cuda_available": torch.cuda.is_available()
+        "cuda_available": cuda_available,
+        "quantization": quantization_info
     }
-    if torch.cuda.is_available():
+    if cuda_available:
         device_info["gpu_name"] = torch.cuda.get_device_name(0)
         device_info["gpu_memory"] = f"{torch.cuda.get_device_properties(0).total_memory / 1024**3:.2f} GB"
     
     # Thông tin queue
     queue_info = {
         "queue_size": request_queue.qsize(),
-        "is_processing": processing_lock.locked()
+        "queue_max_size": REQUEST_QUEUE_MAX_SIZE,
+        "is_processing": processing_lock.locked(),
+        "batch_max_size": BATCH_MAX_SIZE,
+        "batch_max_wait_ms": BATCH_MAX_WAIT_MS,
+        "replicas": replica_pool.stats() if replica_pool is not None else None
+    }
+    
+    # Độ sâu và thời gian chờ từng tầng của pipeline
+    pipeline_info = {
+        "preprocess_workers": PREPROCESS_WORKERS,
+        "depth": {
+            "waiting_preprocess": request_queue.qsize(),
+            "preprocessing": pipeline_stats.in_flight["preprocess"],
+            "ready": ready_queue.qsize(),
+            "ready_capacity": PREPROCESS_QUEUE_SIZE,
+            "inferring": pipeline_stats.in_flight["inference"]
+        },
+        "stages": pipeline_stats.snapshot()
     }
     
     return jsonify({
         "status": "success",
         "server": "running",
         "model_status": model_status,
+        "model": "stand-in" if STAND_IN_MODEL else MODEL_NAME,
+        "startup": {
+            "phases_s": startup_state["phases"],
+            "elapsed_s": round(time.perf_counter() - startup_started_at, 3),
+            "error": startup_state["error"]
+        },
         "device": device_info,
-        "queue": queue_info
+        "queue": queue_info,
+        "pipeline": pipeline_info,
+        "generation": {
+            "default_profile": GENERATION_PROFILE,
+            "profiles": list(GENERATION_PROFILES),
+            "json_early_stop": JSON_EARLY_STOP,
+            "tile_policy": TILE_POLICY,
+            "decoding": DECODING
+        },
+        "speculative": {
+            "draft_tokens": SPECULATIVE_DRAFT_TOKENS,
+            "min_acceptance": SPECULATIVE_MIN_ACCEPTANCE,
+            # Index nằm trong process chạy model: mỗi replica có index riêng, không đọc được từ process chính
+            "index": draft_index.stats() if draft_index is not None and replica_pool is None else None
+        },
+        "admission": admission.stats(request_queue.qsize(), pipeline_stats.ewma("service"), in_pipeline_count()),
+        "jobs": job_store.stats(),
+        "cache": result_cache.stats(),
+        "prefix_cache": prefix_cache.stats() if prefix_cache is not None else {"enabled": False},
+        "feature_cache": feature_cache.stats(),
+        "fetcher": image_fetcher.stats()
     }), 200 if model_status == "ready" else 503
 
+# Endpoint metrics (Prometheus)
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Metrics định dạng Prometheus text exposition."""
+    return Response(metrics_registry.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.after_request
+def count_http_request(response):
+    """Đếm HTTP request theo endpoint và status code."""
+    HTTP_REQUESTS.inc(endpoint=request.endpoint or "unknown", status=response.status_code)
+    return response
+
 # Question mặc định cho trích xuất hóa đơn
 DEFAULT_QUESTION = """<image>
 Trích xuất tất cả các trường thông tin từ hóa đơn/biên lai trong ảnh dưới dạng đối tượng JSON.
@@ -231,165 +584,1087 @@ Các trường BẮT BUỘC phải trích xuất:
 - "Danh sách món" (Mảng chứa "Tên món", "Đơn giá", "Số lượng")
 """
 
-def process_invoice_request(request_id, image_data):
+# Profile generation mặc định của server (fast / balanced / accurate), request có thể chọn profile khác
+GENERATION_PROFILE = os.environ.get('GENERATION_PROFILE', DEFAULT_PROFILE)
+get_profile_config(GENERATION_PROFILE)  # Báo lỗi ngay khi khởi động nếu cấu hình sai
+# Dừng generate ngay khi object JSON đã đóng thay vì chạy đến EOS/max_new_tokens
+JSON_EARLY_STOP = os.environ.get('JSON_EARLY_STOP', '1').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Cách chia tile ảnh: fixed = tối đa 6 tile + thumbnail như cũ, adaptive = cắt nền quanh hóa đơn rồi chọn
+# số tile theo độ phân giải vùng cắt và mật độ chữ (ít token ảnh hơn, prefill ngắn hơn). Request chọn được
+TILE_POLICIES = ("fixed", "adaptive")
+TILE_POLICY = os.environ.get('TILE_POLICY', 'fixed').strip().lower()
+if TILE_POLICY not in TILE_POLICIES:
+    raise ValueError(f"TILE_POLICY không hợp lệ: '{TILE_POLICY}'. Chọn một trong: {', '.join(TILE_POLICIES)}")
+
+def build_generation_config(profile=None, stream=False):
+    """Cấu hình Generation của profile (dict thuần, dùng làm cache key). Tạo mới mỗi lần vì model.chat sửa dict này."""
+    generation_config = get_profile_config(profile or GENERATION_PROFILE)
+    generation_config["json_early_stop"] = generation_config.get("json_early_stop", False) and JSON_EARLY_STOP
+    if stream:
+        # Streamer của transformers không hỗ trợ beam search
+        generation_config["num_beams"] = 1
+    return generation_config
+
+def finish_request(request_id, result):
+    """Lưu kết quả và signal event để client biết đã xong."""
+    if not job_store.finish(request_id, result):
+        print(f"⚠️  Request {request_id} đã hết hạn, bỏ qua kết quả")
+
+def finish_success(request_id, response, options):
+    """Trả kết quả thành công cho request và lưu vào cache."""
+    result = {
+        "status": "success",
+        "data": {
+            "extraction_result": response,
+            "profile": options.get("profile") or GENERATION_PROFILE,
+            "preprocess": options.get("preprocess_info"),
+            "prefill": options.get("prefill_info"),
+            "decoding": options.get("decoding_info")
+        }
+    }
+    cache_key = options.get("cache_key")
+    if cache_key is not None:
+        result_cache.put(cache_key, result)
+    finish_request(request_id, result)
+
+def process_invoice_request(request_id, image_data, options=None):
     """Xử lý request trích xuất hóa đơn (chạy trong worker thread)"""
+    process_invoice_batch([(request_id, image_data, options or {})])
+
+def process_invoice_batch(batch):
+    """Tiền xử lý rồi chạy model cho batch [(request_id, image_data, options), ...] (không qua pipeline)."""
+    prepared = [preprocess_request(request_id, image_data, options) for request_id, image_data, options in batch]
+    run_inference_batch([item for item in prepared if item is not None])
+
+def preprocess_request(request_id, image_data, options):
+    """Decode + chia tile ảnh. Trả về (request_id, pixel_values, options), None nếu lỗi."""
     try:
-        # Tiền xử lý ảnh
-        pixel_values = load_image(image_data).to(
-            torch.bfloat16 if device == "cuda" else torch.float32
-        ).to(device)
-        
-        # Cấu hình Generation (mặc định)
-        generation_config = dict(
-            max_new_tokens=1024, 
-            do_sample=False,
-            temperature=0.0,
-            num_beams=3, 
-            repetition_penalty=3.5
-        )
-        
-        # Chạy mô hình với question mặc định
-        with torch.no_grad():
-            response = model.chat(tokenizer, pixel_values, DEFAULT_QUESTION, generation_config)
-
-        # Lưu kết quả và signal event
-        with result_lock:
-            result_store[request_id] = {
-                "status": "success",
-                "data": {
-                    "extraction_result": response
-                }
-            }
-        
-        # Signal event để client biết đã xong
-        with event_lock:
-            if request_id in request_events:
-                request_events[request_id].set()
+        dtype = torch.bfloat16 if device == "cuda" else torch.float32
+        visual_features = options.get("visual_features")
+        if visual_features is not None:
+            # Đặc trưng ảnh đã có trong cache: không decode/chia tile, pixel_values chỉ còn để đếm số tile
+            options["preprocess_info"] = {"tiles": int(visual_features.size(0)), "vision_cached": True}
+            return request_id, torch.empty((visual_features.size(0), 0), dtype=dtype), options
+        with STAGE_SECONDS.time(stage="decode"):
+            # PIL decode lười: load() để thời gian decode không bị tính vào preprocess
+            image = open_image(image_data)
+            image.load()
+        tile_policy = options.get("tile_policy") or TILE_POLICY
+        with STAGE_SECONDS.time(stage="preprocess"):
+            if tile_policy == "adaptive":
+                tiles, info = tile_image_adaptive(image)
+            else:
+                tiles = tile_image(image)
+                info = {"original_size": list(image.size), "tiles": int(tiles.size(0))}
+            pixel_values = normalize_tiles(tiles).to(dtype)
+        TILES_PER_IMAGE.observe(pixel_values.size(0))
+        # Báo lại trong kết quả: số tile quyết định số token ảnh (256/tile) phải prefill
+        options["preprocess_info"] = dict(info, tile_policy=tile_policy)
+        if device == "cuda":
+            # Pinned memory để copy lên GPU bất đồng bộ trong worker inference
+            pixel_values = pixel_values.pin_memory()
+        return request_id, pixel_values, options
     except Exception as e:
-        # Lưu lỗi và signal event
-        with result_lock:
-            result_store[request_id] = {
-                "status": "error",
-                "message": f"Lỗi xử lý: {str(e)}"
+        ERRORS.inc(stage="preprocess", type=type(e).__name__)
+        finish_request(request_id, {
+            "status": "error",
+            "message": f"Lỗi xử lý: {str(e)}"
+        })
+        return None
+
+def run_inference_batch(batch, replica=None):
+    """Chạy model cho batch đã tiền xử lý [(request_id, pixel_values, options), ...].
+
+    Các request cùng profile (và cùng cách decode) chạy chung một lượt forward (batch_chat cần chung generation config).
+    replica: chạy trên process replica thay vì model trong process hiện tại.
+    """
+    groups = {}
+    for item in batch:
+        if item[2].get("questions") is not None:
+            # Nhiều câu hỏi trên 1 ảnh: chạy riêng, dùng chung đặc trưng ảnh cho các câu hỏi
+            run_question_request(*item, replica=replica)
+        elif item[2].get("stream") is not None:
+            # Request stream chạy riêng (streamer chỉ hỗ trợ batch 1), ưu tiên vì client đang chờ từng token
+            run_single_request(*item, replica=replica)
+        else:
+            key = (item[2].get("profile") or GENERATION_PROFILE, item[2].get("decoding") or DECODING)
+            groups.setdefault(key, []).append(item)
+    for (profile, decoding), group in groups.items():
+        run_profile_batch(group, profile, replica=replica, decoding=decoding)
+
+def generate_responses(pixel_values_list, profile, channel=None, max_new_tokens=None):
+    """Chạy model cho các ảnh cùng profile trong một lượt forward, trả về list response.
+
+    Chạy trong worker inference hoặc trong process replica. channel: queue nhận token khi stream (1 ảnh),
+    max_new_tokens: ghi đè giới hạn token của profile (dùng cho warm-up).
+    """
+    num_patches_list = [pv.size(0) for pv in pixel_values_list]
+    with STAGE_SECONDS.time(stage="h2d"):
+        pixel_values = (pixel_values_list[0] if len(pixel_values_list) == 1
+                        else torch.cat(pixel_values_list, dim=0)).to(device, non_blocking=True)
+        if device == "cuda":
+            # non_blocking chỉ xếp lệnh copy vào stream: chờ copy xong để h2d đo đúng thời gian truyền
+            # (không thì thời gian copy bị tính vào generate)
+            torch.cuda.synchronize()
+    generation_config = to_generate_kwargs(build_generation_config(profile, stream=channel is not None), tokenizer)
+    if max_new_tokens is not None:
+        generation_config["max_new_tokens"] = max_new_tokens
+    if channel is not None:
+        generation_config["streamer"] = QueueTextStreamer(tokenizer, channel)
+    if prefix_cache is not None and len(pixel_values_list) == 1:
+        # Prompt bắt đầu bằng prefix đã có KV cache: generate chỉ prefill phần sau (token ảnh + câu hỏi)
+        generation_config["past_key_values"] = prefix_cache.for_generation(generation_config.get("num_beams", 1))
+    
+    # Chạy mô hình với question mặc định
+    with torch.no_grad(), STAGE_SECONDS.time(stage="generate"):
+        if len(pixel_values_list) == 1:
+            responses = [model.chat(tokenizer, pixel_values, DEFAULT_QUESTION, generation_config)]
+        else:
+            responses = model.batch_chat(
+                tokenizer, pixel_values,
+                num_patches_list=num_patches_list,
+                questions=[DEFAULT_QUESTION] * len(pixel_values_list),
+                generation_config=generation_config
+            )
+    if max_new_tokens is None:
+        remember_responses(responses)
+    return responses
+
+def remember_responses(responses):
+    """Thêm kết quả decode tự do vào index draft của speculative decoding (kết quả warm-up bị cắt ngắn không được
+    thêm; SpeculativeDecoder tự thêm token kết quả của nó, không tokenize lại)."""
+    if draft_index is None:
+        return
+    for response in responses:
+        draft_index.add(tokenizer.encode(response, add_special_tokens=False))
+
+def answer_questions(pixel_values_list, profile, channel=None, questions=(), visual_features=None):
+    """Trả lời nhiều câu hỏi về 1 ảnh trong một lượt batch_chat, vision encoder chạy tối đa 1 lần.
+
+    Chạy trong worker inference hoặc trong process replica. visual_features: đặc trưng ảnh lấy từ cache
+    (bỏ qua vision encoder). Trả về (responses, đặc trưng mới tính trên CPU hoặc None, giây chạy vision encoder).
+    """
+    computed = None
+    vision_seconds = 0.0
+    with torch.no_grad():
+        if visual_features is None:
+            started_at = time.perf_counter()
+            with STAGE_SECONDS.time(stage="vision"):
+                visual_features = model.extract_feature(pixel_values_list[0].to(device))
+            vision_seconds = time.perf_counter() - started_at
+            computed = visual_features.cpu()
+        visual_features = visual_features.to(device)
+        num_tiles = visual_features.size(0)
+        generation_config = to_generate_kwargs(build_generation_config(profile), tokenizer)
+        # generate của InternVL dùng visual_features thay cho extract_feature(pixel_values);
+        # pixel_values rỗng chỉ để chat/batch_chat đếm số tile khi chèn token ảnh vào prompt
+        generation_config["visual_features"] = visual_features.repeat(len(questions), 1, 1)
+        placeholder = visual_features.new_empty((num_tiles * len(questions), 0))
+        with STAGE_SECONDS.time(stage="generate"):
+            if len(questions) == 1:
+                responses = [model.chat(tokenizer, placeholder, questions[0], generation_config)]
+            else:
+                responses = model.batch_chat(
+                    tokenizer, placeholder,
+                    num_patches_list=[num_tiles] * len(questions),
+                    questions=list(questions),
+                    generation_config=generation_config
+                )
+    return responses, computed, vision_seconds
+
+def schema_responses(pixel_values_list):
+    """Decode theo INVOICE_SCHEMA từng ảnh (batch 1, bắt đầu từ KV cache của prefix prompt).
+
+    Chạy trong worker inference hoặc trong process replica. Greedy, không dùng beam/repetition_penalty của profile.
+    Trả về (list response JSON, list thống kê decode mỗi ảnh).
+    """
+    responses, decoding_infos = [], []
+    with torch.no_grad(), STAGE_SECONDS.time(stage="generate"):
+        for pixel_values in pixel_values_list:
+            past_key_values = prefix_cache.for_generation() if prefix_cache is not None else None
+            session = open_session(model, tokenizer, pixel_values.to(device, non_blocking=True), DEFAULT_QUESTION,
+                                   past_key_values)
+            result, stats = schema_decoder.decode(session)
+            responses.append(json.dumps(result, ensure_ascii=False))
+            decoding_infos.append(dict(stats, mode="schema"))
+    return responses, decoding_infos
+
+def speculative_responses(pixel_values_list, profile):
+    """Greedy decode có draft từ các kết quả gần đây, từng ảnh (batch 1, bắt đầu từ KV cache của prefix prompt).
+
+    Chạy trong worker inference hoặc trong process replica. Dùng max_new_tokens, repetition_penalty,
+    json_early_stop của profile, không dùng beam. Trả về (list response, list thống kê decode mỗi ảnh).
+    """
+    generation_config = build_generation_config(profile)
+    responses, decoding_infos = [], []
+    with torch.no_grad(), STAGE_SECONDS.time(stage="generate"):
+        for pixel_values in pixel_values_list:
+            past_key_values = prefix_cache.for_generation() if prefix_cache is not None else None
+            session = open_session(model, tokenizer, pixel_values.to(device, non_blocking=True), DEFAULT_QUESTION,
+                                   past_key_values)
+            response, stats = speculative_decoder.decode(
+                session,
+                max_new_tokens=generation_config.get("max_new_tokens", 1024),
+                repetition_penalty=generation_config.get("repetition_penalty", 1.0),
+                json_early_stop=generation_config.get("json_early_stop", False)
+            )
+            responses.append(response)
+            decoding_infos.append(dict(stats, mode="speculative"))
+    return responses, decoding_infos
+
+def run_replica_task(pixel_values_list, profile, channel=None, task="generate", **kwargs):
+    """Handler của process replica: generate_responses, answer_questions khi task="questions",
+    schema_responses / speculative_responses khi task="schema" / "speculative"."""
+    if task == "questions":
+        return answer_questions(pixel_values_list, profile, channel, **kwargs)
+    if task == "schema":
+        return schema_responses(pixel_values_list)
+    if task == "speculative":
+        return speculative_responses(pixel_values_list, profile)
+    return generate_responses(pixel_values_list, profile, channel, **kwargs)
+
+def prefill_report(batch_size):
+    """Token prompt lấy từ KV cache của prefix và thời gian ước tính tiết kiệm cho mỗi request của lượt generate."""
+    if prefix_cache is None:
+        return None
+    if batch_size != 1:
+        return {"prefix_tokens_reused": 0, "prefix_saved_ms": 0.0}
+    return prefix_cache.report()
+
+def run_generation(pixel_values_list, profile, channel=None, replica=None, decoding=None):
+    """Chạy generate_responses (hoặc schema_responses / speculative_responses theo decoding, trừ request stream)
+    tại chỗ hoặc trên replica, ghi metrics batch/token. Trả về (responses, thông tin decode mỗi ảnh)."""
+    # Decode tự viết vòng lặp (schema, speculative) chạy từng ảnh, request stream luôn decode tự do
+    mode = "free" if channel is not None else (decoding or DECODING)
+    per_image = mode != "free"
+    BATCH_SIZE.observe(len(pixel_values_list))
+    if prefix_cache is not None and (per_image or len(pixel_values_list) == 1):
+        PREFIX_TOKENS_REUSED.inc(len(prefix_cache) * len(pixel_values_list))
+    generate_started_at = time.perf_counter()
+    if replica is None:
+        result = (run_replica_task(pixel_values_list, profile, task=mode) if per_image
+                  else generate_responses(pixel_values_list, profile, channel))
+    else:
+        # Metrics ghi trong process replica không về process chính: đo cả lượt gọi replica
+        with STAGE_SECONDS.time(stage="generate"):
+            result = (replica.call(pixel_values_list, profile, task=mode) if per_image
+                      else replica.call(pixel_values_list, profile, channel))
+    generate_seconds = time.perf_counter() - generate_started_at
+    responses, decoding_infos = result if per_image else (result, [{"mode": "free"}] * len(result))
+    for info in decoding_infos:
+        if info["mode"] == "speculative":
+            DRAFT_TOKENS.inc(info["accepted_tokens"], result="accepted")
+            DRAFT_TOKENS.inc(info["drafted_tokens"] - info["accepted_tokens"], result="rejected")
+    # Decode tự viết vòng lặp đã đếm token: không tokenize lại response chỉ để ghi metrics
+    if mode == "speculative":
+        token_counts = [info["generated_tokens"] for info in decoding_infos]
+    elif mode == "schema":
+        token_counts = [info["forced_tokens"] + info["sampled_tokens"] for info in decoding_infos]
+    else:
+        token_counts = count_generated_tokens(responses)
+    record_generation(token_counts, generate_seconds)
+    return responses, decoding_infos
+
+def run_profile_batch(batch, profile, replica=None, decoding=None):
+    """Chạy model cho các request cùng profile trong một lượt forward."""
+    request_ids = [request_id for request_id, _, _ in batch]
+    pixel_values_list = [pixel_values for _, pixel_values, _ in batch]
+    options_list = [options for _, _, options in batch]
+    per_image = (decoding or DECODING) != "free"
+    
+    try:
+        responses, decoding_infos = run_generation(pixel_values_list, profile, replica=replica, decoding=decoding)
+    except Exception as e:
+        ERRORS.inc(stage="inference", type=type(e).__name__)
+        if len(request_ids) > 1:
+            # Batch lỗi (vd: hết bộ nhớ) - chạy lại từng request để không mất cả batch
+            print(f"⚠️  Batch {len(request_ids)} request lỗi ({e}), chạy lại từng request...")
+            for request_id, pv, options in batch:
+                run_single_request(request_id, pv, options, replica=replica)
+            return
+        finish_request(request_ids[0], {
+            "status": "error",
+            "message": f"Lỗi xử lý: {str(e)}"
+        })
+        return
+    
+    # Trả kết quả về đúng job của từng request
+    # Decode schema/speculative chạy từng ảnh: mỗi ảnh đều dùng KV cache của prefix
+    prefill_info = prefill_report(1 if per_image else len(batch))
+    for request_id, response, options, decoding_info in zip(request_ids, responses, options_list, decoding_infos):
+        options["prefill_info"] = prefill_info
+        options["decoding_info"] = decoding_info
+        finish_success(request_id, response, options)
+
+def run_single_request(request_id, pixel_values, options, replica=None):
+    """Chạy model cho một request đã tiền xử lý (request stream, hoặc khi batch lỗi)."""
+    channel = options.get("stream")
+    try:
+        if channel is not None:
+            # Stream bắt đầu khi job được worker lấy ra khỏi queue
+            channel.put(("start", None, time.monotonic()))
+        responses, decoding_infos = run_generation([pixel_values], options.get("profile"), channel, replica=replica,
+                                                   decoding=options.get("decoding"))
+        options["prefill_info"] = prefill_report(1)
+        options["decoding_info"] = decoding_infos[0]
+        finish_success(request_id, responses[0], options)
+    except Exception as e:
+        ERRORS.inc(stage="inference", type=type(e).__name__)
+        finish_request(request_id, {
+            "status": "error",
+            "message": f"Lỗi xử lý: {str(e)}"
+        })
+    finally:
+        if channel is not None:
+            channel.put(("done", None, time.monotonic()))
+
+def run_question_request(request_id, pixel_values, options, replica=None):
+    """Chạy model cho request nhiều câu hỏi, lưu đặc trưng ảnh mới tính vào feature_cache."""
+    questions = options["questions"]
+    profile = options.get("profile") or GENERATION_PROFILE
+    try:
+        kwargs = {"questions": questions, "visual_features": options.get("visual_features")}
+        started_at = time.perf_counter()
+        if replica is None:
+            responses, features, vision_seconds = answer_questions([pixel_values], profile, **kwargs)
+        else:
+            with STAGE_SECONDS.time(stage="generate"):
+                responses, features, vision_seconds = replica.call([pixel_values], profile, task="questions", **kwargs)
+        record_generation(count_generated_tokens(responses), time.perf_counter() - started_at)
+        if features is not None:
+            feature_cache.put(options["feature_key"], features)
+        finish_request(request_id, {
+            "status": "success",
+            "data": {
+                "image_id": options["image_id"],
+                "answers": [{"question": question, "answer": response}
+                            for question, response in zip(questions, responses)],
+                "profile": profile,
+                "vision_cached": features is None,
+                "vision_ms": round(1000 * vision_seconds, 1),
+                "preprocess": options.get("preprocess_info")
             }
-        
-        # Signal event để client biết đã xong (dù có lỗi)
-        with event_lock:
-            if request_id in request_events:
-                request_events[request_id].set()
+        })
+    except Exception as e:
+        ERRORS.inc(stage="inference", type=type(e).__name__)
+        finish_request(request_id, {
+            "status": "error",
+            "message": f"Lỗi xử lý: {str(e)}"
+        })
+
+def collect_batch(source=None, max_size=None, max_wait_ms=None):
+    """Lấy item đầu tiên (blocking) rồi gom thêm trong cửa sổ max_wait_ms, tối đa max_size item."""
+    source = ready_queue if source is None else source
+    max_size = BATCH_MAX_SIZE if max_size is None else max_size
+    max_wait_ms = BATCH_MAX_WAIT_MS if max_wait_ms is None else max_wait_ms
+    
+    batch = [source.get()]
+    deadline = time.monotonic() + max_wait_ms / 1000.0
+    while len(batch) < max_size:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining > 0:
+                batch.append(source.get(timeout=remaining))
+            else:
+                # Hết cửa sổ chờ nhưng vẫn lấy các item đã có sẵn trong queue
+                batch.append(source.get_nowait())
+        except queue.Empty:
+            break
+    return batch
 
-def queue_worker():
-    """Worker thread xử lý request từ queue"""
+def preprocess_worker():
+    """Thread tiền xử lý: lấy ảnh thô từ request_queue, đưa pixel_values vào ready_queue."""
     while True:
+        request_id, image_data, options = request_queue.get()
         try:
-            # Lấy request từ queue (blocking)
-            request_id, image_data = request_queue.get()
+            # Bỏ qua job đã bị client hủy/hết hạn trong lúc chờ
+            if is_expired(options):
+                expire_request(request_id, "preprocess")
+                continue
+            if not job_store.mark_processing(request_id):
+                continue
             
-            # Xử lý với lock để đảm bảo chỉ 1 request tại một thời điểm
-            with processing_lock:
-                print(f"🔄 Đang xử lý request {request_id}...")
-                process_invoice_request(request_id, image_data)
-                print(f"✅ Hoàn thành request {request_id}")
+            started_at = time.monotonic()
+            queue_wait = started_at - options.get("submitted_at", started_at)
+            pipeline_stats.record("queue_wait", queue_wait)
+            STAGE_SECONDS.observe(queue_wait, stage="queue_wait")
+            pipeline_stats.enter("preprocess")
+            try:
+                item = preprocess_request(request_id, image_data, options)
+            finally:
+                pipeline_stats.leave("preprocess")
+            options["ready_at"] = time.monotonic()
+            pipeline_stats.record("preprocess", options["ready_at"] - started_at)
             
-            # Đánh dấu task đã hoàn thành
+            # Blocking khi ready_queue đầy: backpressure để tiền xử lý không chạy quá xa model
+            if item is not None:
+                ready_queue.put(item)
+        except Exception as e:
+            print(f"❌ Lỗi trong preprocess worker: {e}")
+            import traceback
+            traceback.print_exc()
+        finally:
             request_queue.task_done()
+
+def queue_worker(replica=None):
+    """Worker thread inference: gom pixel_values đã sẵn sàng thành micro-batch và chỉ chạy model.
+
+    replica: chế độ nhiều replica, mỗi worker thread gửi batch đến replica riêng của nó. Các worker
+    cùng lấy từ ready_queue nên replica nào rảnh trước nhận batch tiếp theo.
+    """
+    while True:
+        try:
+            # Gom request từ ready_queue (blocking cho request đầu tiên)
+            batch = collect_batch()
+            
+            try:
+                dequeued_at = time.monotonic()
+                # Bỏ qua job đã bị client hủy/hết hạn trong lúc chờ
+                active_batch = []
+                for item in batch:
+                    if is_expired(item[2], dequeued_at):
+                        expire_request(item[0], "inference")
+                    elif job_store.get(item[0]) is not None:
+                        active_batch.append(item)
+                for _, _, options in active_batch:
+                    pipeline_stats.record("handoff_wait", dequeued_at - options.get("ready_at", dequeued_at))
+                request_ids = [item[0] for item in active_batch]
+                
+                # Xử lý với lock để đảm bảo chỉ 1 batch tại một thời điểm trên model của process này
+                # (mỗi replica tự chạy tuần tự các batch của nó)
+                if active_batch:
+                    worker_name = "" if replica is None else f" (replica {replica.index})"
+                    with processing_lock if replica is None else contextlib.nullcontext():
+                        print(f"🔄 Đang xử lý batch {len(active_batch)} request{worker_name}: {', '.join(request_ids)}...")
+                        pipeline_stats.enter("inference", len(active_batch))
+                        try:
+                            run_inference_batch(active_batch, replica=replica)
+                        finally:
+                            pipeline_stats.leave("inference", len(active_batch))
+                        inference_seconds = time.monotonic() - dequeued_at
+                        pipeline_stats.record("inference", inference_seconds)
+                        # Các replica chạy song song: thời gian phục vụ hiệu dụng chia cho số worker inference
+                        pipeline_stats.record("service", inference_seconds / len(active_batch) / inference_worker_count())
+                        print(f"✅ Hoàn thành batch {len(active_batch)} request{worker_name}")
+            finally:
+                # Đánh dấu task đã hoàn thành
+                for _ in batch:
+                    ready_queue.task_done()
         except Exception as e:
             print(f"❌ Lỗi trong worker thread: {e}")
             import traceback
             traceback.print_exc()
 
-# Worker thread sẽ được khởi động sau khi load model (trong __main__)
+def is_expired(options, now=None):
+    """Request đã quá hạn chờ (client không còn đợi kết quả)."""
+    deadline = options.get("deadline")
+    return deadline is not None and (time.monotonic() if now is None else now) > deadline
+
+def expire_request(request_id, stage):
+    """Kết thúc job quá hạn mà không chạy model."""
+    EXPIRED.inc(stage=stage)
+    finish_request(request_id, {
+        "status": "error",
+        "message": "Request hết hạn trong hàng đợi - server quá tải"
+    })
+
+def drop_expired_requests():
+    """Xóa các request đã quá hạn khỏi request_queue. Trả về số request bị bỏ."""
+    now = time.monotonic()
+    expired = request_queue.remove_if(lambda item: is_expired(item[2], now))
+    for request_id, _, _ in expired:
+        expire_request(request_id, "queue")
+    return len(expired)
+
+def in_pipeline_count():
+    """Số request đã rời request_queue nhưng chưa xong (tiền xử lý, chờ model, đang chạy)."""
+    return pipeline_stats.in_flight["preprocess"] + ready_queue.qsize() + pipeline_stats.in_flight["inference"]
+
+def inference_worker_count():
+    """Số worker inference chạy song song (số replica, hoặc 1)."""
+    return len(replica_pool) if replica_pool is not None else 1
+
+def start_replicas():
+    """Fork các replica inference sau khi load model (chỉ CPU, INFERENCE_REPLICAS > 1).
+
+    Gọi trước start_workers và trước khi chạy inference trong process chính.
+    """
+    global replica_pool
+    if INFERENCE_REPLICAS <= 1:
+        return None
+    if device != "cpu":
+        print(f"⚠️  INFERENCE_REPLICAS={INFERENCE_REPLICAS} chỉ hỗ trợ CPU, dùng 1 model trên {device}")
+        return None
+    replica_pool = ReplicaPool(INFERENCE_REPLICAS, REPLICA_THREADS, run_replica_task)
+    # Process chính chỉ còn tiền xử lý ảnh: không giữ thread torch tranh core với các replica
+    torch.set_num_threads(1)
+    print(f"✅ Đã fork {INFERENCE_REPLICAS} replica inference ({REPLICA_THREADS} thread/replica)")
+    return replica_pool
+
+def start_workers():
+    """Khởi động các thread tiền xử lý và worker inference (mỗi replica một worker)."""
+    for i in range(PREPROCESS_WORKERS):
+        threading.Thread(target=preprocess_worker, name=f"preprocess-{i}", daemon=True).start()
+    if replica_pool is None:
+        worker_thread = threading.Thread(target=queue_worker, name="inference", daemon=True)
+        worker_thread.start()
+        return worker_thread
+    for replica in replica_pool:
+        worker_thread = threading.Thread(target=queue_worker, args=(replica,),
+                                         name=f"inference-{replica.index}", daemon=True)
+        worker_thread.start()
+    return worker_thread
+
+# Worker thread sẽ được khởi động sau khi load model (start_server_runtime, thread nền)
+
+def read_image_data():
+    """Đọc ảnh từ request (file 'image' hoặc JSON 'image_url'). Trả về (image_data, error_response)."""
+    # Kiểm tra xem có file upload không
+    if 'image' in request.files:
+        file = request.files['image']
+        if file.filename == '':
+            return None, (jsonify({
+                "status": "error",
+                "message": "Không có file được chọn."
+            }), 400)
+        image_data = file.read()
+    
+    # Nếu không có file upload, kiểm tra image_url
+    elif request.is_json:
+        data = request.get_json()
+        
+        if not data or 'image_url' not in data:
+            return None, (jsonify({
+                "status": "error",
+                "message": "Cần cung cấp 'image_url' (JSON) hoặc upload file 'image' (multipart/form-data)."
+            }), 400)
+        
+        image_url = data.get('image_url')
+        try:
+            with STAGE_SECONDS.time(stage="download"):
+                image_data = image_fetcher.fetch(image_url)
+        except ImageTooLarge as e:
+            ERRORS.inc(stage="download", type=type(e).__name__)
+            return None, (jsonify({
+                "status": "error",
+                "message": str(e)
+            }), 413)
+    else:
+        return None, (jsonify({
+            "status": "error",
+            "message": "Cần cung cấp 'image_url' (JSON) hoặc upload file 'image' (multipart/form-data)."
+        }), 400)
+    
+    if not image_data:
+        return None, (jsonify({
+            "status": "error",
+            "message": "Không thể lấy dữ liệu ảnh."
+        }), 400)
+    return image_data, None
+
+def is_truthy(value):
+    """Đọc giá trị bool từ query string/form/JSON."""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+def read_request_options():
+    """Đọc tùy chọn của request từ query string, form hoặc JSON body. Trả về (options, error_response)."""
+    data = request.get_json(silent=True) if request.is_json else None
+    data = data if isinstance(data, dict) else {}
+    
+    def lookup(name, default=None):
+        for source in (request.args, request.form, data):
+            if name in source:
+                return source[name]
+        return default
+    
+    profile = lookup('profile') or GENERATION_PROFILE
+    if profile not in GENERATION_PROFILES:
+        return None, (jsonify({
+            "status": "error",
+            "message": f"Profile không hợp lệ: '{profile}'. Chọn một trong: {', '.join(GENERATION_PROFILES)}"
+        }), 400)
+    
+    tile_policy = str(lookup('tile_policy') or TILE_POLICY).strip().lower()
+    if tile_policy not in TILE_POLICIES:
+        return None, (jsonify({
+            "status": "error",
+            "message": f"tile_policy không hợp lệ: '{tile_policy}'. Chọn một trong: {', '.join(TILE_POLICIES)}"
+        }), 400)
+    
+    decoding = str(lookup('decoding') or DECODING).strip().lower()
+    if decoding not in DECODING_MODES:
+        return None, (jsonify({
+            "status": "error",
+            "message": f"decoding không hợp lệ: '{decoding}'. Chọn một trong: {', '.join(DECODING_MODES)}"
+        }), 400)
+    
+    return {
+        # no_cache: bỏ qua kết quả trong cache, luôn chạy model (kết quả mới vẫn được ghi vào cache)
+        "no_cache": is_truthy(lookup('no_cache', False)),
+        # profile: cấu hình generation (fast / balanced / accurate)
+        "profile": profile,
+        # tile_policy: cách chia tile ảnh (fixed / adaptive)
+        "tile_policy": tile_policy,
+        # decoding: cách sinh output (free / schema / speculative)
+        "decoding": decoding
+    }, None
+
+_model_revision = None
+
+def model_revision():
+    """Hash ngắn của checkpoint trong LOCAL_MODEL_PATH: nội dung config.json + tên, kích thước file weights.
+
+    Không phụ thuộc đường dẫn (Docker/local cùng model cho cùng giá trị), tính 1 lần.
+    """
+    global _model_revision
+    if _model_revision is None:
+        hasher = hashlib.sha256()
+        try:
+            with open(os.path.join(LOCAL_MODEL_PATH, "config.json"), "rb") as f:
+                hasher.update(f.read())
+        except OSError:
+            hasher.update(b"no-config")
+        for pattern in ("*.safetensors", "*.bin"):
+            for path in sorted(glob.glob(os.path.join(LOCAL_MODEL_PATH, pattern))):
+                hasher.update(f"\0{os.path.basename(path)}:{os.path.getsize(path)}".encode("utf-8"))
+        _model_revision = hasher.hexdigest()[:16]
+    return _model_revision
+
+def model_identity():
+    """Model sinh ra kết quả, đưa vào key cache kết quả: cache SQLite dùng chung giữa các lần khởi động, kết quả của
+    model khác (checkpoint khác, int8, model thay thế) không được trả cho nhau."""
+    return {
+        "model": "stand-in" if STAND_IN_MODEL else MODEL_NAME,
+        "revision": None if STAND_IN_MODEL else model_revision(),
+        "quantize": QUANTIZE,
+        "quantize_vision_projector": QUANTIZE != "none" and QUANTIZE_VISION_PROJECTOR
+    }
+
+def submit_job(image_data, options=None, wait_s=None):
+    """Tạo job và đưa vào queue xử lý (hoặc trả kết quả từ cache).
+
+    wait_s: thời gian client còn lấy kết quả (mặc định REQUEST_TIMEOUT_S của request đồng bộ/stream);
+    job còn chờ trong hàng đợi quá thời gian này bị bỏ mà không chạy model.
+    Raise JobStoreFull nếu kho job đầy, AdmissionRejected nếu hàng đợi quá tải.
+    """
+    options = dict(options or {})
+    if options.get("questions") is None:
+        generation_config = build_generation_config(options.get("profile"), stream=options.get("stream") is not None)
+        if (options.get("tile_policy") or TILE_POLICY) != "fixed":
+            # Chia tile khác cho kết quả khác: cache riêng (key của fixed giữ nguyên như trước)
+            generation_config["tile_policy"] = options.get("tile_policy") or TILE_POLICY
+        if (options.get("decoding") or DECODING) == "schema":
+            # Decode theo schema luôn greedy, không phụ thuộc profile: các profile dùng chung kết quả
+            generation_config = {"decoding": "schema", "tile_policy": options.get("tile_policy") or TILE_POLICY}
+        elif (options.get("decoding") or DECODING) == "speculative":
+            # Greedy (không beam) nên khác kết quả của profile khi decode tự do
+            generation_config["decoding"] = "speculative"
+        generation_config["model"] = model_identity()
+        options["cache_key"] = make_cache_key(image_data, DEFAULT_QUESTION, generation_config)
+    
+    # Request nhiều câu hỏi không dùng cache kết quả (đặc trưng ảnh đã được cache riêng)
+    cached = None if options.get("no_cache") or "cache_key" not in options else result_cache.get(options["cache_key"])
+    if cached is not None:
+        job = job_store.create()
+        cached["data"]["cached"] = True
+        job_store.finish(job.job_id, cached)
+        print(f"⚡ Request {job.job_id} lấy kết quả từ cache")
+        return job
+    
+    # Kết quả từ cache không tốn tài nguyên model nên chỉ kiểm soát tải với request phải chạy model
+    if request_queue.full():
+        drop_expired_requests()
+    service_s = pipeline_stats.ewma("service")
+    try:
+        admission.check(request_queue.qsize(), service_s, in_pipeline_count())
+    except AdmissionRejected as e:
+        REJECTED.inc(reason=e.reason)
+        raise
+    
+    job = job_store.create()
+    options["submitted_at"] = time.monotonic()
+    # Quá hạn này client không còn chờ: request bị bỏ trước khi tốn thời gian tiền xử lý/model
+    options["deadline"] = options["submitted_at"] + (REQUEST_TIMEOUT_S if wait_s is None else wait_s)
+    try:
+        request_queue.put_nowait((job.job_id, image_data, options))
+    except queue.Full:
+        # Hàng đợi vừa đầy bởi request đồng thời khác
+        job_store.discard(job.job_id)
+        REJECTED.inc(reason="queue_full")
+        admission.reject_full(request_queue.qsize(), service_s)
+    print(f"📥 Đã thêm request {job.job_id} vào queue (queue size: {request_queue.qsize()})")
+    return job
+
+# Thời gian tối đa chờ kết quả của request đồng bộ/stream (5 phút)
+REQUEST_TIMEOUT_S = 300
+# Chu kỳ gửi sự kiện vị trí trong hàng đợi / keep-alive cho client stream
+STREAM_EVENT_INTERVAL_S = 1.0
+
+def job_store_full_response(e):
+    """Response khi kho job đầy."""
+    return jsonify({
+        "status": "error",
+        "message": f"Server quá tải, vui lòng thử lại sau: {str(e)}"
+    }), 503
+
+def admission_rejected_response(e):
+    """Response 429/503 kèm Retry-After khi hàng đợi quá tải."""
+    response = jsonify({
+        "status": "error",
+        "message": f"Server quá tải, vui lòng thử lại sau {e.retry_after}s: {str(e)}",
+        "retry_after": e.retry_after
+    })
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, e.status_code
 
 # API Endpoint Trích xuất Hóa đơn (chỉ cần ảnh)
 @app.route('/extract_invoice', methods=['POST'])
 def extract_invoice():
     """Trích xuất thông tin từ hóa đơn/biên lai. Chỉ cần gửi ảnh."""
-    if model is None or tokenizer is None:
+    if not is_ready():
+        return not_ready_response()
+
+    try:
+        options, error_response = read_request_options()
+        if error_response is not None:
+            return error_response
+        
+        image_data, error_response = read_image_data()
+        if error_response is not None:
+            return error_response
+        
+        job = submit_job(image_data, options)
+        
+        # Đợi kết quả với Event (không cần polling - hiệu quả hơn)
+        if job.wait(timeout=REQUEST_TIMEOUT_S):
+            # Event được signal - request đã xong (hoặc job đã bị loại khỏi kho)
+            job_store.pop(job.job_id)
+            if job.result is not None:
+                status_code = 200 if job.result.get("status") == "success" else 500
+                return jsonify(job.result), status_code
+        
+        # Timeout - xóa job để worker bỏ qua kết quả trả về muộn
+        job_store.discard(job.job_id)
+        TIMEOUTS.inc()
+        
+        return jsonify({
+            "status": "error",
+            "message": "Request timeout - xử lý quá lâu"
+        }), 504
+
+    except JobStoreFull as e:
+        return job_store_full_response(e)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    except requests.exceptions.RequestException as e:
+        ERRORS.inc(stage="download", type=type(e).__name__)
         return jsonify({
             "status": "error",
-            "message": "Model chưa sẵn sàng."
-        }), 503
+            "message": f"Không thể tải ảnh từ URL: {str(e)}"
+        }), 400
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Lỗi xảy ra: {str(e)}"
+        }), 500
+
+# API bất đồng bộ: tạo job và trả về job_id ngay, không giữ thread chờ model
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Tạo job trích xuất hóa đơn, trả về job_id ngay lập tức."""
+    if not is_ready():
+        return not_ready_response()
 
     try:
-        image_data = None
+        options, error_response = read_request_options()
+        if error_response is not None:
+            return error_response
         
-        # Kiểm tra xem có file upload không
-        if 'image' in request.files:
-            file = request.files['image']
-            if file.filename == '':
-                return jsonify({
-                    "status": "error",
-                    "message": "Không có file được chọn."
-                }), 400
-            image_data = file.read()
+        image_data, error_response = read_image_data()
+        if error_response is not None:
+            return error_response
         
-        # Nếu không có file upload, kiểm tra image_url
-        elif request.is_json:
-            data = request.get_json()
-            
-            if not data or 'image_url' not in data:
-                return jsonify({
+        # Client poll kết quả đến khi job hết TTL, không phải REQUEST_TIMEOUT_S của request đồng bộ
+        job = submit_job(image_data, options, wait_s=JOB_TTL_S)
+        data = job.to_dict()
+        data["status_url"] = f"/jobs/{job.job_id}"
+        return jsonify({
+            "status": "success",
+            "data": data
+        }), 202
+
+    except JobStoreFull as e:
+        return job_store_full_response(e)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    except requests.exceptions.RequestException as e:
+        ERRORS.inc(stage="download", type=type(e).__name__)
+        return jsonify({
+            "status": "error",
+            "message": f"Không thể tải ảnh từ URL: {str(e)}"
+        }), 400
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Lỗi xảy ra: {str(e)}"
+        }), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Lấy trạng thái/kết quả job. Hỗ trợ long-poll với ?wait=<giây>."""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({
+            "status": "error",
+            "message": "Không tìm thấy job (không tồn tại hoặc đã hết hạn)."
+        }), 404
+    
+    try:
+        wait = min(max(float(request.args.get('wait', 0)), 0.0), JOB_LONG_POLL_MAX_S)
+    except ValueError:
+        return jsonify({
+            "status": "error",
+            "message": "Tham số 'wait' phải là số giây."
+        }), 400
+    
+    # Long-poll: giữ kết nối tối đa JOB_LONG_POLL_MAX_S giây cho đến khi job xong
+    if wait > 0 and job.status != JOB_DONE:
+        job.wait(timeout=wait)
+    
+    return jsonify({
+        "status": "success",
+        "data": job.to_dict()
+    }), 200 if job.status == JOB_DONE else 202
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def delete_job(job_id):
+    """Xóa job. Job chưa chạy sẽ được worker bỏ qua."""
+    if job_store.pop(job_id) is None:
+        return jsonify({
+            "status": "error",
+            "message": "Không tìm thấy job (không tồn tại hoặc đã hết hạn)."
+        }), 404
+    return jsonify({
+        "status": "success",
+        "message": "Đã xóa job."
+    }), 200
+
+def sse_event(event, data):
+    """Định dạng một sự kiện Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def queue_position(job_id):
+    """Số request đứng trước job trong pipeline (0 = sẽ chạy ở batch tiếp theo)."""
+    with ready_queue.mutex:
+        ready_ids = [item[0] for item in ready_queue.queue]
+    if job_id in ready_ids:
+        return ready_ids.index(job_id)
+    with request_queue.mutex:
+        waiting_ids = [item[0] for item in request_queue.queue]
+    if job_id in waiting_ids:
+        return len(ready_ids) + pipeline_stats.in_flight["preprocess"] + waiting_ids.index(job_id)
+    # Đang được tiền xử lý
+    return len(ready_ids)
+
+def stream_job_events(job, channel, submitted_at):
+    """Generator sự kiện SSE cho một job: queued -> start -> first_token -> token... -> done/error."""
+    started_at = None
+    first_token_at = None
+    text = ""
+    fields = {}
+    try:
+        yield sse_event("queued", {"job_id": job.job_id, "position": queue_position(job.job_id)})
+        while not (job.event.is_set() and channel.empty()):
+            if time.monotonic() - submitted_at > REQUEST_TIMEOUT_S:
+                TIMEOUTS.inc()
+                yield sse_event("error", {
                     "status": "error",
-                    "message": "Cần cung cấp 'image_url' (JSON) hoặc upload file 'image' (multipart/form-data)."
-                }), 400
+                    "message": "Request timeout - xử lý quá lâu"
+                })
+                return
+            try:
+                kind, payload, at = channel.get(timeout=STREAM_EVENT_INTERVAL_S)
+            except queue.Empty:
+                if started_at is None and not job.event.is_set():
+                    yield sse_event("queued", {"job_id": job.job_id, "position": queue_position(job.job_id)})
+                else:
+                    yield ": keep-alive\n\n"
+                continue
             
-            image_url = data.get('image_url')
-            response_img = requests.get(image_url, timeout=10)
-            response_img.raise_for_status() 
-            image_data = response_img.content
-        else:
-            return jsonify({
-                "status": "error",
-                "message": "Cần cung cấp 'image_url' (JSON) hoặc upload file 'image' (multipart/form-data)."
-            }), 400
+            if kind == "start":
+                started_at = at
+                yield sse_event("start", {"job_id": job.job_id, "queue_ms": 1000 * (at - submitted_at)})
+            elif kind == "token":
+                if first_token_at is None:
+                    first_token_at = at
+                    yield sse_event("first_token", {
+                        "ttft_ms": 1000 * (at - submitted_at),
+                        "generation_ttft_ms": 1000 * (at - started_at) if started_at is not None else None
+                    })
+                text += payload
+                event = {"text": payload}
+                # Chỉ gửi lại các trường JSON khi có trường mới sinh xong
+                partial_fields = parse_partial_fields(text)
+                if partial_fields != fields:
+                    fields = partial_fields
+                    event["fields"] = fields
+                yield sse_event("token", event)
         
-        if image_data is None:
-            return jsonify({
+        finished_at = time.monotonic()
+        result = job.result
+        if result is None:
+            yield sse_event("error", {
                 "status": "error",
-                "message": "Không thể lấy dữ liệu ảnh."
-            }), 400
+                "message": "Job đã bị loại bỏ trước khi hoàn thành."
+            })
+            return
+        yield sse_event("done" if result.get("status") == "success" else "error", dict(result, timings={
+            "queue_ms": 1000 * (started_at - submitted_at) if started_at is not None else None,
+            "ttft_ms": 1000 * (first_token_at - submitted_at) if first_token_at is not None else None,
+            "total_ms": 1000 * (finished_at - submitted_at)
+        }))
+    finally:
+        # Client ngắt kết nối giữa chừng: job chưa chạy sẽ được worker bỏ qua
+        job_store.discard(job.job_id)
+
+# API stream: trả kết quả từng token qua Server-Sent Events
+@app.route('/extract_invoice/stream', methods=['POST'])
+def extract_invoice_stream():
+    """Trích xuất hóa đơn và stream text sinh ra theo từng token (text/event-stream)."""
+    if not is_ready():
+        return not_ready_response()
+
+    try:
+        options, error_response = read_request_options()
+        if error_response is not None:
+            return error_response
         
-        # Tạo request ID và Event
-        request_id = str(uuid.uuid4())
-        request_event = threading.Event()
+        image_data, error_response = read_image_data()
+        if error_response is not None:
+            return error_response
         
-        # Lưu event
-        with event_lock:
-            request_events[request_id] = request_event
+        channel = queue.Queue()
+        options["stream"] = channel
+        # Stream gửi từng token do model sinh: luôn decode tự do
+        options["decoding"] = "free"
+        submitted_at = time.monotonic()
+        job = submit_job(image_data, options)
+    except JobStoreFull as e:
+        return job_store_full_response(e)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
+    except requests.exceptions.RequestException as e:
+        ERRORS.inc(stage="download", type=type(e).__name__)
+        return jsonify({
+            "status": "error",
+            "message": f"Không thể tải ảnh từ URL: {str(e)}"
+        }), 400
+    except Exception as e:
+        return jsonify({
+            "status": "error",
+            "message": f"Lỗi xảy ra: {str(e)}"
+        }), 500
+    
+    return Response(
+        stream_with_context(stream_job_events(job, channel, submitted_at)),
+        mimetype='text/event-stream',
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # Tắt buffer của nginx để token đến client ngay
+        }
+    )
+
+def read_questions():
+    """Đọc danh sách câu hỏi (JSON 'questions' là list, hoặc form field 'questions' lặp lại / chuỗi JSON).
+
+    Trả về (questions, error_response).
+    """
+    data = request.get_json(silent=True) if request.is_json else None
+    if isinstance(data, dict) and 'questions' in data:
+        questions = data['questions']
+    else:
+        questions = request.form.getlist('questions') or request.args.getlist('questions')
+        if len(questions) == 1 and questions[0].strip().startswith('['):
+            try:
+                questions = json.loads(questions[0])
+            except ValueError:
+                pass
+    if isinstance(questions, str):
+        questions = [questions]
+    if (not isinstance(questions, list) or not questions
+            or not all(isinstance(question, str) and question.strip() for question in questions)):
+        return None, (jsonify({
+            "status": "error",
+            "message": "Cần cung cấp 'questions': danh sách câu hỏi (chuỗi khác rỗng)."
+        }), 400)
+    if len(questions) > MAX_QUESTIONS_PER_REQUEST:
+        return None, (jsonify({
+            "status": "error",
+            "message": f"Tối đa {MAX_QUESTIONS_PER_REQUEST} câu hỏi mỗi request."
+        }), 400)
+    return [question.strip() for question in questions], None
+
+# API nhiều câu hỏi trên 1 ảnh: vision encoder chạy 1 lần, đặc trưng ảnh được cache cho câu hỏi tiếp theo
+@app.route('/extract_invoice/questions', methods=['POST'])
+def extract_invoice_questions():
+    """Trả lời danh sách câu hỏi về 1 ảnh (upload/image_url, hoặc image_id của ảnh đã gửi trước đó)."""
+    if not is_ready():
+        return not_ready_response()
+
+    try:
+        options, error_response = read_request_options()
+        if error_response is not None:
+            return error_response
         
-        # Thêm vào queue
-        request_queue.put((request_id, image_data))
-        queue_size = request_queue.qsize()
+        questions, error_response = read_questions()
+        if error_response is not None:
+            return error_response
         
-        print(f"📥 Đã thêm request {request_id} vào queue (queue size: {queue_size})")
+        data = request.get_json(silent=True) if request.is_json else None
+        data = data if isinstance(data, dict) else {}
+        image_id = request.form.get('image_id') or request.args.get('image_id') or data.get('image_id')
+        has_image = 'image' in request.files or 'image_url' in data
+        if has_image or not image_id:
+            image_data, error_response = read_image_data()
+            if error_response is not None:
+                return error_response
+            image_id = hash_image(image_data)
+        else:
+            image_data = b""
         
-        # Đợi kết quả với Event (không cần polling - hiệu quả hơn)
-        timeout = 300  # 5 phút timeout
-        if request_event.wait(timeout=timeout):
-            # Event được signal - request đã xong
-            with result_lock:
-                if request_id in result_store:
-                    result = result_store.pop(request_id)
-                    status_code = 200 if result.get("status") == "success" else 500
-                    
-                    # Cleanup event
-                    with event_lock:
-                        request_events.pop(request_id, None)
-                    
-                    return jsonify(result), status_code
+        feature_key = f"{image_id}:{options['tile_policy']}"
+        visual_features = feature_cache.get(feature_key)
+        if visual_features is None and not image_data:
+            return jsonify({
+                "status": "error",
+                "message": "Không còn đặc trưng của image_id trong cache, vui lòng gửi lại ảnh."
+            }), 404
+        options.update(questions=questions, image_id=image_id, feature_key=feature_key,
+                       visual_features=visual_features)
         
-        # Timeout - Event không được signal trong thời gian chờ
-        with event_lock:
-            request_events.pop(request_id, None)
-        with result_lock:
-            result_store.pop(request_id, None)
+        job = submit_job(image_data, options)
+        if job.wait(timeout=REQUEST_TIMEOUT_S):
+            job_store.pop(job.job_id)
+            if job.result is not None:
+                status_code = 200 if job.result.get("status") == "success" else 500
+                return jsonify(job.result), status_code
         
+        job_store.discard(job.job_id)
+        TIMEOUTS.inc()
         return jsonify({
             "status": "error",
             "message": "Request timeout - xử lý quá lâu"
         }), 504
 
+    except JobStoreFull as e:
+        return job_store_full_response(e)
+    except AdmissionRejected as e:
+        return admission_rejected_response(e)
     except requests.exceptions.RequestException as e:
+        ERRORS.inc(stage="download", type=type(e).__name__)
         return jsonify({
             "status": "error",
             "message": f"Không thể tải ảnh từ URL: {str(e)}"
@@ -400,19 +1675,168 @@ def extract_invoice():
             "message": f"Lỗi xảy ra: {str(e)}"
         }), 500
 
-if __name__ == '__main__':
+def batch_upload_window():
+    """Số ảnh của 1 request upload nhiều ảnh được đưa vào pipeline cùng lúc."""
+    return BATCH_UPLOAD_WINDOW or 2 * BATCH_MAX_SIZE * inference_worker_count()
+
+def ndjson_line(record):
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+def stream_batch_results(images, options):
+    """Đưa ảnh vào pipeline theo cửa sổ, trả 1 dòng NDJSON cho mỗi ảnh theo thứ tự xong, dòng cuối là tổng kết.
+
+    images: iterator (tên, bytes ảnh, lỗi) của iter_uploaded_images. Ảnh lỗi chỉ làm dòng của ảnh đó báo lỗi.
+    """
+    started_at = time.monotonic()
+    window = batch_upload_window()
+    done = queue.Queue()
+    in_flight = {}  # job_id -> (index, filename)
+    counts = {"success": 0, "error": 0}
+    uploads = images
+    images = enumerate(uploads)
+    current = None
+    exhausted = False
+    
+    def result_line(index, filename, result):
+        counts["success" if result.get("status") == "success" else "error"] += 1
+        return ndjson_line(dict(result, index=index, filename=filename))
+    
     try:
-        load_model()
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
+        while True:
+            # Đưa thêm ảnh vào pipeline khi cửa sổ còn chỗ: micro-batching gom các ảnh này thành batch
+            while not exhausted and len(in_flight) < window:
+                if current is None:
+                    current = next(images, None)
+                    if current is None:
+                        exhausted = True
+                        break
+                    retry_deadline = time.monotonic() + REQUEST_TIMEOUT_S
+                index, (filename, image_data, error) = current
+                if index >= BATCH_UPLOAD_MAX_IMAGES:
+                    exhausted = True
+                    yield result_line(index, filename, {
+                        "status": "error",
+                        "message": f"Vượt quá {BATCH_UPLOAD_MAX_IMAGES} ảnh mỗi request, ảnh này và các ảnh sau không được xử lý"
+                    })
+                    break
+                if error is not None:
+                    current = None
+                    yield result_line(index, filename, {"status": "error", "message": error})
+                    continue
+                try:
+                    job = submit_job(image_data, options)
+                except (AdmissionRejected, JobStoreFull) as e:
+                    if in_flight:
+                        # Chờ ảnh của chính request này xong để giải phóng chỗ trong hàng đợi
+                        break
+                    if time.monotonic() > retry_deadline:
+                        current = None
+                        yield result_line(index, filename, {"status": "error", "message": f"Server quá tải: {e}"})
+                        continue
+                    time.sleep(min(max(getattr(e, "retry_after", 1) or 1, 0.1), 5))
+                    continue
+                except Exception as e:
+                    # Lỗi của riêng ảnh này (vd: tạo cache key): báo lỗi ở dòng của ảnh, các ảnh khác vẫn chạy
+                    current = None
+                    yield result_line(index, filename, {"status": "error", "message": f"Lỗi xử lý: {e}"})
+                    continue
+                current = None
+                in_flight[job.job_id] = (index, filename)
+                job_store.add_done_callback(job, lambda finished: done.put(finished))
+            if not in_flight:
+                if exhausted:
+                    break
+                continue
+            try:
+                job = done.get(timeout=REQUEST_TIMEOUT_S)
+            except queue.Empty:
+                # Không ảnh nào xong trong thời gian chờ tối đa: báo timeout cho các ảnh đang chờ
+                for job_id, (index, filename) in list(in_flight.items()):
+                    job_store.discard(job_id)
+                    TIMEOUTS.inc()
+                    yield result_line(index, filename, {"status": "error", "message": "Request timeout - xử lý quá lâu"})
+                in_flight.clear()
+                continue
+            entry = in_flight.pop(job.job_id, None)
+            if entry is None:
+                # Job đã được báo timeout trước đó
+                continue
+            index, filename = entry
+            job_store.pop(job.job_id)
+            if job.result is None:
+                # Job bị loại khỏi kho job (hết TTL / kho đầy) trước khi xong
+                yield result_line(index, filename, {"status": "error", "message": "Job bị loại khỏi hàng đợi trước khi xử lý xong"})
+                continue
+            yield result_line(index, filename, job.result)
+        yield ndjson_line({"summary": {
+            "images": counts["success"] + counts["error"],
+            "succeeded": counts["success"],
+            "failed": counts["error"],
+            "elapsed_s": round(time.monotonic() - started_at, 3)
+        }})
+    finally:
+        # Client ngắt kết nối: bỏ các ảnh chưa xong (worker bỏ qua kết quả trả về muộn)
+        for job_id in in_flight:
+            job_store.discard(job_id)
+        uploads.close()  # Đóng file tạm của upload
+
+# API nhiều ảnh trong 1 request: kết quả từng ảnh được stream về (NDJSON) ngay khi ảnh đó xong
+@app.route('/extract_invoice/batch', methods=['POST'])
+def extract_invoice_batch():
+    """Trích xuất nhiều hóa đơn (nhiều file ảnh và/hoặc file zip/tar) trong 1 request."""
+    if not is_ready():
+        return not_ready_response()
+    
+    options, error_response = read_request_options()
+    if error_response is not None:
+        return error_response
+    
+    files = [file for name in request.files for file in request.files.getlist(name) if file.filename]
+    if not files:
+        return jsonify({
+            "status": "error",
+            "message": "Cần upload ít nhất 1 file ảnh hoặc file zip/tar (multipart/form-data)."
+        }), 400
+    
+    images = iter_uploaded_images(spool_uploads(files), BATCH_UPLOAD_MAX_IMAGE_BYTES)
+    return Response(
+        stream_with_context(stream_batch_results(images, options)),
+        mimetype='application/x-ndjson',
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # Tắt buffer của nginx để từng dòng kết quả đến client ngay
+        }
+    )
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='InternVL Invoice Extraction API')
+    parser.add_argument('--quantize', choices=QUANTIZE_MODES, default=None,
+                        help='Lượng tử hóa model trên CPU (mặc định: biến môi trường QUANTIZE hoặc none)')
+    parser.add_argument('--quantize-vision-projector', action='store_true', default=None,
+                        help='Lượng tử hóa thêm MLP projector của vision (cùng --quantize int8)')
+    args = parser.parse_args()
+    if args.quantize is not None:
+        QUANTIZE = args.quantize
+    if args.quantize_vision_projector:
+        QUANTIZE_VISION_PROJECTOR = True
+    if QUANTIZE not in QUANTIZE_MODES:
+        print(f"❌ QUANTIZE không hợp lệ: '{QUANTIZE}'. Chọn một trong: {', '.join(QUANTIZE_MODES)}")
         os._exit(1)
     
-    # Khởi động worker thread để xử lý queue
-    worker_thread = threading.Thread(target=queue_worker, daemon=True)
-    worker_thread.start()
-    print("✅ Queue worker thread đã khởi động")
-    print(f"   Queue system: Xử lý tuần tự (1 request tại một thời điểm)")
+    model_loaded = False
+    if INFERENCE_REPLICAS > 1:
+        # Nhiều replica: load model và fork ngay tại đây, trước khi có thread nào (model-loader, server HTTP).
+        # Server chỉ nhận kết nối sau khi fork xong
+        try:
+            load_model_and_fork()
+        except Exception as e:
+            startup_failed(e)
+        model_loaded = True
+    
+    # Load model + warm-up trong thread nền: server nhận kết nối ngay, /health báo loading/warming_up/ready
+    threading.Thread(target=start_server_runtime, kwargs={"model_loaded": model_loaded},
+                     name="model-loader", daemon=True).start()
     
     # Tự động phát hiện port từ environment variable
     # Hugging Face Spaces dùng port 7860, mặc định là 8000
@@ -0,0 +1,98 @@
+"""
+Đọc ảnh từ upload của /extract_invoice/batch: nhiều file ảnh và/hoặc file nén zip/tar
+- Đọc lần lượt (generator): endpoint lấy ảnh tiếp theo khi còn chỗ trong cửa sổ xử lý, bộ nhớ không tăng theo số ảnh
+- File upload được chép sang file tạm riêng (spool_uploads) vì werkzeug đóng file của request khi view trả về,
+  trước khi response stream đọc tới
+- File trong archive không phải ảnh (theo đuôi file), thư mục, file ẩn (__MACOSX/, .DS_Store) bị bỏ qua
+- Ảnh lỗi (quá lớn, rỗng, archive hỏng) trả về kèm thông báo lỗi thay vì dừng cả lượt upload
+"""
+import os
+import shutil
+import tarfile
+import zipfile
+import tempfile
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp'}
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+# File upload nhỏ hơn ngưỡng này được giữ trong bộ nhớ, lớn hơn thì ghi ra file tạm trên đĩa
+SPOOL_MAX_MEMORY_BYTES = 16 * 1024 * 1024
+
+def is_archive(filename):
+    """File upload là zip/tar (theo đuôi file)."""
+    name = (filename or "").lower()
+    return name.endswith('.zip') or name.endswith(TAR_EXTENSIONS)
+
+def _is_image_member(name):
+    parts = name.replace('\\', '/').split('/')
+    if any(part.startswith('.') or part == '__MACOSX' for part in parts):
+        return False
+    return os.path.splitext(parts[-1])[1].lower() in IMAGE_EXTENSIONS
+
+def _read_limited(stream, size, max_bytes):
+    """Bytes của ảnh, hoặc (None, lỗi) nếu rỗng/quá lớn. size: kích thước khai báo (None nếu không biết)."""
+    if size is not None and size > max_bytes:
+        return None, f"Ảnh quá lớn ({size} bytes, tối đa {max_bytes} bytes)"
+    data = stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        return None, f"Ảnh quá lớn (tối đa {max_bytes} bytes)"
+    if not data:
+        return None, "File rỗng"
+    return data, None
+
+def _iter_zip(archive_name, stream, max_bytes):
+    with zipfile.ZipFile(stream) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not _is_image_member(info.filename):
+                continue
+            name = f"{archive_name}/{info.filename}"
+            try:
+                with archive.open(info) as member:
+                    data, error = _read_limited(member, info.file_size, max_bytes)
+            except (zipfile.BadZipFile, RuntimeError, OSError) as e:
+                # RuntimeError: file có mật khẩu
+                data, error = None, f"Không đọc được file trong archive: {e}"
+            yield name, data, error
+
+def _iter_tar(archive_name, stream, max_bytes):
+    with tarfile.open(fileobj=stream, mode='r:*') as archive:
+        for member in archive:
+            if not member.isfile() or not _is_image_member(member.name):
+                continue
+            name = f"{archive_name}/{member.name}"
+            try:
+                data, error = _read_limited(archive.extractfile(member), member.size, max_bytes)
+            except (tarfile.TarError, OSError) as e:
+                data, error = None, f"Không đọc được file trong archive: {e}"
+            yield name, data, error
+
+def spool_uploads(files):
+    """Chép các file upload (werkzeug FileStorage) sang file tạm: [(tên, file tạm)], dùng được sau khi view trả về."""
+    uploads = []
+    for file in files:
+        spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY_BYTES)
+        shutil.copyfileobj(file.stream, spooled)
+        spooled.seek(0)
+        uploads.append((file.filename or "upload", spooled))
+    return uploads
+
+def iter_uploaded_images(uploads, max_bytes):
+    """(tên, bytes ảnh hoặc None, lỗi hoặc None) cho từng ảnh trong các file upload [(tên, file)] của spool_uploads.
+
+    Ảnh trong archive có tên "tên archive/đường dẫn trong archive". Mỗi file được đóng khi đọc xong
+    (hoặc khi generator bị đóng giữa chừng).
+    """
+    try:
+        for name, stream in uploads:
+            with stream:
+                if not is_archive(name):
+                    data, error = _read_limited(stream, None, max_bytes)
+                    yield name, data, error
+                    continue
+                reader = _iter_zip if name.lower().endswith('.zip') else _iter_tar
+                try:
+                    yield from reader(name, stream, max_bytes)
+                except (zipfile.BadZipFile, tarfile.TarError, OSError, EOFError) as e:
+                    yield name, None, f"Không đọc được file nén: {e}"
+    finally:
+        for _, stream in uploads:
+            stream.close()
@@ -0,0 +1,1192 @@
+"""
+Script benchmark hiệu năng API InternVL
+- batching: đo throughput (requests/s) của micro-batching ở các batch size khác nhau
+- preprocess: so sánh tốc độ/độ chính xác của load_image vector hóa với cách làm cũ
+- profiles: so sánh độ trễ/độ chính xác giữa các profile generation trên một tập ảnh cố định
+- metrics: đo chi phí instrumentation /metrics so với thời gian xử lý 1 request
+- replicas: đo throughput (requests/s) theo số replica inference fork từ model đã load (CPU)
+- quantize: so sánh fp32 với int8 (độ trễ, RSS, độ trùng khớp các trường) trên CPU
+- tiles: so sánh chia tile cố định với adaptive (cắt nền + số tile theo vùng cắt): số tile, độ trễ, độ trùng khớp
+- prefix: đo độ trễ generate có/không dùng KV cache của phần prompt cố định (prefix cache)
+- schema: so sánh decode tự do với decode theo schema JSON (số lượt forward, độ trễ, tỉ lệ JSON hợp lệ)
+- speculative: speculative decoding với draft từ kết quả trước so với decode tự do (tỉ lệ chấp nhận, token/s)
+- fetch: kiểm tra ImageFetcher với server HTTP cục bộ (ảnh chậm, ảnh lớn, ảnh lặp lại)
+- suite: bộ benchmark offline (tiền xử lý theo kích thước ảnh, vòng hàng đợi, requests/s đầu-cuối)
+  với model thay thế nhỏ (CPU, không cần mạng), ghi kết quả ra JSON để so sánh giữa các lần chạy
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import statistics
+
+# Set UTF-8 encoding cho Windows
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp'}
+
+def find_images(paths, limit=None):
+    """Tìm file ảnh từ danh sách file/thư mục."""
+    image_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for file in files:
+                    if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS:
+                        image_files.append(os.path.join(root, file))
+        elif os.path.isfile(path):
+            image_files.append(path)
+    image_files = sorted(image_files)
+    return image_files[:limit] if limit else image_files
+
+def read_images(image_files):
+    """Đọc bytes của các ảnh (đo riêng phần model, không tính I/O đĩa)."""
+    images = []
+    for image_file in image_files:
+        with open(image_file, 'rb') as f:
+            images.append(f.read())
+    return images
+
+def make_synthetic_image(width, height, seed=0):
+    """Tạo ảnh JPEG giả lập (nhiễu mịn) kích thước width x height."""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 256, (max(1, height // 16), max(1, width // 16), 3), dtype=np.uint8)
+    image = Image.fromarray(noise).resize((width, height))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+def parse_size(text):
+    """Đọc kích thước dạng WxH."""
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+def percentile(values, q):
+    """Phân vị q (0-100) theo nearest-rank."""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+def time_call(func, repeats):
+    """Chạy func nhiều lần, trả về thời gian trung vị (giây)."""
+    func()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def bench_preprocess(samples, repeats, tolerance=1e-4):
+    """So sánh load_image (vector hóa) với load_image_reference (PIL từng tile) trên từng ảnh."""
+    from image_preprocess import load_image, load_image_reference
+
+    results = []
+    for name, image_data in samples:
+        fast = load_image(image_data)
+        reference = load_image_reference(image_data)
+        max_diff = float((fast - reference).abs().max()) if fast.shape == reference.shape else float('inf')
+
+        fast_time = time_call(lambda: load_image(image_data), repeats)
+        reference_time = time_call(lambda: load_image_reference(image_data), repeats)
+        results.append({
+            "image": name,
+            "tiles": int(fast.shape[0]),
+            "reference_ms": reference_time * 1000,
+            "vectorized_ms": fast_time * 1000,
+            "speedup": reference_time / fast_time,
+            "max_abs_diff": max_diff,
+            "within_tolerance": max_diff <= tolerance
+        })
+        print(f"   {name:<24} tiles={fast.shape[0]}  cũ {reference_time * 1000:7.1f} ms  "
+              f"mới {fast_time * 1000:7.1f} ms  x{reference_time / fast_time:4.2f}  "
+              f"max_diff={max_diff:.2e} {'✅' if max_diff <= tolerance else '❌'}")
+    return results
+
+SCALAR_FIELDS = ["Tên người bán", "Địa chỉ", "Ngày giao dịch", "Tổng tiền thanh toán"]
+
+def run_extraction(app, image_data, options):
+    """Chạy 1 request qua process_invoice_request, trả về (extraction_result, giây)."""
+    job = app.job_store.create()
+    start = time.perf_counter()
+    app.process_invoice_request(job.job_id, image_data, options)
+    elapsed = time.perf_counter() - start
+    app.job_store.pop(job.job_id)
+    result = job.result or {}
+    if result.get("status") != "success":
+        return None, elapsed
+    return result["data"]["extraction_result"], elapsed
+
+def field_agreement(candidate, reference):
+    """Tỷ lệ trường trùng khớp (4 trường chính + số món) giữa 2 kết quả đã parse."""
+    if candidate is None or reference is None:
+        return 0.0
+    matches = sum(1 for field in SCALAR_FIELDS
+                  if str(candidate.get(field, "")).strip() == str(reference.get(field, "")).strip())
+    items_candidate = candidate.get("Danh sách món")
+    items_reference = reference.get("Danh sách món")
+    matches += int(len(items_candidate or []) == len(items_reference or []))
+    return matches / (len(SCALAR_FIELDS) + 1)
+
+def bench_profiles(app, images, profiles, reference_profile="accurate"):
+    """Đo độ trễ, tỷ lệ JSON hợp lệ và độ trùng khớp với profile tham chiếu cho từng profile."""
+    from generation import parse_json_response
+
+    outputs = {}
+    for profile in profiles:
+        outputs[profile] = [run_extraction(app, image_data, {"profile": profile, "no_cache": True})
+                            for image_data in images]
+
+    reference = [parse_json_response(text) if text is not None else None
+                 for text, _ in outputs.get(reference_profile, [])]
+    results = []
+    for profile in profiles:
+        parsed = [parse_json_response(text) if text is not None else None for text, _ in outputs[profile]]
+        latencies = [seconds for _, seconds in outputs[profile]]
+        agreement = ([field_agreement(p, r) for p, r in zip(parsed, reference)] if reference else [])
+        results.append({
+            "profile": profile,
+            "images": len(images),
+            "mean_latency_s": statistics.mean(latencies),
+            "median_latency_s": statistics.median(latencies),
+            "valid_json_rate": sum(p is not None for p in parsed) / len(parsed),
+            "field_agreement": statistics.mean(agreement) if agreement else None
+        })
+        print(f"   {profile:<10} trung bình {statistics.mean(latencies):7.2f} s  "
+              f"trung vị {statistics.median(latencies):7.2f} s  "
+              f"JSON hợp lệ {100 * results[-1]['valid_json_rate']:5.1f}%  "
+              + (f"trùng khớp với {reference_profile} {100 * results[-1]['field_agreement']:5.1f}%"
+                 if agreement else ""))
+    return results
+
+def bench_tiles(app, samples, profile):
+    """So sánh tile_policy fixed với adaptive trên từng ảnh: số tile, thời gian tiền xử lý + generate,
+    độ trùng khớp các trường của adaptive so với fixed (tham chiếu)."""
+    from generation import parse_json_response
+
+    results = []
+    for name, image_data in samples:
+        row = {"image": name}
+        for policy in ("fixed", "adaptive"):
+            job = app.job_store.create()
+            start = time.perf_counter()
+            app.process_invoice_request(job.job_id, image_data, {"profile": profile, "tile_policy": policy})
+            elapsed = time.perf_counter() - start
+            app.job_store.pop(job.job_id)
+            result = job.result or {}
+            data = result.get("data") or {}
+            text = data.get("extraction_result") if result.get("status") == "success" else None
+            row[policy] = {
+                "latency_s": elapsed,
+                "tiles": (data.get("preprocess") or {}).get("tiles"),
+                "crop_box": (data.get("preprocess") or {}).get("crop_box"),
+                "parsed": parse_json_response(text) if text is not None else None
+            }
+        row["field_agreement"] = field_agreement(row["adaptive"]["parsed"], row["fixed"]["parsed"])
+        results.append(row)
+        print(f"   {name:<24} tile {row['fixed']['tiles']} -> {row['adaptive']['tiles']}  "
+              f"{row['fixed']['latency_s']:6.2f} s -> {row['adaptive']['latency_s']:6.2f} s  "
+              f"trùng khớp {100 * row['field_agreement']:5.1f}%")
+
+    fixed_total = sum(row["fixed"]["latency_s"] for row in results)
+    adaptive_total = sum(row["adaptive"]["latency_s"] for row in results)
+    summary = {
+        "images": len(results),
+        "mean_tiles_fixed": statistics.mean(row["fixed"]["tiles"] or 0 for row in results),
+        "mean_tiles_adaptive": statistics.mean(row["adaptive"]["tiles"] or 0 for row in results),
+        "mean_latency_fixed_s": fixed_total / len(results),
+        "mean_latency_adaptive_s": adaptive_total / len(results),
+        "speedup": fixed_total / adaptive_total if adaptive_total > 0 else None,
+        "field_agreement": statistics.mean(row["field_agreement"] for row in results),
+        "valid_json_rate_adaptive": sum(row["adaptive"]["parsed"] is not None for row in results) / len(results)
+    }
+    print(f"   Trung bình: tile {summary['mean_tiles_fixed']:.1f} -> {summary['mean_tiles_adaptive']:.1f}, "
+          f"độ trễ {summary['mean_latency_fixed_s']:.2f} s -> {summary['mean_latency_adaptive_s']:.2f} s "
+          f"(x{summary['speedup'] or 0:.2f}), trùng khớp với fixed {100 * summary['field_agreement']:.1f}%, "
+          f"JSON hợp lệ {100 * summary['valid_json_rate_adaptive']:.1f}%")
+    return {"images": results, "summary": summary}
+
+def bench_prefix(app, pixel_values_list, profile, repeats, max_new_tokens=None):
+    """Độ trễ generate 1 ảnh khi prefill cả prompt so với khi bắt đầu từ KV cache của prefix."""
+    prefix_cache = app.prefix_cache
+    if prefix_cache is None:
+        print("❌ Model không tạo được KV cache của prefix (PREFIX_CACHE=0 hoặc template không hỗ trợ)")
+        return None
+
+    def run(use_prefix):
+        app.prefix_cache = prefix_cache if use_prefix else None
+        try:
+            return time_call(lambda: [app.generate_responses([pv], profile, max_new_tokens=max_new_tokens)
+                                      for pv in pixel_values_list], repeats) / len(pixel_values_list)
+        finally:
+            app.prefix_cache = prefix_cache
+
+    full_s = run(False)
+    cached_s = run(True)
+    result = {
+        "images": len(pixel_values_list),
+        "prefix_tokens": len(prefix_cache),
+        "prefix_prefill_ms": 1000 * prefix_cache.prefill_seconds,
+        "full_prefill_ms": 1000 * full_s,
+        "prefix_cache_ms": 1000 * cached_s,
+        "saved_ms": 1000 * (full_s - cached_s)
+    }
+    print(f"   Prefix {result['prefix_tokens']} token (prefill riêng {result['prefix_prefill_ms']:.1f} ms)")
+    print(f"   Mỗi request: prefill cả prompt {result['full_prefill_ms']:.1f} ms -> "
+          f"dùng prefix cache {result['prefix_cache_ms']:.1f} ms (tiết kiệm {result['saved_ms']:.1f} ms)")
+    return result
+
+def bench_schema(app, pixel_values_list, profile, repeats):
+    """Decode tự do (profile) so với decode theo INVOICE_SCHEMA trên từng ảnh: lượt forward, độ trễ, JSON hợp lệ."""
+    from generation import parse_json_response
+
+    rows = []
+    for index, pixel_values in enumerate(pixel_values_list):
+        free_responses = []
+        free_s = time_call(lambda: free_responses.append(app.generate_responses([pixel_values], profile)[0]), repeats)
+        free_response = free_responses[-1]
+        schema_results = []
+        schema_s = time_call(lambda: schema_results.append(app.schema_responses([pixel_values])), repeats)
+        schema_responses, schema_infos = schema_results[-1]
+        free_json = parse_json_response(free_response)
+        schema_json = parse_json_response(schema_responses[0])
+        row = {
+            "image": index,
+            # Decode tự do: 1 lượt forward mỗi token sinh ra
+            "free_forward_passes": len(app.tokenizer.encode(free_response, add_special_tokens=False)),
+            "schema_forward_passes": schema_infos[0]["forward_passes"],
+            "schema_forced_tokens": schema_infos[0]["forced_tokens"],
+            "free_ms": 1000 * free_s,
+            "schema_ms": 1000 * schema_s,
+            "free_valid_json": free_json is not None,
+            "schema_valid_json": schema_json is not None,
+            "same_result": free_json == schema_json
+        }
+        rows.append(row)
+        print(f"   Ảnh {index}: tự do {row['free_forward_passes']} lượt / {row['free_ms']:.0f} ms"
+              f"{'' if row['free_valid_json'] else ' (JSON lỗi)'} -> schema {row['schema_forward_passes']} lượt "
+              f"({row['schema_forced_tokens']} token cấu trúc) / {row['schema_ms']:.0f} ms"
+              f"{'' if row['same_result'] else ' (kết quả khác)'}")
+    total_free = sum(row["free_forward_passes"] for row in rows)
+    total_schema = sum(row["schema_forward_passes"] for row in rows)
+    summary = {
+        "images": len(rows),
+        "forward_pass_ratio": total_schema / total_free if total_free else None,
+        "free_ms": statistics.mean(row["free_ms"] for row in rows),
+        "schema_ms": statistics.mean(row["schema_ms"] for row in rows),
+        "free_valid_json_rate": sum(row["free_valid_json"] for row in rows) / len(rows),
+        "schema_valid_json_rate": sum(row["schema_valid_json"] for row in rows) / len(rows),
+        "rows": rows
+    }
+    print(f"   Tổng: schema cần {100 * (summary['forward_pass_ratio'] or 0):.0f}% số lượt forward, "
+          f"{summary['free_ms']:.0f} ms -> {summary['schema_ms']:.0f} ms/ảnh, JSON hợp lệ "
+          f"{100 * summary['free_valid_json_rate']:.0f}% -> {100 * summary['schema_valid_json_rate']:.0f}%")
+    return summary
+
+def bench_speculative(app, pixel_values_list, profile):
+    """Lần lượt từng ảnh: speculative decoding (index chỉ có kết quả các ảnh trước) rồi decode tự do cùng profile."""
+    from speculative import NgramIndex
+
+    # Index rỗng: ảnh đầu tiên không có draft, các ảnh sau dùng kết quả của ảnh trước
+    app.draft_index = NgramIndex(n=app.SPECULATIVE_NGRAM, max_sequences=app.SPECULATIVE_INDEX_SIZE)
+    app.speculative_decoder.index = app.draft_index
+    rows = []
+    for index, pixel_values in enumerate(pixel_values_list):
+        started_at = time.perf_counter()
+        responses, infos = app.speculative_responses([pixel_values], profile)
+        speculative_s = time.perf_counter() - started_at
+        started_at = time.perf_counter()
+        free_response = app.generate_responses([pixel_values], profile)[0]
+        free_s = time.perf_counter() - started_at
+        info = infos[0]
+        row = {
+            "image": index,
+            "free_ms": 1000 * free_s,
+            "speculative_ms": 1000 * speculative_s,
+            "generated_tokens": info["generated_tokens"],
+            "forward_passes": info["forward_passes"],
+            "acceptance_rate": info["acceptance_rate"],
+            "tokens_per_s": info["tokens_per_s"],
+            "drafting_stopped": info["drafting_stopped"],
+            "same_result": responses[0] == free_response
+        }
+        rows.append(row)
+        print(f"   Ảnh {index}: tự do {row['free_ms']:.0f} ms -> speculative {row['speculative_ms']:.0f} ms, "
+              f"{row['generated_tokens']} token / {row['forward_passes']} lượt, chấp nhận "
+              f"{100 * row['acceptance_rate']:.0f}% ({row['tokens_per_s']:.1f} token/s)"
+              f"{', ngừng draft' if row['drafting_stopped'] else ''}{'' if row['same_result'] else ' (kết quả khác)'}")
+    summary = {
+        "images": len(rows),
+        "free_ms": statistics.mean(row["free_ms"] for row in rows),
+        "speculative_ms": statistics.mean(row["speculative_ms"] for row in rows),
+        "acceptance_rate": statistics.mean(row["acceptance_rate"] for row in rows),
+        "same_result_rate": sum(row["same_result"] for row in rows) / len(rows),
+        "rows": rows
+    }
+    print(f"   Trung bình: {summary['free_ms']:.0f} ms -> {summary['speculative_ms']:.0f} ms/ảnh, chấp nhận "
+          f"{100 * summary['acceptance_rate']:.0f}%, trùng kết quả decode tự do {100 * summary['same_result_rate']:.0f}%")
+    return summary
+
+def load_metrics_tokenizer(path):
+    """Tokenizer của model để đo chi phí đếm token (record_generation tokenize lại response của decode tự do).
+
+    Không có model thì dùng tokenizer của model thay thế (theo byte, rẻ hơn tokenizer thật).
+    """
+    if path and os.path.exists(os.path.join(path, 'tokenizer_config.json')):
+        try:
+            from transformers import AutoTokenizer
+            return AutoTokenizer.from_pretrained(path, trust_remote_code=True, local_files_only=True), path
+        except Exception as e:
+            print(f"⚠️  Không load được tokenizer từ {path}: {e}")
+    from stand_in_model import StandInTokenizer
+    return StandInTokenizer(), "stand-in (theo byte)"
+
+def bench_metrics_overhead(image_data, repeats, iterations=10000, tokenizer=None):
+    """So sánh chi phí ghi metrics của 1 request với thời gian tiền xử lý ảnh (phần rẻ nhất của request).
+
+    tokenizer: tính cả lượt tokenize response để đếm token như record_generation của decode tự do
+    (decode schema/speculative lấy số token từ thống kê decode, không tokenize).
+    """
+    import json
+    from image_preprocess import load_image
+    from metrics import Registry
+    from stand_in_model import SAMPLE_RESPONSE
+
+    registry = Registry()
+    stages = registry.histogram("stage_seconds", "bench", labels=("stage",))
+    tiles = registry.histogram("tiles", "bench", buckets=(1, 2, 3, 4, 5, 6, 7, 9, 13))
+    batch_size = registry.histogram("batch_size", "bench", buckets=(1, 2, 4, 8, 16, 32))
+    tokens = registry.counter("tokens", "bench")
+    tokens_per_second = registry.histogram("tokens_per_second", "bench")
+    requests_total = registry.counter("requests", "bench", labels=("endpoint", "status"))
+    response = json.dumps(SAMPLE_RESPONSE, ensure_ascii=False)
+
+    def count_tokens():
+        return len(tokenizer.encode(response, add_special_tokens=False)) if tokenizer is not None else 350
+
+    def instrument_request():
+        # Đúng số lần ghi của 1 request qua app.py: 6 tầng + tiles + batch + token + HTTP
+        for stage in ("download", "queue_wait", "decode", "preprocess", "h2d"):
+            with stages.time(stage=stage):
+                pass
+        with stages.time(stage="generate"):
+            pass
+        tiles.observe(7)
+        batch_size.observe(1)
+        generated = count_tokens()
+        tokens.inc(generated)
+        tokens_per_second.observe(generated / 28.0)
+        requests_total.inc(endpoint="extract_invoice", status=200)
+
+    instrument_request()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        instrument_request()
+    metrics_seconds = (time.perf_counter() - start) / iterations
+    count_seconds = time_call(count_tokens, repeats)
+    render_seconds = time_call(registry.render, repeats)
+    preprocess_seconds = time_call(lambda: load_image(image_data), repeats)
+
+    overhead = metrics_seconds / preprocess_seconds
+    print(f"   metrics/request   {metrics_seconds * 1e6:8.1f} µs (gồm đếm token {count_seconds * 1e6:.1f} µs, "
+          f"{count_tokens()} token)")
+    print(f"   load_image        {preprocess_seconds * 1000:8.1f} ms")
+    print(f"   render /metrics   {render_seconds * 1000:8.2f} ms")
+    print(f"   overhead          {100 * overhead:8.4f}% so với riêng tiền xử lý "
+          f"{'✅' if overhead < 0.01 else '❌'} (< 1%, chưa tính thời gian generate)")
+    return {
+        "metrics_us_per_request": metrics_seconds * 1e6,
+        "token_count_us": count_seconds * 1e6,
+        "preprocess_ms": preprocess_seconds * 1000,
+        "render_ms": render_seconds * 1000,
+        "overhead_ratio": overhead,
+        "below_1_percent": overhead < 0.01
+    }
+
+def start_image_server(image_data, slow_delay_s=0.5, large_bytes=64 * 1024 * 1024):
+    """Server HTTP cục bộ giả lập nguồn ảnh, trả về (server, base_url, số lần GET theo đường dẫn).
+
+    /image.jpg: có ETag (trả 304 khi khớp), /slow.jpg: chậm slow_delay_s giây,
+    /large.jpg: lớn large_bytes bytes (stream từng phần), /nocache.jpg: không có ETag/Last-Modified.
+    """
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    etag = '"bench-image"'
+    hits = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            hits[path] = hits.get(path, 0) + 1
+            if path == "/image.jpg" and self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if path == "/large.jpg":
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                chunk = b"\0" * (1024 * 1024)
+                try:
+                    for _ in range(large_bytes // len(chunk)):
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    self.wfile.write(b"0\r\n\r\n")
+                except OSError:
+                    # Client ngắt kết nối khi vượt giới hạn dung lượng
+                    self.close_connection = True
+                return
+            if path not in ("/image.jpg", "/slow.jpg", "/nocache.jpg"):
+                self.send_error(404)
+                return
+            if path == "/slow.jpg":
+                time.sleep(slow_delay_s)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(image_data)))
+            if path != "/nocache.jpg":
+                self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(image_data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", hits
+
+def bench_fetch(image_data, repeats, concurrency, slow_delay_s, max_bytes):
+    """So sánh requests.get (cách cũ) với ImageFetcher trên server cục bộ."""
+    import tempfile
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+    from image_fetcher import ImageFetcher, ImageTooLarge
+
+    server, base_url, hits = start_image_server(image_data, slow_delay_s=slow_delay_s,
+                                                large_bytes=max(4 * max_bytes, 8 * 1024 * 1024))
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            fetcher = ImageFetcher(max_bytes=max_bytes, max_concurrent=concurrency, cache_dir=cache_dir)
+
+            # Ảnh lặp lại: requests.get tải lại toàn bộ + mở kết nối mới; fetcher dùng lại kết nối và nhận 304
+            plain = time_call(lambda: requests.get(f"{base_url}/nocache.jpg", timeout=10).content, repeats)
+            pooled = time_call(lambda: fetcher.fetch(f"{base_url}/nocache.jpg"), repeats)
+            cached = time_call(lambda: fetcher.fetch(f"{base_url}/image.jpg"), repeats)
+            assert fetcher.fetch(f"{base_url}/image.jpg") == image_data
+            results["repeated"] = {
+                "requests_get_ms": plain * 1000,
+                "pooled_ms": pooled * 1000,
+                "revalidated_ms": cached * 1000,
+                "not_modified_responses": fetcher.stats()["cache_hits"]
+            }
+            print(f"   ảnh lặp lại        requests.get {plain * 1000:7.2f} ms  pool {pooled * 1000:7.2f} ms  "
+                  f"cache+304 {cached * 1000:7.2f} ms")
+
+            # Ảnh chậm: các lượt tải khác URL chạy song song, cùng URL dùng chung 1 lượt tải
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                start = time.perf_counter()
+                list(pool.map(lambda i: fetcher.fetch(f"{base_url}/slow.jpg?i={i}"), range(concurrency)))
+                parallel = time.perf_counter() - start
+                hits_before = hits.get("/slow.jpg", 0)
+                start = time.perf_counter()
+                list(pool.map(lambda i: fetcher.fetch(f"{base_url}/slow.jpg"), range(concurrency)))
+                shared = time.perf_counter() - start
+                shared_requests = hits.get("/slow.jpg", 0) - hits_before
+            results["slow"] = {
+                "concurrency": concurrency,
+                "delay_s": slow_delay_s,
+                "distinct_urls_s": parallel,
+                "same_url_s": shared,
+                "same_url_server_requests": shared_requests
+            }
+            print(f"   {concurrency} ảnh chậm {slow_delay_s:.1f}s     khác URL {parallel:5.2f} s  "
+                  f"cùng URL {shared:5.2f} s ({shared_requests} lượt tải)")
+
+            # Ảnh lớn: dừng ngay khi vượt max_bytes, không đọc hết response
+            start = time.perf_counter()
+            try:
+                fetcher.fetch(f"{base_url}/large.jpg")
+                rejected = False
+            except ImageTooLarge:
+                rejected = True
+            large = time.perf_counter() - start
+            results["large"] = {"rejected": rejected, "seconds": large}
+            print(f"   ảnh lớn             {'bị từ chối ✅' if rejected else 'không bị từ chối ❌'} "
+                  f"sau {large * 1000:.1f} ms (giới hạn {max_bytes} bytes)")
+            results["stats"] = fetcher.stats()
+    finally:
+        server.shutdown()
+    return results
+
+def bench_replicas(app, pixel_values_list, replica_counts, requests_per_count, profile, threads=None):
+    """Đo requests/s khi chia model đã load cho N replica (mỗi replica cpu_count/N thread)."""
+    import queue
+    import threading
+    from replicas import ReplicaPool
+
+    cpu_count = os.cpu_count() or 1
+    results = []
+    for count in replica_counts:
+        replica_threads = threads or max(1, cpu_count // count)
+        pool = ReplicaPool(count, replica_threads, app.generate_responses)
+        try:
+            # Warm-up mỗi replica 1 request
+            for replica in pool:
+                replica.call([pixel_values_list[0]], profile)
+
+            work = queue.Queue()
+            for i in range(requests_per_count):
+                work.put(pixel_values_list[i % len(pixel_values_list)])
+            errors = []
+
+            def drain(replica):
+                while True:
+                    try:
+                        pixel_values = work.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        replica.call([pixel_values], profile)
+                    except Exception as e:
+                        errors.append(e)
+
+            start = time.perf_counter()
+            workers = [threading.Thread(target=drain, args=(replica,)) for replica in pool]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            pool.close()
+
+        results.append({
+            "replicas": count,
+            "threads_per_replica": replica_threads,
+            "requests": requests_per_count,
+            "errors": len(errors),
+            "seconds": elapsed,
+            "requests_per_second": requests_per_count / elapsed
+        })
+        print(f"   replicas={count:<3} threads={replica_threads:<3} {requests_per_count / elapsed:8.3f} req/s  "
+              f"({elapsed:.2f} s, lỗi: {len(errors)})")
+    return results
+
+def current_rss_mb():
+    """RSS hiện tại của process (MB), đọc từ /proc (Linux)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def quantize_worker(image_files, mode, vision_projector, profile, output):
+    """Chạy trong process riêng (RSS không lẫn giữa các mode): load model theo mode, trích xuất từng ảnh."""
+    import json
+    os.environ['QUANTIZE'] = mode
+    os.environ['QUANTIZE_VISION_PROJECTOR'] = '1' if vision_projector else '0'
+    import app
+    rss_before = current_rss_mb()
+    app.load_model()
+    rss_loaded = current_rss_mb()
+
+    images = read_images(image_files)
+    run_extraction(app, images[0], {"profile": profile, "no_cache": True})
+    outputs = [run_extraction(app, image_data, {"profile": profile, "no_cache": True}) for image_data in images]
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            "mode": mode,
+            "device": app.device,
+            "quantization": app.quantization_info,
+            "rss_model_mb": rss_loaded - rss_before,
+            "rss_peak_mb": current_rss_mb(),
+            "outputs": [text for text, _ in outputs],
+            "latencies": [seconds for _, seconds in outputs]
+        }, f, ensure_ascii=False)
+
+def bench_quantize(image_files, modes, profile):
+    """Chạy từng mode (fp32 = none, int8, int8 + vision projector) trong subprocess rồi so sánh."""
+    import json
+    import tempfile
+    import subprocess
+    from generation import parse_json_response
+
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode in modes:
+            output = os.path.join(tmp_dir, f"{mode}.json")
+            command = [sys.executable, os.path.abspath(__file__), 'quantize', '--worker', mode,
+                       '--profile', profile, '--output', output] + image_files
+            if subprocess.run(command).returncode != 0 or not os.path.exists(output):
+                print(f"❌ Mode {mode} lỗi")
+                return None
+            with open(output, encoding='utf-8') as f:
+                runs.append(json.load(f))
+
+    reference = [parse_json_response(text) if text is not None else None for text in runs[0]["outputs"]]
+    results = []
+    for run in runs:
+        parsed = [parse_json_response(text) if text is not None else None for text in run["outputs"]]
+        agreement = statistics.mean(field_agreement(p, r) for p, r in zip(parsed, reference))
+        results.append({
+            "mode": run["mode"],
+            "quantization": run["quantization"],
+            "mean_latency_s": statistics.mean(run["latencies"]),
+            "median_latency_s": statistics.median(run["latencies"]),
+            "rss_model_mb": run["rss_model_mb"],
+            "rss_peak_mb": run["rss_peak_mb"],
+            "valid_json_rate": sum(p is not None for p in parsed) / len(parsed),
+            "field_agreement": agreement
+        })
+        print(f"   {run['mode']:<12} trung bình {results[-1]['mean_latency_s']:7.2f} s  "
+              f"RSS model {run['rss_model_mb']:7.0f} MB  đỉnh {run['rss_peak_mb']:7.0f} MB  "
+              f"JSON hợp lệ {100 * results[-1]['valid_json_rate']:5.1f}%  "
+              f"trùng khớp với {runs[0]['mode']} {100 * agreement:5.1f}%")
+    return results
+
+def bench_batching(app, images, batch_sizes, rounds):
+    """Đo requests/s khi worker chạy các batch kích thước khác nhau."""
+    results = []
+    for batch_size in batch_sizes:
+        # Warm-up 1 batch để không tính chi phí khởi tạo lần đầu
+        batch = [(app.job_store.create().job_id, images[i % len(images)], {}) for i in range(batch_size)]
+        app.process_invoice_batch(batch)
+        for job_id, _, _ in batch:
+            app.job_store.discard(job_id)
+
+        total_requests = 0
+        errors = 0
+        start = time.perf_counter()
+        for r in range(rounds):
+            batch = [(app.job_store.create().job_id, images[(r * batch_size + i) % len(images)], {})
+                     for i in range(batch_size)]
+            app.process_invoice_batch(batch)
+            for job_id, _, _ in batch:
+                job = app.job_store.pop(job_id)
+                if job is None or job.result is None or job.result.get("status") != "success":
+                    errors += 1
+            total_requests += batch_size
+        elapsed = time.perf_counter() - start
+
+        results.append({
+            "batch_size": batch_size,
+            "requests": total_requests,
+            "errors": errors,
+            "seconds": elapsed,
+            "requests_per_second": total_requests / elapsed,
+            "latency_per_batch": elapsed / rounds
+        })
+        print(f"   batch_size={batch_size:<3} {total_requests / elapsed:8.3f} req/s  "
+              f"({elapsed / rounds:.2f} s/batch, lỗi: {errors})")
+    return results
+
+def bench_preprocess_stages(sizes, repeats):
+    """Thời gian từng bước tiền xử lý (decode, chia tile, normalize) theo kích thước ảnh."""
+    from image_preprocess import open_image, tile_image, normalize_tiles
+
+    results = []
+    for index, (width, height) in enumerate(sizes):
+        image_data = make_synthetic_image(width, height, seed=index)
+        timings = {"decode": [], "tile": [], "normalize": [], "total": []}
+        for _ in range(repeats + 1):
+            start = time.perf_counter()
+            image = open_image(image_data)
+            image.load()
+            decoded = time.perf_counter()
+            tiles = tile_image(image)
+            tiled = time.perf_counter()
+            pixel_values = normalize_tiles(tiles)
+            done = time.perf_counter()
+            for stage, seconds in (("decode", decoded - start), ("tile", tiled - decoded),
+                                   ("normalize", done - tiled), ("total", done - start)):
+                timings[stage].append(seconds)
+        # Lần đầu là warm-up
+        result = {"size": f"{width}x{height}", "bytes": len(image_data), "tiles": int(pixel_values.size(0))}
+        result.update({f"{stage}_ms": statistics.median(values[1:]) * 1000 for stage, values in timings.items()})
+        results.append(result)
+        print(f"   {result['size']:<10} tiles={result['tiles']}  decode {result['decode_ms']:6.1f} ms  "
+              f"chia tile {result['tile_ms']:6.1f} ms  normalize {result['normalize_ms']:6.1f} ms  "
+              f"tổng {result['total_ms']:6.1f} ms")
+    return results
+
+def bench_queue_roundtrip(app, image_data, requests_count, profile):
+    """So sánh 1 request đi qua hàng đợi (submit_job -> tiền xử lý -> worker -> kết quả)
+    với gọi thẳng process_invoice_request: phần chênh lệch là chi phí hàng đợi/bàn giao giữa các thread."""
+    options = {"profile": profile, "no_cache": True}
+    direct = [run_extraction(app, image_data, options)[1] for _ in range(requests_count)]
+    queued = []
+    errors = 0
+    for _ in range(requests_count):
+        start = time.perf_counter()
+        job = app.submit_job(image_data, options)
+        job.wait(timeout=app.REQUEST_TIMEOUT_S)
+        queued.append(time.perf_counter() - start)
+        app.job_store.pop(job.job_id)
+        if job.result is None or job.result.get("status") != "success":
+            errors += 1
+    result = {
+        "requests": requests_count,
+        "errors": errors,
+        "direct_median_s": statistics.median(direct),
+        "queued_median_s": statistics.median(queued),
+        "overhead_ms": (statistics.median(queued) - statistics.median(direct)) * 1000
+    }
+    print(f"   gọi thẳng {result['direct_median_s'] * 1000:8.1f} ms  qua hàng đợi {result['queued_median_s'] * 1000:8.1f} ms  "
+          f"chênh lệch {result['overhead_ms']:6.1f} ms  (lỗi: {errors})")
+    return result
+
+def bench_end_to_end(app, images, requests_count, concurrency_levels, profile):
+    """Requests/s và độ trễ qua endpoint /extract_invoice (Flask test client) ở các mức đồng thời."""
+    import threading
+
+    results = []
+    for concurrency in concurrency_levels:
+        latencies = []
+        statuses = {}
+        lock = threading.Lock()
+        counter = iter(range(requests_count))
+
+        def client_loop():
+            client = app.app.test_client()
+            for index in counter:
+                start = time.perf_counter()
+                response = client.post(f'/extract_invoice?no_cache=1&profile={profile}', data={
+                    'image': (io.BytesIO(images[index % len(images)]), 'image.jpg')
+                })
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client_loop) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        results.append({
+            "concurrency": concurrency,
+            "requests": requests_count,
+            "seconds": elapsed,
+            "requests_per_second": requests_count / elapsed,
+            "p50_s": percentile(latencies, 50),
+            "p90_s": percentile(latencies, 90),
+            "p99_s": percentile(latencies, 99),
+            "status_codes": {str(code): count for code, count in sorted(statuses.items())}
+        })
+        print(f"   đồng thời {concurrency:<3} {requests_count / elapsed:7.2f} req/s  p50 {results[-1]['p50_s']:6.2f} s  "
+              f"p90 {results[-1]['p90_s']:6.2f} s  p99 {results[-1]['p99_s']:6.2f} s  HTTP {results[-1]['status_codes']}")
+    return results
+
+def cmd_batching(args):
+    """Benchmark micro-batching với model thật."""
+    image_files = find_images(args.images, limit=args.limit)
+    if not image_files:
+        print(f"❌ Không tìm thấy ảnh nào trong {args.images}")
+        return 1
+    images = read_images(image_files)
+
+    import app
+    app.load_model()
+
+    print("="*60)
+    print(f"BENCHMARK MICRO-BATCHING ({len(images)} ảnh, device: {app.device})")
+    print("="*60)
+    bench_batching(app, images, args.batch_sizes, args.rounds)
+    return 0
+
+def cmd_preprocess(args):
+    """Benchmark tiền xử lý ảnh (không cần model)."""
+    if args.images:
+        image_files = find_images(args.images, limit=args.limit)
+        samples = [(os.path.basename(path), data) for path, data in zip(image_files, read_images(image_files))]
+    else:
+        samples = [(f"synthetic {w}x{h}", make_synthetic_image(w, h, seed=i))
+                   for i, (w, h) in enumerate(parse_size(size) for size in args.sizes)]
+    if not samples:
+        print(f"❌ Không tìm thấy ảnh nào trong {args.images}")
+        return 1
+
+    print("="*60)
+    print(f"BENCHMARK TIỀN XỬ LÝ ẢNH ({len(samples)} ảnh, {args.repeats} lần đo/ảnh)")
+    print("="*60)
+    bench_preprocess(samples, args.repeats)
+    return 0
+
+def cmd_profiles(args):
+    """So sánh các profile generation với model thật."""
+    image_files = find_images(args.images, limit=args.limit)
+    if not image_files:
+        print(f"❌ Không tìm thấy ảnh nào trong {args.images}")
+        return 1
+    images = read_images(image_files)
+
+    import app
+    app.load_model()
+
+    print("="*60)
+    print(f"BENCHMARK PROFILE GENERATION ({len(images)} ảnh, device: {app.device})")
+    print("="*60)
+    bench_profiles(app, images, args.profiles, reference_profile=args.reference)
+    return 0
+
+def cmd_tiles(args):
+    """So sánh chia tile cố định với adaptive (cần model, hoặc STAND_IN_MODEL=1 để chỉ đo độ trễ)."""
+    if args.images:
+        image_files = find_images(args.images, limit=args.limit)
+        samples = [(os.path.basename(path), data) for path, data in zip(image_files, read_images(image_files))]
+    else:
+        samples = [(f"synthetic {w}x{h}", make_synthetic_image(w, h, seed=i))
+                   for i, (w, h) in enumerate(parse_size(size) for size in args.sizes)]
+    if not samples:
+        print(f"❌ Không tìm thấy ảnh nào trong {args.images}")
+        return 1
+
+    import app
+    app.load_model()
+
+    print("="*60)
+    print(f"BENCHMARK CHIA TILE ({len(samples)} ảnh, device: {app.device}, profile {args.profile})")
+    print("="*60)
+    bench_tiles(app, samples, args.profile)
+    return 0
+
+def cmd_prefix(args):
+    """Đo tác dụng của KV cache prefix prompt (cần model, hoặc STAND_IN_MODEL=1)."""
+    if args.images:
+        images = read_images(find_images(args.images, limit=args.limit))
+    else:
+        images = [make_synthetic_image(*parse_size(size), seed=i) for i, size in enumerate(args.sizes)]
+    if not images:
+        print(f"❌ Không tìm thấy ảnh nào trong {args.images}")
+        return 1
+
+    import app
+    app.load_model()
+    from image_preprocess import load_image
+    dtype = app.torch.bfloat16 if app.device == "cuda" else app.torch.float32
+    pixel_values_list = [load_image(image_data).to(dtype) for image_data in images]
+
+    print("="*60)
+    print(f"BENCHMARK PREFIX CACHE ({len(images)} ảnh, device: {app.device}, profile {args.profile})")
+    print("="*60)
+    return 0 if bench_prefix(app, pixel_values_list, args.profile, args.repeats, args.max_new_tokens) else 1
+
+def cmd_schema(args):
+    """So sánh decode tự do với decode theo schema (cần model, hoặc STAND_IN_MODEL=1)."""
+    if args.images:
+        images = read_images(find_images(args.images, limit=args.limit))
+    else:
+        images = [make_synthetic_image(*parse_size(size), seed=i) for i, size in enumerate(args.sizes)]
+    if not images:
+        print(f"❌ Không tìm thấy ảnh nào trong {args.images}")
+        return 1
+
+    import app
+    app.load_model()
+    app.schema_decoder.prepare()
+    from image_preprocess import load_image
+    dtype = app.torch.bfloat16 if app.device == "cuda" else app.torch.float32
+    pixel_values_list = [load_image(image_data).to(dtype) for image_data in images]
+
+    print("="*60)
+    print(f"BENCHMARK DECODE THEO SCHEMA ({len(images)} ảnh, device: {app.device}, profile {args.profile})")
+    print("="*60)
+    bench_schema(app, pixel_values_list, args.profile, args.repeats)
+    return 0
+
+def cmd_speculative(args):
+    """Đo speculative decoding (cần model, hoặc STAND_IN_MODEL=1)."""
+    if args.images:
+        images = read_images(find_images(args.images, limit=args.limit))
+    else:
+        images = [make_synthetic_image(*parse_size(args.size), seed=i) for i in range(args.limit)]
+    if not images:
+        print(f"❌ Không tìm thấy ảnh nào trong {args.images}")
+        return 1
+
+    import app
+    app.load_model()
+    from image_preprocess import load_image
+    dtype = app.torch.bfloat16 if app.device == "cuda" else app.torch.float32
+    pixel_values_list = [load_image(image_data).to(dtype) for image_data in images]
+
+    print("="*60)
+    print(f"BENCHMARK SPECULATIVE DECODING ({len(images)} ảnh, device: {app.device}, profile {args.profile})")
+    print("="*60)
+    bench_speculative(app, pixel_values_list, args.profile)
+    return 0
+
+def cmd_metrics(args):
+    """Benchmark chi phí instrumentation (không cần model)."""
+    if args.image:
+        with open(args.image, 'rb') as f:
+            image_data = f.read()
+    else:
+        image_data = make_synthetic_image(*parse_size(args.size))
+
+    print("="*60)
+    print("BENCHMARK CHI PHÍ METRICS")
+    print("="*60)
+    tokenizer, tokenizer_name = load_metrics_tokenizer(args.tokenizer)
+    print(f"   Tokenizer đếm token: {tokenizer_name}")
+    result = bench_metrics_overhead(image_data, args.repeats, iterations=args.iterations, tokenizer=tokenizer)
+    return 0 if result["below_1_percent"] else 1
+
+def cmd_replicas(args):
+    """Benchmark số replica inference với model thật (CPU)."""
+    image_files = find_images(args.images, limit=args.limit)
+    if not image_files:
+        print(f"❌ Không tìm thấy ảnh nào trong {args.images}")
+        return 1
+
+    import torch
+    # Process chính không được chạy song song bằng OpenMP trước khi fork replica
+    torch.set_num_threads(1)
+    from image_preprocess import load_image
+    pixel_values_list = [load_image(image_data) for image_data in read_images(image_files)]
+
+    import app
+    app.load_model()
+    if app.device != "cpu":
+        print("❌ Benchmark replica chỉ hỗ trợ CPU")
+        return 1
+
+    print("="*60)
+    print(f"BENCHMARK REPLICA ({len(pixel_values_list)} ảnh, {os.cpu_count()} CPU, profile {args.profile})")
+    print("="*60)
+    bench_replicas(app, pixel_values_list, args.replicas, args.requests, args.profile, threads=args.threads)
+    return 0
+
+def cmd_quantize(args):
+    """So sánh fp32 với int8 dynamic quantization trên CPU (cần model)."""
+    image_files = find_images(args.images, limit=args.limit)
+    if not image_files:
+        print(f"❌ Không tìm thấy ảnh nào trong {args.images}")
+        return 1
+    if args.worker:
+        # Chạy trên CPU kể cả khi có GPU: lượng tử hóa động chỉ hỗ trợ CPU
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        mode, _, projector = args.worker.partition('+')
+        quantize_worker(image_files, mode, projector == 'vision', args.profile, args.output)
+        return 0
+
+    print("="*60)
+    print(f"BENCHMARK LƯỢNG TỬ HÓA ({len(image_files)} ảnh, CPU, profile {args.profile})")
+    print("="*60)
+    return 0 if bench_quantize(image_files, args.modes, args.profile) is not None else 1
+
+def cmd_fetch(args):
+    """Kiểm tra ImageFetcher với server HTTP cục bộ (không cần model, không cần mạng)."""
+    image_data = make_synthetic_image(*parse_size(args.size))
+
+    print("="*60)
+    print(f"BENCHMARK TẢI ẢNH ({len(image_data)} bytes/ảnh)")
+    print("="*60)
+    results = bench_fetch(image_data, args.repeats, args.concurrency, args.slow_delay, args.max_bytes)
+    return 0 if results["large"]["rejected"] else 1
+
+def cmd_suite(args):
+    """Bộ benchmark offline với model thay thế (mặc định) hoặc model thật, ghi kết quả ra JSON."""
+    import json
+    import platform
+
+    if not args.real_model:
+        os.environ['STAND_IN_MODEL'] = '1'
+    sizes = [parse_size(size) for size in args.sizes]
+    if args.images:
+        images = read_images(find_images(args.images, limit=args.limit))
+    else:
+        images = [make_synthetic_image(*sizes[i % len(sizes)], seed=i) for i in range(args.limit)]
+    if not images:
+        print(f"❌ Không tìm thấy ảnh nào trong {args.images}")
+        return 1
+
+    print("="*60)
+    print(f"BỘ BENCHMARK ({'model thật' if args.real_model else 'model thay thế'}, {len(images)} ảnh, "
+          f"{os.cpu_count()} CPU, profile {args.profile})")
+    print("="*60)
+    print("\n📐 Tiền xử lý theo kích thước ảnh")
+    preprocess = bench_preprocess_stages(sizes, args.repeats)
+
+    import torch
+    import app
+    # Load model, khởi động worker, warm-up như khi chạy server
+    app.start_server_runtime()
+
+    print("\n🔁 Vòng hàng đợi")
+    queue_roundtrip = bench_queue_roundtrip(app, images[0], args.repeats, args.profile)
+    print("\n🌐 Đầu-cuối qua /extract_invoice")
+    end_to_end = bench_end_to_end(app, images, args.requests, args.concurrency, args.profile)
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+            "device": app.device,
+            "model": "stand-in" if app.STAND_IN_MODEL else app.MODEL_NAME,
+            "profile": args.profile,
+            "batch_max_size": app.BATCH_MAX_SIZE,
+            "inference_replicas": app.INFERENCE_REPLICAS,
+            "quantization": app.quantization_info,
+            "startup_s": app.startup_state["phases"]
+        },
+        "preprocess": preprocess,
+        "queue_roundtrip": queue_roundtrip,
+        "end_to_end": end_to_end
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Đã ghi kết quả vào {args.output}")
+    return 0 if queue_roundtrip["errors"] == 0 and all(
+        set(run["status_codes"]) == {"200"} for run in end_to_end) else 1
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hiệu năng API InternVL')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batching = subparsers.add_parser('batching', help='Đo requests/s của micro-batching (cần model)')
+    batching.add_argument('images', nargs='*', default=['UnBoundingDATASET'],
+                          help='File ảnh hoặc thư mục ảnh (mặc định: UnBoundingDATASET)')
+    batching.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8],
+                          help='Các batch size cần đo (mặc định: 1 2 4 8)')
+    batching.add_argument('--rounds', type=int, default=3, help='Số batch đo cho mỗi batch size (mặc định: 3)')
+    batching.add_argument('--limit', type=int, default=16, help='Số ảnh tối đa dùng để đo (mặc định: 16)')
+    batching.set_defaults(func=cmd_batching)
+
+    preprocess = subparsers.add_parser('preprocess', help='So sánh load_image vector hóa với cách làm cũ')
+    preprocess.add_argument('images', nargs='*', help='File ảnh hoặc thư mục ảnh (mặc định: ảnh giả lập)')
+    preprocess.add_argument('--sizes', nargs='+', default=['640x480', '1280x960', '1080x1920', '3024x4032'],
+                            help='Kích thước ảnh giả lập WxH (mặc định: 640x480 1280x960 1080x1920 3024x4032)')
+    preprocess.add_argument('--repeats', type=int, default=10, help='Số lần đo mỗi ảnh (mặc định: 10)')
+    preprocess.add_argument('--limit', type=int, default=16, help='Số ảnh tối đa dùng để đo (mặc định: 16)')
+    preprocess.set_defaults(func=cmd_preprocess)
+
+    profiles = subparsers.add_parser('profiles', help='So sánh độ trễ/độ chính xác giữa các profile (cần model)')
+    profiles.add_argument('images', nargs='*', default=['UnBoundingDATASET'],
+                          help='File ảnh hoặc thư mục ảnh (mặc định: UnBoundingDATASET)')
+    profiles.add_argument('--profiles', nargs='+', default=['fast', 'balanced', 'accurate'],
+                          help='Các profile cần so sánh (mặc định: fast balanced accurate)')
+    profiles.add_argument('--reference', default='accurate', help='Profile tham chiếu để tính độ trùng khớp')
+    profiles.add_argument('--limit', type=int, default=10, help='Số ảnh tối đa (mặc định: 10)')
+    profiles.set_defaults(func=cmd_profiles)
+
+    tiles = subparsers.add_parser('tiles', help='So sánh chia tile cố định với adaptive: số tile, độ trễ, độ trùng khớp (cần model)')
+    tiles.add_argument('images', nargs='*', help='File ảnh hoặc thư mục ảnh (mặc định: ảnh giả lập)')
+    tiles.add_argument('--sizes', nargs='+', default=['800x1000', '1080x1920', '3024x4032'],
+                       help='Kích thước ảnh giả lập WxH khi không có ảnh')
+    tiles.add_argument('--profile', default='fast', help='Profile generation (mặc định: fast)')
+    tiles.add_argument('--limit', type=int, default=10, help='Số ảnh tối đa (mặc định: 10)')
+    tiles.set_defaults(func=cmd_tiles)
+
+    prefix = subparsers.add_parser('prefix', help='Đo độ trễ có/không dùng KV cache của prefix prompt (cần model)')
+    prefix.add_argument('images', nargs='*', help='File ảnh hoặc thư mục ảnh (mặc định: ảnh giả lập)')
+    prefix.add_argument('--sizes', nargs='+', default=['800x1000'], help='Kích thước ảnh giả lập WxH khi không có ảnh')
+    prefix.add_argument('--profile', default='fast', help='Profile generation (mặc định: fast)')
+    prefix.add_argument('--repeats', type=int, default=5, help='Số lần đo (mặc định: 5)')
+    prefix.add_argument('--max-new-tokens', type=int, default=1,
+                        help='Số token sinh mỗi lượt (mặc định: 1 - chỉ đo prefill)')
+    prefix.add_argument('--limit', type=int, default=4, help='Số ảnh tối đa (mặc định: 4)')
+    prefix.set_defaults(func=cmd_prefix)
+
+    schema = subparsers.add_parser('schema', help='So sánh decode tự do với decode theo schema JSON (cần model)')
+    schema.add_argument('images', nargs='*', help='File ảnh hoặc thư mục ảnh (mặc định: ảnh giả lập)')
+    schema.add_argument('--sizes', nargs='+', default=['800x1000', '1080x1920'],
+                        help='Kích thước ảnh giả lập WxH khi không có ảnh')
+    schema.add_argument('--profile', default='fast', help='Profile của decode tự do (mặc định: fast)')
+    schema.add_argument('--repeats', type=int, default=1, help='Số lần đo mỗi ảnh (mặc định: 1)')
+    schema.add_argument('--limit', type=int, default=4, help='Số ảnh tối đa (mặc định: 4)')
+    schema.set_defaults(func=cmd_schema)
+
+    speculative = subparsers.add_parser('speculative',
+                                        help='Speculative decoding với draft từ kết quả trước so với decode tự do (cần model)')
+    speculative.add_argument('images', nargs='*',
+                             help='File ảnh hoặc thư mục ảnh, nên cùng cửa hàng (mặc định: ảnh giả lập)')
+    speculative.add_argument('--size', default='800x1000', help='Kích thước ảnh giả lập WxH khi không có ảnh')
+    speculative.add_argument('--profile', default='fast',
+                             help='Profile (max_new_tokens, repetition_penalty; mặc định: fast - greedy như speculative)')
+    speculative.add_argument('--limit', type=int, default=4, help='Số ảnh tối đa (mặc định: 4)')
+    speculative.set_defaults(func=cmd_speculative)
+
+    metrics = subparsers.add_parser('metrics', help='Đo chi phí instrumentation /metrics (không cần model)')
+    metrics.add_argument('--image', help='Ảnh dùng để đo tiền xử lý (mặc định: ảnh giả lập)')
+    metrics.add_argument('--size', default='1280x960', help='Kích thước ảnh giả lập WxH (mặc định: 1280x960)')
+    metrics.add_argument('--iterations', type=int, default=10000,
+                         help='Số request giả lập để đo chi phí ghi metrics (mặc định: 10000)')
+    metrics.add_argument('--repeats', type=int, default=10, help='Số lần đo tiền xử lý (mặc định: 10)')
+    metrics.add_argument('--tokenizer', default='internvl_local',
+                         help='Thư mục tokenizer của model để đo chi phí đếm token (mặc định: internvl_local; '
+                              'không có thì dùng tokenizer của model thay thế)')
+    metrics.set_defaults(func=cmd_metrics)
+
+    replicas = subparsers.add_parser('replicas', help='Đo requests/s theo số replica inference trên CPU (cần model)')
+    replicas.add_argument('images', nargs='*', default=['UnBoundingDATASET'],
+                          help='File ảnh hoặc thư mục ảnh (mặc định: UnBoundingDATASET)')
+    replicas.add_argument('--replicas', type=int, nargs='+', default=[1, 2, 4, 8],
+                          help='Các số replica cần đo (mặc định: 1 2 4 8)')
+    replicas.add_argument('--threads', type=int, help='Số thread mỗi replica (mặc định: số CPU / số replica)')
+    replicas.add_argument('--requests', type=int, default=16, help='Số request đo cho mỗi cấu hình (mặc định: 16)')
+    replicas.add_argument('--profile', default='fast', help='Profile generation (mặc định: fast)')
+    replicas.add_argument('--limit', type=int, default=8, help='Số ảnh tối đa (mặc định: 8)')
+    replicas.set_defaults(func=cmd_replicas)
+
+    quantize = subparsers.add_parser('quantize', help='So sánh fp32 với int8 trên CPU: độ trễ, RSS, độ trùng khớp (cần model)')
+    quantize.add_argument('images', nargs='*', default=['UnBoundingDATASET'],
+                          help='File ảnh hoặc thư mục ảnh (mặc định: UnBoundingDATASET)')
+    quantize.add_argument('--modes', nargs='+', default=['none', 'int8', 'int8+vision'],
+                          help='Các mode cần so sánh, mode đầu tiên là tham chiếu (mặc định: none int8 int8+vision)')
+    quantize.add_argument('--profile', default='fast', help='Profile generation (mặc định: fast)')
+    quantize.add_argument('--limit', type=int, default=10, help='Số ảnh tối đa (mặc định: 10)')
+    quantize.add_argument('--worker', help=argparse.SUPPRESS)
+    quantize.add_argument('--output', help=argparse.SUPPRESS)
+    quantize.set_defaults(func=cmd_quantize)
+
+    fetch = subparsers.add_parser('fetch', help='Kiểm tra tải ảnh từ URL với server HTTP cục bộ (không cần model)')
+    fetch.add_argument('--size', default='1280x960', help='Kích thước ảnh giả lập WxH (mặc định: 1280x960)')
+    fetch.add_argument('--repeats', type=int, default=20, help='Số lần đo ảnh lặp lại (mặc định: 20)')
+    fetch.add_argument('--concurrency', type=int, default=8, help='Số lượt tải đồng thời (mặc định: 8)')
+    fetch.add_argument('--slow-delay', type=float, default=0.5, help='Độ trễ (giây) của ảnh chậm (mặc định: 0.5)')
+    fetch.add_argument('--max-bytes', type=int, default=20 * 1024 * 1024,
+                       help='Dung lượng ảnh tối đa (mặc định: 20MB)')
+    fetch.set_defaults(func=cmd_fetch)
+
+    suite = subparsers.add_parser('suite', help='Bộ benchmark offline, ghi kết quả ra JSON (mặc định model thay thế, CPU)')
+    suite.add_argument('images', nargs='*', help='File ảnh hoặc thư mục ảnh cho phần đầu-cuối (mặc định: ảnh giả lập)')
+    suite.add_argument('--sizes', nargs='+', default=['640x480', '1280x960', '1080x1920', '3024x4032'],
+                       help='Kích thước ảnh giả lập WxH (mặc định: 640x480 1280x960 1080x1920 3024x4032)')
+    suite.add_argument('--repeats', type=int, default=5, help='Số lần đo tiền xử lý/vòng hàng đợi (mặc định: 5)')
+    suite.add_argument('--requests', type=int, default=8, help='Số request đầu-cuối mỗi mức đồng thời (mặc định: 8)')
+    suite.add_argument('--concurrency', type=int, nargs='+', default=[1, 4],
+                       help='Các mức request đồng thời (mặc định: 1 4)')
+    suite.add_argument('--profile', default='fast', help='Profile generation (mặc định: fast)')
+    suite.add_argument('--limit', type=int, default=8, help='Số ảnh tối đa (mặc định: 8)')
+    suite.add_argument('--real-model', action='store_true', help='Dùng model thật trong internvl_local thay cho model thay thế')
+    suite.add_argument('--output', default='benchmark_results.json', help='File JSON kết quả (mặc định: benchmark_results.json)')
+    suite.set_defaults(func=cmd_suite)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        print("\n\n⚠️  Bị hủy bởi người dùng")
+        sys.exit(1)
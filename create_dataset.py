@@ -1,121 +1,41 @@
 """
 Script tự động tạo dataset từ model InternVL
-Chạy model trên tất cả ảnh trong UnBoundingDATASET và xuất ra Hugging Face Dataset hoặc CSV
+Chạy model trên tất cả ảnh trong UnBoundingDATASET và xuất ra Hugging Face Dataset (shard Parquet) và/hoặc CSV
+- Pool thread đọc + decode + chia tile ảnh trước (prefetch) trong lúc model chạy
+- Model chạy batch_chat theo nhóm ảnh, tiến độ hiển thị ảnh/s và thời gian còn lại (ETA)
+- Kết quả lưu vào manifest (theo hash nội dung ảnh + version model/prompt) sau mỗi batch:
+  chạy lại chỉ xử lý ảnh mới/đã thay đổi
+- Kết quả được ghi ngay vào các sink (shard Parquet, CSV) trong cùng một lượt inference, không giữ trong bộ nhớ
+- Chia việc cho nhiều process/máy (--num-shards/--shard-index, gán ảnh theo hash đường dẫn), index file ảnh
+  được cache giữa các lần chạy, --merge gộp output các shard thành 1 dataset
 """
 import os
-import io
-import csv
 import json
+import time
+import itertools
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import torch
-import torchvision.transforms as T
-from PIL import Image
-from torchvision.transforms.functional import InterpolationMode
 from transformers import AutoModel, AutoTokenizer
 import sys
 
-try:
-    from datasets import Dataset, DatasetDict, Features, Value, Image as HFImage
-    HF_DATASETS_AVAILABLE = True
-except ImportError:
-    HF_DATASETS_AVAILABLE = False
-    print("⚠️  Hugging Face datasets không được cài đặt. Chỉ có thể xuất CSV.")
-    print("   Cài đặt: pip install datasets")
+from dataset_writer import PARQUET_AVAILABLE, CsvSink, ParquetShardSink
+if not PARQUET_AVAILABLE:
+    print("⚠️  pyarrow không được cài đặt. Chỉ có thể xuất CSV.")
+    print("   Cài đặt: pip install pyarrow datasets")
 
 # Set UTF-8 encoding cho Windows
 if sys.platform == 'win32':
     sys.stdout.reconfigure(encoding='utf-8')
 
-# Import các hàm từ app.py
-IMAGENET_MEAN = (0.485, 0.456, 0.406)
-IMAGENET_STD = (0.229, 0.224, 0.225)
+# Tiền xử lý ảnh và cấu hình generation dùng chung với app.py
+from image_preprocess import open_image, tile_image, normalize_tiles
+from generation import GENERATION_PROFILES, get_profile_config
+from generation_runtime import to_generate_kwargs
+from dataset_manifest import DatasetManifest, hash_file_content, model_identity, make_version
+from dataset_shards import scan_image_files, select_shard, merge_parquet_datasets, merge_csv_files
 
-def build_transform(input_size):
-    """Xây dựng pipeline chuyển đổi ảnh."""
-    transform = T.Compose([
-        T.Lambda(lambda img: img.convert('RGB') if img.mode != 'RGB' else img),
-        T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
-        T.ToTensor(),
-        T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
-    ])
-    return transform
-
-def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-    """Tìm tỷ lệ khung hình gần nhất với ảnh gốc."""
-    best_ratio_diff = float('inf')
-    best_ratio = (1, 1)
-    area = width * height
-    for ratio in target_ratios:
-        target_aspect_ratio = ratio[0] / ratio[1]
-        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-        if ratio_diff < best_ratio_diff:
-            best_ratio_diff = ratio_diff
-            best_ratio = ratio
-        elif ratio_diff == best_ratio_diff:
-            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                best_ratio = ratio
-    return best_ratio
-
-def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=False):
-    """Tiền xử lý ảnh động, chia ảnh thành các patches."""
-    orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
-
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
-
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
-
-    target_width = image_size * target_aspect_ratio[0]
-    target_height = image_size * target_aspect_ratio[1]
-    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
-
-    resized_img = image.resize((target_width, target_height))
-    processed_images = []
-    for i in range(blocks):
-        box = (
-            (i % (target_width // image_size)) * image_size,
-            (i // (target_width // image_size)) * image_size,
-            ((i % (target_width // image_size)) + 1) * image_size,
-            ((i // (target_width // image_size)) + 1) * image_size
-        )
-        split_img = resized_img.crop(box)
-        processed_images.append(split_img)
-    assert len(processed_images) == blocks
-    if use_thumbnail and len(processed_images) != 1:
-        thumbnail_img = image.resize((image_size, image_size))
-        processed_images.append(thumbnail_img)
-    return processed_images
-
-def load_image(image_path, input_size=448, max_num=6):
-    """Tải và tiền xử lý ảnh từ đường dẫn file."""
-    image = Image.open(image_path).convert('RGB')
-    transform = build_transform(input_size=input_size)
-    images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
-    pixel_values = [transform(img) for img in images]
-    pixel_values = torch.stack(pixel_values)
-    return pixel_values
-
-def find_all_images(dataset_path):
-    """Tìm tất cả file ảnh trong thư mục dataset."""
-    image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp'}
-    image_files = []
-    
-    if not os.path.exists(dataset_path):
-        return image_files
-    
-    for root, dirs, files in os.walk(dataset_path):
-        for file in files:
-            if any(file.lower().endswith(ext) for ext in image_extensions):
-                image_files.append(os.path.join(root, file))
-    
-    return sorted(image_files)
-
-def extract_invoice_info(model, tokenizer, image_path):
-    """Trích xuất thông tin từ ảnh hóa đơn."""
-    DEFAULT_QUESTION = """<image>
+DEFAULT_QUESTION = """<image>
 Trích xuất tất cả các trường thông tin từ hóa đơn/biên lai trong ảnh dưới dạng đối tượng JSON.
 Các trường BẮT BUỘC phải trích xuất:
 - "Tên người bán"
@@ -124,28 +44,70 @@ Các trường BẮT BUỘC phải trích xuất:
 - "Tổng tiền thanh toán" (Total Amount)
 - "Danh sách món" (Mảng chứa "Tên món", "Đơn giá", "Số lượng")
 """
-    
-    # Load và tiền xử lý ảnh
-    pixel_values = load_image(image_path, max_num=6)
-    if torch.cuda.is_available():
-        pixel_values = pixel_values.to(torch.bfloat16).cuda()
-    else:
-        pixel_values = pixel_values.to(torch.float32)
-    
-    # Cấu hình Generation
-    generation_config = dict(
-        max_new_tokens=1024, 
-        do_sample=False,
-        temperature=0.0,
-        num_beams=3, 
-        repetition_penalty=3.5
-    )
-    
-    # Chạy model
+
+def find_all_images(dataset_path, cache_path=None):
+    """Tìm tất cả file ảnh trong thư mục dataset: đường dẫn tương đối (phân cách '/'), đã sắp xếp.
+
+    cache_path: file index JSON, thư mục không thay đổi từ lần chạy trước không phải liệt kê lại.
+    """
+    if not os.path.exists(dataset_path):
+        return []
+    return scan_image_files(dataset_path, cache_path)
+
+# Ảnh đã tiền xử lý: image_data là bytes gốc của file, pixel_values là None nếu ảnh đã có trong manifest
+PreparedImage = namedtuple('PreparedImage', 'idx image_path content_hash image_data pixel_values error')
+
+def prepare_image(image_path, dtype, done_hashes=frozenset()):
+    """Đọc file 1 lần, hash nội dung; decode và chia tile nếu ảnh chưa được xử lý.
+
+    Trả về (content_hash, bytes ảnh, pixel_values), pixel_values là None nếu hash có trong done_hashes.
+    """
+    with open(image_path, 'rb') as f:
+        image_data = f.read()
+    content_hash = hash_file_content(image_data)
+    if content_hash in done_hashes:
+        return content_hash, image_data, None
+    image = open_image(image_data)
+    pixel_values = normalize_tiles(tile_image(image, max_num=6)).to(dtype)
+    return content_hash, image_data, pixel_values
+
+def iter_prepared_images(indexed_files, dtype, workers=4, prefetch=16, done_hashes=frozenset()):
+    """Tiền xử lý ảnh [(id, đường dẫn), ...] trong pool thread, trả về PreparedImage theo thứ tự file.
+
+    Tối đa prefetch ảnh đã/đang được chuẩn bị chờ model để bộ nhớ không tăng theo số ảnh.
+    """
+    files = iter(indexed_files)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque((idx, path, executor.submit(prepare_image, path, dtype, done_hashes))
+                        for idx, path in itertools.islice(files, prefetch))
+        while pending:
+            idx, image_path, future = pending.popleft()
+            next_file = next(files, None)
+            if next_file is not None:
+                pending.append((next_file[0], next_file[1],
+                                executor.submit(prepare_image, next_file[1], dtype, done_hashes)))
+            try:
+                yield PreparedImage(idx, image_path, *future.result(), None)
+            except Exception as e:
+                yield PreparedImage(idx, image_path, None, None, None, e)
+
+def extract_invoice_batch(model, tokenizer, pixel_values_list, generation_config, device):
+    """Trích xuất thông tin từ nhiều ảnh hóa đơn trong một lượt batch_chat."""
+    pixel_values = torch.cat(pixel_values_list, dim=0).to(device)
     with torch.no_grad():
-        extraction_result = model.chat(tokenizer, pixel_values, DEFAULT_QUESTION, generation_config)
-    
-    return extraction_result
+        if len(pixel_values_list) == 1:
+            return [model.chat(tokenizer, pixel_values, DEFAULT_QUESTION, generation_config)]
+        return model.batch_chat(
+            tokenizer, pixel_values,
+            num_patches_list=[pv.size(0) for pv in pixel_values_list],
+            questions=[DEFAULT_QUESTION] * len(pixel_values_list),
+            generation_config=generation_config
+        )
+
+def format_duration(seconds):
+    """Định dạng số giây thành HH:MM:SS."""
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
 
 def parse_extraction_result(extraction_result):
     """Parse kết quả trích xuất từ model (có thể là JSON string hoặc dict)."""
@@ -189,133 +151,226 @@ def generate_conversations(extraction_result):
     
     return conversations
 
-def process_all_images(dataset_path, model, tokenizer, output_path='dataset', output_format='hf'):
-    """Xử lý tất cả ảnh và tạo dataset (Hugging Face hoặc CSV)."""
-    image_files = find_all_images(dataset_path)
+def build_sample(extraction_result):
+    """Tạo phần nội dung của 1 mẫu (description, extractions, conversations) từ kết quả trích xuất."""
+    # Tạo description (tóm tắt)
+    extracted_data = parse_extraction_result(extraction_result)
+    
+    description_parts = ["Hóa đơn bán hàng"]
+    
+    name = extracted_data.get('Tên người bán') or extracted_data.get('Tên cửa hàng')
+    if name:
+        description_parts.append(f"của {name}")
+    
+    date = extracted_data.get('Ngày giao dịch') or extracted_data.get('Ngày bán')
+    if date:
+        description_parts.append(f"ngày {date}")
     
-    if not image_files:
+    total = extracted_data.get('Tổng tiền thanh toán') or extracted_data.get('Tổng tiền')
+    if total:
+        description_parts.append(f"tổng tiền {total}")
+    
+    description = ", ".join(description_parts) if len(description_parts) > 1 else str(extraction_result)[:200]
+    
+    # Tạo conversations
+    conversations = generate_conversations(extraction_result)
+    
+    # Format extractions
+    if isinstance(extraction_result, dict):
+        extractions_str = json.dumps(extraction_result, ensure_ascii=False)
+    else:
+        extractions_str = str(extraction_result)
+    
+    return {
+        'description': description,
+        'extractions': extractions_str,
+        'conversations': json.dumps(conversations, ensure_ascii=False)
+    }
+
+def build_record(idx, image_path, image_data, sample, image_name=None):
+    """Mẫu dataset hoàn chỉnh (bytes ảnh gốc + đường dẫn tương đối cho Parquet, đường dẫn cho CSV)."""
+    return {
+        'id': idx,
+        'image_bytes': image_data,
+        'image_path': image_path,
+        'image_name': image_name or os.path.basename(image_path),
+        **sample
+    }
+
+def process_all_images(dataset_path, model, tokenizer, sinks, batch_size=4, workers=4, prefetch=None,
+                       profile='accurate', manifest_path=None, model_name='internvl', resume=True,
+                       num_shards=1, shard_index=0, index_cache=None):
+    """Xử lý tất cả ảnh, ghi từng mẫu vào các sink (ParquetShardSink / CsvSink) theo thứ tự file.
+
+    manifest_path: file SQLite lưu kết quả sau mỗi batch; resume: bỏ qua ảnh đã có kết quả
+    cùng version (model_name + câu hỏi + profile) trong manifest.
+    num_shards/shard_index: chỉ xử lý ảnh thuộc shard này (id vẫn là vị trí trong toàn bộ danh sách ảnh).
+    Trả về số mẫu đã ghi.
+    """
+    scan_started = time.perf_counter()
+    all_files = find_all_images(dataset_path, index_cache)
+    
+    if not all_files:
         print(f"❌ Không tìm thấy ảnh nào trong {dataset_path}")
         return
+    print(f"[*] Index {len(all_files)} ảnh trong {time.perf_counter() - scan_started:.2f}s")
+    
+    ids = {relative_path: idx for idx, relative_path in enumerate(all_files, start=1)}
+    image_files = select_shard(all_files, num_shards, shard_index)
+    if num_shards > 1:
+        print(f"[*] Shard {shard_index}/{num_shards}: {len(image_files)} ảnh")
+    indexed_files = [(ids[relative_path], os.path.join(dataset_path, *relative_path.split('/')))
+                     for relative_path in image_files]
+    
+    device = next(model.parameters()).device
+    dtype = torch.bfloat16 if device.type == 'cuda' else torch.float32
+    generation_config = to_generate_kwargs(get_profile_config(profile), tokenizer)
+    prefetch = prefetch or 2 * batch_size + workers
     
-    print(f"[*] Tìm thấy {len(image_files)} ảnh")
-    print(f"[*] Bắt đầu xử lý...")
+    manifest = None
+    done_hashes = frozenset()
+    if manifest_path:
+        version = make_version(model_name, DEFAULT_QUESTION, get_profile_config(profile))
+        manifest = DatasetManifest(manifest_path, version)
+        if resume:
+            done_hashes = frozenset(manifest.done_hashes())
+        print(f"[*] Manifest: {manifest_path} (version {version}, {len(done_hashes)} ảnh đã có kết quả)")
     
-    results = []
+    print(f"[*] Tìm thấy {len(image_files)} ảnh cần xử lý")
+    print(f"[*] Bắt đầu xử lý (batch {batch_size}, {workers} thread tiền xử lý, prefetch {prefetch}, profile {profile})...")
     
-    for idx, image_path in enumerate(image_files, start=1):
+    counts = {"processed": 0, "skipped": 0, "errors": 0, "written": 0}
+    started_at = time.perf_counter()
+    # Ảnh theo thứ tự file chờ ghi (cả ảnh đã có trong manifest) để thứ tự mẫu trong output ổn định
+    pending = []
+    
+    def run_model(items):
+        """Chạy model cho các ảnh, trả về list kết quả (None nếu ảnh lỗi)."""
+        if not items:
+            return []
         try:
-            print(f"[{idx}/{len(image_files)}] Đang xử lý: {os.path.basename(image_path)}...")
-            
-            # Load ảnh PIL Image
-            image = Image.open(image_path).convert('RGB')
-            
-            # Trích xuất thông tin
-            extraction_result = extract_invoice_info(model, tokenizer, image_path)
-            
-            # Tạo description (tóm tắt)
-            extracted_data = parse_extraction_result(extraction_result)
-            
-            description_parts = ["Hóa đơn bán hàng"]
-            
-            name = extracted_data.get('Tên người bán') or extracted_data.get('Tên cửa hàng')
-            if name:
-                description_parts.append(f"của {name}")
-            
-            date = extracted_data.get('Ngày giao dịch') or extracted_data.get('Ngày bán')
-            if date:
-                description_parts.append(f"ngày {date}")
-            
-            total = extracted_data.get('Tổng tiền thanh toán') or extracted_data.get('Tổng tiền')
-            if total:
-                description_parts.append(f"tổng tiền {total}")
-            
-            description = ", ".join(description_parts) if len(description_parts) > 1 else str(extraction_result)[:200]
-            
-            # Tạo conversations
-            conversations = generate_conversations(extraction_result)
-            
-            # Format extractions
-            if isinstance(extraction_result, dict):
-                extractions_str = json.dumps(extraction_result, ensure_ascii=False)
-            else:
-                extractions_str = str(extraction_result)
-            
-            # Lưu kết quả (lưu cả PIL Image và đường dẫn để dễ xử lý sau)
-            result = {
-                'id': idx,
-                'image': image,  # PIL Image cho HF Dataset
-                'image_path': image_path,  # Đường dẫn cho CSV
-                'description': description,
-                'extractions': extractions_str,
-                'conversations': json.dumps(conversations, ensure_ascii=False)
-            }
-            
-            results.append(result)
-            print(f"    ✅ Hoàn thành")
-            
+            return extract_invoice_batch(
+                model, tokenizer, [item.pixel_values for item in items], generation_config, device)
         except Exception as e:
-            print(f"    ❌ Lỗi: {e}")
-            import traceback
-            traceback.print_exc()
-            continue
-    
-    if not results:
-        print("❌ Không có kết quả nào để lưu")
-        return
+            # Batch lỗi (vd: hết bộ nhớ) - chạy lại từng ảnh để không mất cả batch
+            print(f"    ⚠️  Batch {len(items)} ảnh lỗi ({e}), chạy lại từng ảnh...")
+            extraction_results = []
+            for item in items:
+                try:
+                    extraction_results.extend(
+                        extract_invoice_batch(model, tokenizer, [item.pixel_values], generation_config, device))
+                except Exception as e:
+                    print(f"    ❌ Lỗi: {os.path.basename(item.image_path)}: {e}")
+                    extraction_results.append(None)
+            return extraction_results
     
-    # Tạo dataset theo format
-    if output_format == 'hf' and HF_DATASETS_AVAILABLE:
-        print(f"\n[*] Đang tạo Hugging Face Dataset...")
-        
-        # Chuẩn bị data cho HF Dataset (bỏ image_path, chỉ giữ PIL Image)
-        hf_results = []
-        for result in results:
-            hf_result = result.copy()
-            hf_result.pop('image_path', None)  # Bỏ image_path, chỉ giữ PIL Image
-            hf_results.append(hf_result)
-        
-        # Tạo Dataset từ results
-        dataset = Dataset.from_list(hf_results)
-        
-        # Tạo DatasetDict với train split
-        dataset_dict = DatasetDict({
-            'train': dataset
-        })
-        
-        # Lưu dataset
-        dataset_dict.save_to_disk(output_path)
-        
-        print(f"✅ Đã tạo Hugging Face Dataset với {len(results)} mẫu")
-        print(f"✅ Dataset được lưu tại: {output_path}")
-        print(f"✅ Format: DatasetDict với train split")
-        print(f"✅ Features: {list(dataset.features.keys())}")
-        
-    elif output_format == 'csv' or not HF_DATASETS_AVAILABLE:
-        # Ghi vào CSV
-        output_csv = output_path if output_path.endswith('.csv') else f"{output_path}.csv"
-        print(f"\n[*] Đang ghi vào CSV: {output_csv}")
-        
-        # Chuyển đổi image từ PIL Image sang đường dẫn cho CSV
-        csv_results = []
-        for result in results:
-            csv_result = {
-                'id': result['id'],
-                'image': result.get('image_path', ''),  # Dùng image_path thay vì PIL Image
-                'description': result['description'],
-                'extractions': result['extractions'],
-                'conversations': result['conversations']
-            }
-            csv_results.append(csv_result)
+    def run_pending():
+        """Chạy model cho các ảnh đang chờ, lưu kết quả vào manifest (checkpoint), ghi vào sink rồi báo tiến độ."""
+        to_run = [item for item in pending if item.pixel_values is not None]
+        samples = dict(zip((item.idx for item in to_run), run_model(to_run)))
         
-        with open(output_csv, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=csv_results[0].keys())
-            writer.writeheader()
-            writer.writerows(csv_results)
+        finished = []
+        for item in pending:
+            if item.pixel_values is None:
+                sample = manifest.get(item.content_hash)
+            elif samples[item.idx] is None:
+                counts["errors"] += 1
+                continue
+            else:
+                sample = build_sample(samples[item.idx])
+                finished.append((item.content_hash, item.image_path, sample))
+                counts["processed"] += 1
+            record = build_record(item.idx, item.image_path, item.image_data, sample,
+                                  all_files[item.idx - 1])
+            for sink in sinks:
+                sink.write(record)
+            counts["written"] += 1
+        if manifest is not None and finished:
+            manifest.put_many(finished)
+        pending.clear()
         
-        print(f"✅ Đã tạo CSV với {len(results)} mẫu")
-        print(f"✅ File CSV: {output_csv}")
+        elapsed = time.perf_counter() - started_at
+        seen = counts["processed"] + counts["skipped"] + counts["errors"]
+        rate = counts["processed"] / elapsed if elapsed > 0 else 0.0
+        eta = (len(image_files) - seen) / rate if rate > 0 else 0.0
+        print(f"[{seen}/{len(image_files)}] {rate:.2f} ảnh/s, đã chạy {format_duration(elapsed)}, "
+              f"còn lại ~{format_duration(eta)} (bỏ qua: {counts['skipped']}, lỗi: {counts['errors']})")
+    
+    try:
+        for item in iter_prepared_images(indexed_files, dtype, workers, prefetch, done_hashes):
+            if item.error is not None:
+                print(f"    ❌ Lỗi đọc ảnh {os.path.basename(item.image_path)}: {item.error}")
+                counts["errors"] += 1
+            else:
+                if item.pixel_values is None:
+                    # Đã có kết quả trong manifest (cùng nội dung ảnh + version): không chạy model
+                    counts["skipped"] += 1
+                pending.append(item)
+                # Chạy khi đủ batch ảnh cần model (hoặc nhiều ảnh bỏ qua đang chờ ghi)
+                if (sum(p.pixel_values is not None for p in pending) >= batch_size
+                        or len(pending) >= prefetch):
+                    run_pending()
+        if pending:
+            run_pending()
+    finally:
+        if manifest is not None:
+            manifest.close()
+    
+    print(f"[*] Đã xử lý {counts['processed']} ảnh, bỏ qua {counts['skipped']} ảnh đã có kết quả, "
+          f"lỗi {counts['errors']} ảnh")
     
-    return results
+    return counts["written"]
+
+def load_model(model_path):
+    """Load tokenizer + model InternVL (GPU nếu có)."""
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_path, 
+        trust_remote_code=True,
+        local_files_only=True
+    )
+    
+    model = AutoModel.from_pretrained(
+        model_path,
+        torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
+        low_cpu_mem_usage=True,
+        trust_remote_code=True,
+        use_flash_attn=False,
+        local_files_only=True
+    ).eval()
+    
+    if torch.cuda.is_available():
+        model = model.cuda()
+    return model, tokenizer
+
+def merge_outputs(inputs, output, shard_size=1000):
+    """Gộp output của các shard (thư mục Parquet hoặc file CSV) thành 1 dataset, id đánh lại 1..N."""
+    parquet_inputs = [path for path in inputs if os.path.isdir(path)]
+    csv_inputs = [path for path in inputs if not os.path.isdir(path)]
+    missing = [path for path in csv_inputs if not os.path.isfile(path)]
+    if missing:
+        print(f"❌ Không tìm thấy: {', '.join(missing)}")
+        return 1
+    if parquet_inputs and csv_inputs:
+        print("❌ Không gộp lẫn thư mục Parquet và file CSV")
+        return 1
+    
+    output_base = output[:-len('.csv')] if output.endswith('.csv') else output
+    try:
+        if parquet_inputs:
+            if not PARQUET_AVAILABLE:
+                print("❌ Cần pyarrow để gộp Parquet: pip install pyarrow")
+                return 1
+            written = merge_parquet_datasets(parquet_inputs, output_base, shard_rows=max(1, shard_size))
+        else:
+            written = merge_csv_files(csv_inputs, f"{output_base}.csv")
+    except (ValueError, KeyError) as e:
+        print(f"❌ Lỗi gộp dataset: {e}")
+        return 1
+    
+    print(f"✅ Đã gộp {written} mẫu từ {len(inputs)} output vào {output_base if parquet_inputs else output_base + '.csv'}")
+    if parquet_inputs:
+        print(f"✅ Hugging Face Dataset (split train): datasets.load_dataset('{output_base}')")
+    return 0
 
 def main():
     import argparse
@@ -324,11 +379,37 @@ def main():
     parser.add_argument('dataset_path', nargs='?', help='Đường dẫn đến thư mục UnBoundingDATASET')
     parser.add_argument('--output', default='dataset', help='Tên file/directory output (mặc định: dataset)')
     parser.add_argument('--format', choices=['hf', 'csv', 'both'], default='hf', 
-                       help='Format output: hf (Hugging Face Dataset), csv, hoặc both (mặc định: hf)')
+                       help='Format output: hf (Hugging Face Dataset - shard Parquet), csv, hoặc both (mặc định: hf)')
+    parser.add_argument('--shard-size', type=int, default=1000,
+                        help='Số mẫu tối đa mỗi shard Parquet (mặc định: 1000)')
     parser.add_argument('--model_path', default='internvl_local', help='Đường dẫn đến model (mặc định: internvl_local)')
+    parser.add_argument('--batch-size', type=int, default=4, help='Số ảnh mỗi lượt batch_chat (mặc định: 4)')
+    parser.add_argument('--workers', type=int, default=4, help='Số thread đọc + tiền xử lý ảnh (mặc định: 4)')
+    parser.add_argument('--prefetch', type=int,
+                        help='Số ảnh tối đa đã tiền xử lý chờ model (mặc định: 2 x batch-size + workers)')
+    parser.add_argument('--profile', choices=list(GENERATION_PROFILES), default='accurate',
+                        help='Profile generation (mặc định: accurate, cấu hình gốc beam search 3)')
+    parser.add_argument('--manifest', help='File manifest SQLite lưu kết quả từng ảnh (mặc định: <output>.manifest.sqlite)')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='Xử lý lại tất cả ảnh, không dùng kết quả đã có trong manifest')
+    parser.add_argument('--stand-in', action='store_true',
+                        help='Dùng model thay thế nhỏ (stand_in_model.py) để kiểm thử pipeline, không cần checkpoint')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='Chia ảnh thành N phần theo hash đường dẫn để chạy song song nhiều process/máy (mặc định: 1)')
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='Phần do process này xử lý (0..N-1), output thêm hậu tố -shard-XXX-of-YYY')
+    parser.add_argument('--index-cache', help='File cache index ảnh (mặc định: <output>.index.json)')
+    parser.add_argument('--merge', nargs='+', metavar='INPUT',
+                        help='Gộp output các shard (thư mục Parquet hoặc file CSV) vào --output rồi thoát')
     
     args = parser.parse_args()
     
+    if args.merge:
+        return merge_outputs(args.merge, args.output, args.shard_size)
+    if args.num_shards < 1 or not 0 <= args.shard_index < args.num_shards:
+        print(f"❌ --shard-index phải trong khoảng 0..{args.num_shards - 1} (--num-shards >= 1)")
+        return 1
+    
     # Đường dẫn dataset
     if args.dataset_path:
         DATASET_PATH = args.dataset_path
@@ -362,31 +443,19 @@ def main():
     print(f"Format: {args.format}")
     print("="*60)
     
-    if args.format == 'hf' and not HF_DATASETS_AVAILABLE:
-        print("\n⚠️  Hugging Face datasets không có sẵn, sẽ xuất CSV thay thế")
+    if args.format in ('hf', 'both') and not PARQUET_AVAILABLE:
+        print("\n⚠️  pyarrow không có sẵn, sẽ xuất CSV thay thế")
         args.format = 'csv'
     
     # Load model
     print("\n[*] Đang load model...")
     try:
-        tokenizer = AutoTokenizer.from_pretrained(
-            MODEL_PATH, 
-            trust_remote_code=True,
-            local_files_only=True
-        )
-        
-        model = AutoModel.from_pretrained(
-            MODEL_PATH,
-            torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
-            low_cpu_mem_usage=True,
-            trust_remote_code=True,
-            use_flash_attn=False,
-            local_files_only=True
-        ).eval()
-        
-        if torch.cuda.is_available():
-            model = model.cuda()
-        
+        if args.stand_in:
+            from stand_in_model import load_stand_in_model
+            model, tokenizer = load_stand_in_model()
+            print("⚠️  Dùng model thay thế khởi tạo ngẫu nhiên (chỉ để kiểm thử pipeline)")
+        else:
+            model, tokenizer = load_model(MODEL_PATH)
         print("✅ Model đã load thành công")
     except Exception as e:
         print(f"❌ Lỗi load model: {e}")
@@ -394,17 +463,39 @@ def main():
         traceback.print_exc()
         return 1
     
+    output_base = args.output[:-len('.csv')] if args.output.endswith('.csv') else args.output
+    if args.num_shards > 1:
+        output_base = f"{output_base}-shard-{args.shard_index:03d}-of-{args.num_shards:03d}"
+    options = dict(batch_size=max(1, args.batch_size), workers=max(1, args.workers), prefetch=args.prefetch,
+                   profile=args.profile, manifest_path=args.manifest or f"{output_base}.manifest.sqlite",
+                   model_name='stand-in' if args.stand_in else model_identity(MODEL_PATH),
+                   resume=not args.no_resume, num_shards=args.num_shards, shard_index=args.shard_index,
+                   index_cache=args.index_cache or f"{output_base}.index.json")
+    
+    # Các sink cùng nhận kết quả của một lượt inference
+    sinks = []
+    if args.format in ('hf', 'both'):
+        sinks.append(ParquetShardSink(output_base, shard_rows=max(1, args.shard_size)))
+    if args.format in ('csv', 'both'):
+        sinks.append(CsvSink(f"{output_base}.csv"))
+    
     # Xử lý tất cả ảnh
-    if args.format == 'both':
-        # Tạo cả hai format - cần xử lý riêng để có cả PIL Image và đường dẫn
-        print("\n[*] Tạo cả Hugging Face Dataset và CSV...")
-        # Tạo HF Dataset trước
-        process_all_images(DATASET_PATH, model, tokenizer, args.output, 'hf')
-        # Sau đó tạo CSV từ cùng kết quả (cần load lại ảnh để lấy đường dẫn)
-        csv_output = args.output if args.output.endswith('.csv') else f"{args.output}.csv"
-        process_all_images(DATASET_PATH, model, tokenizer, csv_output, 'csv')
-    else:
-        process_all_images(DATASET_PATH, model, tokenizer, args.output, args.format)
+    try:
+        written = process_all_images(DATASET_PATH, model, tokenizer, sinks, **options)
+    finally:
+        outputs = [path for sink in sinks for path in sink.close()]
+    
+    if not written:
+        print("❌ Không có kết quả nào để lưu")
+        return 1
+    print(f"\n✅ Đã ghi {written} mẫu")
+    for path in outputs:
+        print(f"   {path}")
+    if args.num_shards > 1:
+        print(f"✅ Shard {args.shard_index}/{args.num_shards} xong, gộp khi đủ {args.num_shards} shard: "
+              f"python create_dataset.py --merge <output các shard> --output {args.output}")
+    elif args.format in ('hf', 'both'):
+        print(f"✅ Hugging Face Dataset (split train): datasets.load_dataset('{output_base}')")
     
     return 0
 
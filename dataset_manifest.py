@@ -0,0 +1,80 @@
+"""
+Manifest cho create_dataset.py: lưu kết quả từng ảnh ngay khi xử lý xong (SQLite)
+- Key: hash nội dung ảnh + version (model + câu hỏi + cấu hình generation)
+- Chạy lại chỉ xử lý ảnh mới/đã thay đổi hoặc khi đổi model/prompt, ảnh đã có kết quả được bỏ qua
+- Ghi theo từng batch (1 transaction) nên dừng giữa chừng chỉ mất batch đang chạy
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+def hash_file_content(image_data):
+    """Hash SHA-256 của bytes ảnh."""
+    return hashlib.sha256(image_data).hexdigest()
+
+def model_identity(model_path):
+    """Định danh model: tên thư mục + hash config.json (đổi checkpoint thì version đổi)."""
+    config_path = os.path.join(model_path, "config.json")
+    identity = os.path.basename(os.path.normpath(model_path))
+    try:
+        with open(config_path, "rb") as f:
+            identity += ":" + hashlib.sha256(f.read()).hexdigest()[:16]
+    except OSError:
+        pass
+    return identity
+
+def make_version(model_name, question, generation_config):
+    """Version kết quả: đổi model, câu hỏi hoặc cấu hình generation thì các ảnh được xử lý lại."""
+    hasher = hashlib.sha256()
+    hasher.update(model_name.encode("utf-8"))
+    hasher.update(b"\0")
+    hasher.update(question.encode("utf-8"))
+    hasher.update(b"\0")
+    hasher.update(json.dumps(generation_config, sort_keys=True, default=str).encode("utf-8"))
+    return hasher.hexdigest()[:16]
+
+class DatasetManifest:
+    """Kết quả trích xuất đã xử lý theo (content_hash, version), lưu trong SQLite."""
+
+    def __init__(self, db_path, version):
+        self.db_path = db_path
+        self.version = version
+        self._db = sqlite3.connect(db_path, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS samples ("
+            "content_hash TEXT NOT NULL, version TEXT NOT NULL, image_path TEXT NOT NULL, "
+            "record TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (content_hash, version))"
+        )
+        self._db.commit()
+
+    def done_hashes(self):
+        """Tập hash ảnh đã có kết quả ở version hiện tại."""
+        rows = self._db.execute("SELECT content_hash FROM samples WHERE version = ?", (self.version,))
+        return {row[0] for row in rows}
+
+    def get(self, content_hash):
+        """Record đã lưu (dict), None nếu chưa xử lý."""
+        row = self._db.execute("SELECT record FROM samples WHERE content_hash = ? AND version = ?",
+                               (content_hash, self.version)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put_many(self, items):
+        """Lưu [(content_hash, image_path, record), ...] trong 1 transaction."""
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO samples (content_hash, version, image_path, record, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(content_hash, self.version, image_path, json.dumps(record, ensure_ascii=False), now)
+                 for content_hash, image_path, record in items]
+            )
+
+    def count(self):
+        return self._db.execute("SELECT COUNT(*) FROM samples WHERE version = ?", (self.version,)).fetchone()[0]
+
+    def close(self):
+        self._db.close()
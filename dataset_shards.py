@@ -0,0 +1,149 @@
+"""
+Chia việc tạo dataset cho nhiều process/máy và gộp kết quả
+- Index file ảnh bằng os.scandir, cache theo mtime từng thư mục (chạy lại chỉ liệt kê thư mục đã thay đổi)
+- Gán ảnh vào shard theo hash đường dẫn tương đối (cùng kết quả trên mọi máy, không cần điều phối)
+- Gộp output của các shard (Parquet hoặc CSV) thành 1 dataset, id đánh lại theo thứ tự đường dẫn
+"""
+import os
+import csv
+import glob
+import json
+import heapq
+import hashlib
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp'}
+
+def _scan_directory(path):
+    """Liệt kê 1 thư mục: (file ảnh, thư mục con) theo tên."""
+    files, subdirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                files.append(entry.name)
+    return sorted(files), sorted(subdirs)
+
+def scan_image_files(root, cache_path=None):
+    """Đường dẫn tương đối (phân cách '/') của tất cả ảnh trong root, đã sắp xếp.
+
+    cache_path: file JSON lưu nội dung từng thư mục kèm mtime; thư mục có mtime không đổi
+    (không thêm/xóa/đổi tên file) được lấy từ cache thay vì liệt kê lại.
+    """
+    cached = {}
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get("root") == os.path.abspath(root):
+                cached = index.get("directories", {})
+        except (OSError, ValueError):
+            cached = {}
+
+    directories = {}
+    relative_paths = []
+    stack = [""]
+    while stack:
+        relative_dir = stack.pop()
+        path = os.path.join(root, relative_dir) if relative_dir else root
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        entry = cached.get(relative_dir)
+        if entry is None or entry["mtime_ns"] != mtime_ns:
+            files, subdirs = _scan_directory(path)
+            entry = {"mtime_ns": mtime_ns, "files": files, "subdirs": subdirs}
+        directories[relative_dir] = entry
+        prefix = f"{relative_dir}/" if relative_dir else ""
+        relative_paths.extend(prefix + name for name in entry["files"])
+        stack.extend(prefix + name for name in entry["subdirs"])
+
+    if cache_path:
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"root": os.path.abspath(root), "directories": directories}, f)
+        os.replace(tmp_path, cache_path)
+    return sorted(relative_paths)
+
+def shard_of(relative_path, num_shards):
+    """Shard của ảnh theo hash đường dẫn tương đối."""
+    digest = hashlib.sha1(relative_path.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+def select_shard(relative_paths, num_shards, shard_index):
+    """Các ảnh thuộc shard shard_index (giữ thứ tự)."""
+    if num_shards <= 1:
+        return list(relative_paths)
+    return [path for path in relative_paths if shard_of(path, num_shards) == shard_index]
+
+def _iter_parquet_rows(dataset_dir, batch_size=64):
+    """Đọc lần lượt các mẫu trong data/*.parquet của một output (theo thứ tự shard)."""
+    import pyarrow.parquet as pq
+
+    for path in sorted(glob.glob(os.path.join(dataset_dir, "data", "*.parquet"))):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield from batch.to_pylist()
+
+def _iter_csv_rows(csv_path):
+    with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+        yield from csv.DictReader(f)
+
+def _merge_sorted(streams, key):
+    """Gộp các stream đã sắp xếp theo key, bỏ mẫu trùng key (giữ mẫu đầu tiên)."""
+    def checked(stream, source):
+        previous = None
+        for row in stream:
+            current = key(row)
+            if previous is not None and current < previous:
+                raise ValueError(f"{source} không sắp xếp theo đường dẫn ảnh (không phải output của create_dataset.py?)")
+            previous = current
+            yield row
+
+    last = None
+    for row in heapq.merge(*(checked(stream, source) for source, stream in streams), key=key):
+        if key(row) == last:
+            continue
+        last = key(row)
+        yield row
+
+def merge_parquet_datasets(inputs, output_dir, shard_rows=1000):
+    """Gộp các output Parquet (thư mục) thành output_dir, id = 1..N theo đường dẫn ảnh. Trả về số mẫu."""
+    from dataset_writer import ParquetShardSink
+
+    sink = ParquetShardSink(output_dir, shard_rows=shard_rows)
+    count = 0
+    try:
+        rows = _merge_sorted([(path, _iter_parquet_rows(path)) for path in inputs],
+                             key=lambda row: row["image"]["path"])
+        for count, row in enumerate(rows, start=1):
+            sink.write({
+                "id": count,
+                "image_bytes": row["image"]["bytes"],
+                "image_name": row["image"]["path"],
+                "description": row["description"],
+                "extractions": row["extractions"],
+                "conversations": row["conversations"]
+            })
+    finally:
+        sink.close()
+    return count
+
+def _csv_image_name(row):
+    """Key gộp của 1 dòng CSV: đường dẫn tương đối (cột image_name), không phụ thuộc thư mục gốc dataset trên từng
+    máy. CSV cũ chưa có cột này thì dùng cột image."""
+    return row.get("image_name") or row["image"]
+
+def merge_csv_files(inputs, output_csv):
+    """Gộp các file CSV thành output_csv, id = 1..N theo đường dẫn tương đối của ảnh (như Parquet). Trả về số mẫu."""
+    from dataset_writer import CsvSink
+
+    sink = CsvSink(output_csv)
+    count = 0
+    try:
+        rows = _merge_sorted([(path, _iter_csv_rows(path)) for path in inputs], key=_csv_image_name)
+        for count, row in enumerate(rows, start=1):
+            sink.write(dict(row, id=count, image_path=row["image"], image_name=_csv_image_name(row)))
+    finally:
+        sink.close()
+    return count
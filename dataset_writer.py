@@ -0,0 +1,139 @@
+"""
+Ghi dataset dạng stream cho create_dataset.py (bộ nhớ không tăng theo số ảnh)
+- ParquetShardSink: shard Parquet kích thước cố định theo layout Hugging Face (data/train-xxxxx-of-yyyyy.parquet),
+  ảnh lưu nguyên bytes gốc (không encode lại), đọc bằng datasets.load_dataset(output)
+- CsvSink: ghi từng dòng CSV ngay khi có kết quả
+Nhiều sink cùng nhận kết quả của một lượt inference
+"""
+import os
+import csv
+import glob
+import json
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+CSV_FIELDS = ['id', 'image', 'image_name', 'description', 'extractions', 'conversations']
+
+# Features Hugging Face lưu trong metadata Parquet để load_dataset đọc cột image thành PIL Image
+HF_FEATURES = {
+    "id": {"dtype": "int64", "_type": "Value"},
+    "image": {"_type": "Image"},
+    "description": {"dtype": "string", "_type": "Value"},
+    "extractions": {"dtype": "string", "_type": "Value"},
+    "conversations": {"dtype": "string", "_type": "Value"}
+}
+
+def parquet_schema():
+    """Schema Parquet của dataset (cột image theo định dạng Image của Hugging Face: bytes + path)."""
+    return pa.schema([
+        ("id", pa.int64()),
+        ("image", pa.struct([("bytes", pa.binary()), ("path", pa.string())])),
+        ("description", pa.string()),
+        ("extractions", pa.string()),
+        ("conversations", pa.string())
+    ], metadata={"huggingface": json.dumps({"info": {"features": HF_FEATURES}})})
+
+class CsvSink:
+    """Ghi mẫu vào CSV ngay khi có kết quả (cột image là đường dẫn ảnh, image_name là đường dẫn tương đối trong
+    thư mục dataset như image.path của Parquet: giống nhau trên mọi máy, dùng làm key khi gộp shard)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, fieldnames=CSV_FIELDS)
+        self._writer.writeheader()
+        self.rows = 0
+
+    def write(self, record):
+        self._writer.writerow({
+            'id': record['id'],
+            'image': record['image_path'],
+            'image_name': record.get('image_name') or os.path.basename(record['image_path']),
+            'description': record['description'],
+            'extractions': record['extractions'],
+            'conversations': record['conversations']
+        })
+        self.rows += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        return [self.path]
+
+class ParquetShardSink:
+    """Ghi mẫu vào các shard Parquet tối đa shard_rows dòng, mỗi row group tối đa row_group_rows dòng.
+
+    image.path là record['image_name'] (đường dẫn tương đối trong thư mục dataset, dùng làm key khi gộp shard),
+    mặc định là tên file.
+
+    Chỉ giữ trong bộ nhớ 1 row group chưa ghi; shard cũ của split trong output_dir (kể cả file .tmp của lần chạy
+    bị dừng) bị xóa khi bắt đầu.
+    """
+
+    def __init__(self, output_dir, split='train', shard_rows=1000, row_group_rows=64):
+        if not PARQUET_AVAILABLE:
+            raise RuntimeError("Cần pyarrow để ghi Parquet: pip install pyarrow")
+        self.data_dir = os.path.join(output_dir, 'data')
+        self.split = split
+        self.shard_rows = shard_rows
+        self.row_group_rows = row_group_rows
+        self.schema = parquet_schema()
+        os.makedirs(self.data_dir, exist_ok=True)
+        # Gồm cả shard .tmp còn sót lại khi lần chạy trước bị dừng giữa chừng
+        for pattern in (f"{split}-*.parquet", f"{split}-*.parquet.tmp"):
+            for old_shard in glob.glob(os.path.join(self.data_dir, pattern)):
+                os.remove(old_shard)
+        self._buffer = []
+        self._writer = None
+        self._shard_written = 0
+        self.shards = []
+        self.rows = 0
+
+    def write(self, record):
+        self._buffer.append({
+            'id': record['id'],
+            'image': {'bytes': record['image_bytes'],
+                      'path': record.get('image_name') or os.path.basename(record['image_path'])},
+            'description': record['description'],
+            'extractions': record['extractions'],
+            'conversations': record['conversations']
+        })
+        self.rows += 1
+        if len(self._buffer) >= min(self.row_group_rows, self.shard_rows - self._shard_written):
+            self.flush()
+
+    def flush(self):
+        """Ghi row group đang chờ vào shard hiện tại (mở shard mới nếu cần)."""
+        if not self._buffer:
+            return
+        if self._writer is None:
+            path = os.path.join(self.data_dir, f"{self.split}-{len(self.shards):05d}.parquet.tmp")
+            self._writer = pq.ParquetWriter(path, self.schema)
+            self.shards.append(path)
+        self._writer.write_table(pa.Table.from_pylist(self._buffer, schema=self.schema))
+        self._shard_written += len(self._buffer)
+        self._buffer = []
+        if self._shard_written >= self.shard_rows:
+            self._writer.close()
+            self._writer = None
+            self._shard_written = 0
+
+    def close(self):
+        """Ghi phần còn lại, đặt tên shard theo chuẩn split-xxxxx-of-yyyyy.parquet."""
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        final_paths = []
+        for index, path in enumerate(self.shards):
+            final_path = os.path.join(self.data_dir, f"{self.split}-{index:05d}-of-{len(self.shards):05d}.parquet")
+            os.replace(path, final_path)
+            final_paths.append(final_path)
+        return final_paths
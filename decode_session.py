@@ -0,0 +1,67 @@
+"""
+Session decode 1 ảnh (batch 1) cho các cách decode tự viết vòng lặp (schema_decoding.py, speculative.py)
+- Prefill prompt 1 lần (bắt đầu được từ KV cache của prefix prompt), sau đó đưa thêm token với KV cache
+- feed: nhiều token trong 1 lượt forward, chỉ cần logits vị trí cuối
+- verify: nhiều token trong 1 lượt forward, trả logits của từng vị trí (kiểm tra draft)
+- crop: bỏ các token cuối khỏi KV cache (draft bị từ chối)
+- Model có decode_session (stand_in_model.py) tự tạo session; InternVL chạy language model của transformers
+"""
+import torch
+
+from prefix_cache import IMG_CONTEXT_TOKEN, internvl_query
+
+def internvl_inputs_embeds(model, tokenizer, pixel_values, question, visual_features=None):
+    """inputs_embeds của prompt như InternVL.generate: token <IMG_CONTEXT> được thay bằng đặc trưng ảnh."""
+    embed_tokens = model.language_model.get_input_embeddings()
+    query = internvl_query(model, question, num_patches=pixel_values.size(0))
+    input_ids = tokenizer(query, return_tensors='pt').input_ids.to(embed_tokens.weight.device)
+    if visual_features is None:
+        visual_features = model.extract_feature(pixel_values)
+    inputs_embeds = embed_tokens(input_ids)
+    selected = input_ids == tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
+    inputs_embeds[selected] = visual_features.reshape(-1, inputs_embeds.size(-1)).to(inputs_embeds.dtype)
+    return inputs_embeds
+
+class TransformersSession:
+    """Decode 1 chuỗi trên language model của transformers: giữ KV cache và logits của vị trí cuối.
+
+    Prefill/feed chỉ tính lm_head cho vị trí cuối (logits cả prompt với vocab ~150k token tốn hàng GB).
+    """
+
+    def __init__(self, language_model, inputs_embeds, past_key_values=None):
+        self.language_model = language_model
+        self.device = inputs_embeds.device
+        self.past_key_values = past_key_values
+        cached = past_key_values.get_seq_length() if past_key_values is not None else 0
+        self.logits = self._forward(inputs_embeds=inputs_embeds[:, cached:])[-1]
+
+    def _forward(self, all_positions=False, **inputs):
+        output = self.language_model.get_decoder()(past_key_values=self.past_key_values, use_cache=True, **inputs)
+        self.past_key_values = output.past_key_values
+        hidden = output.last_hidden_state[0] if all_positions else output.last_hidden_state[0, -1:]
+        return self.language_model.get_output_embeddings()(hidden)
+
+    def _input_ids(self, token_ids):
+        return torch.tensor([token_ids], dtype=torch.long, device=self.device)
+
+    def feed(self, token_ids):
+        """Thêm các token vào chuỗi trong 1 lượt forward, cập nhật logits."""
+        self.logits = self._forward(input_ids=self._input_ids(token_ids))[-1]
+
+    def verify(self, token_ids):
+        """Như feed nhưng trả về logits của từng vị trí (len(token_ids), vocab)."""
+        logits = self._forward(all_positions=True, input_ids=self._input_ids(token_ids))
+        self.logits = logits[-1]
+        return logits
+
+    def crop(self, num_tokens):
+        """Bỏ num_tokens token cuối khỏi KV cache. logits không còn đúng cho tới lần feed/verify tiếp theo."""
+        self.past_key_values.crop(-num_tokens)
+        self.logits = None
+
+def open_session(model, tokenizer, pixel_values, question, past_key_values=None):
+    """Prefill prompt (ảnh + question) cho 1 ảnh, trả về session để decode tiếp."""
+    if hasattr(model, "decode_session"):
+        return model.decode_session(tokenizer, pixel_values, question, past_key_values)
+    inputs_embeds = internvl_inputs_embeds(model, tokenizer, pixel_values, question)
+    return TransformersSession(model.language_model, inputs_embeds, past_key_values)
@@ -0,0 +1,70 @@
+"""
+Cache đặc trưng ảnh (đầu ra vision encoder + projector) theo hash nội dung ảnh
+- Hỏi nhiều câu trên cùng một hóa đơn chỉ chạy vision encoder 1 lần
+- Câu hỏi tiếp theo (gửi lại ảnh hoặc image_id) trong thời gian mục còn trong cache bỏ qua hẳn vision encoder
+- LRU trong bộ nhớ, giới hạn số mục và dung lượng tensor; tensor giữ trên CPU
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+def hash_image(image_data):
+    """image_id của ảnh: SHA-256 của bytes ảnh."""
+    return hashlib.sha256(image_data).hexdigest()
+
+class FeatureCache:
+    """LRU các tensor đặc trưng ảnh (số tile, số token ảnh, hidden) theo key."""
+
+    def __init__(self, max_entries=64, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (tensor, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def get(self, key):
+        """Tensor đặc trưng theo key, None nếu không có."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, features):
+        """Lưu tensor đặc trưng (chuyển về CPU). Tensor lớn hơn max_bytes không được lưu."""
+        features = features.detach().cpu()
+        size = features.numel() * features.element_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self.stores += 1
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (features, size)
+            self._bytes += size
+            # Loại bỏ mục ít dùng nhất khi vượt giới hạn
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._bytes -= old_size
+
+    def stats(self):
+        """Thống kê hit/miss cho /health."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,155 @@
+"""
+Cấu hình generation cho model InternVL
+- GENERATION_PROFILES: các profile đặt tên (fast / balanced / accurate) chọn theo request
+- INVOICE_SCHEMA: cấu trúc JSON cố định của kết quả trích xuất (decoding="schema", schema_decoding.py)
+- find_json_object_end / parse_json_response / parse_partial_fields: đọc JSON (hoàn chỉnh hoặc đang sinh dở)
+Không phụ thuộc torch/transformers để server import nhanh; phần chạy cùng model ở generation_runtime.py
+"""
+import json
+
+# json_early_stop không phải tham số của generate: được thay bằng stopping_criteria lúc chạy
+GENERATION_PROFILES = {
+    # Greedy, phạt lặp nhẹ: nhanh nhất trên CPU
+    "fast": dict(
+        max_new_tokens=768,
+        do_sample=False,
+        num_beams=1,
+        repetition_penalty=1.1,
+        json_early_stop=True
+    ),
+    # 2 beam, phạt lặp vừa phải
+    "balanced": dict(
+        max_new_tokens=1024,
+        do_sample=False,
+        num_beams=2,
+        repetition_penalty=2.0,
+        json_early_stop=True
+    ),
+    # Cấu hình gốc của server (beam search 3)
+    "accurate": dict(
+        max_new_tokens=1024,
+        do_sample=False,
+        temperature=0.0,
+        num_beams=3,
+        repetition_penalty=3.5,
+        json_early_stop=True
+    )
+}
+
+DEFAULT_PROFILE = "accurate"
+
+# Cấu trúc output của DEFAULT_QUESTION: key -> "string" (giá trị chuỗi) hoặc [schema phần tử] (mảng object)
+INVOICE_SCHEMA = {
+    "Tên người bán": "string",
+    "Địa chỉ": "string",
+    "Ngày giao dịch": "string",
+    "Tổng tiền thanh toán": "string",
+    "Danh sách món": [{"Tên món": "string", "Đơn giá": "string", "Số lượng": "string"}]
+}
+
+def get_profile_config(profile):
+    """Bản sao cấu hình của profile (dict thuần, dùng được làm cache key). Raise ValueError nếu không có."""
+    if profile not in GENERATION_PROFILES:
+        raise ValueError(f"Profile không hợp lệ: '{profile}'. Chọn một trong: {', '.join(GENERATION_PROFILES)}")
+    return dict(GENERATION_PROFILES[profile])
+
+def find_json_object_end(text, start=0):
+    """Vị trí ngay sau dấu '}' đóng object JSON đầu tiên (bỏ qua ngoặc trong chuỗi), -1 nếu chưa đóng."""
+    first = text.find('{', start)
+    if first < 0:
+        return -1
+    depth = 0
+    in_string = False
+    escaped = False
+    for index in range(first, len(text)):
+        char = text[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                return index + 1
+    return -1
+
+def parse_json_response(text):
+    """Tách và parse object JSON đầu tiên trong output của model, None nếu không parse được."""
+    if isinstance(text, dict):
+        return text
+    start = text.find('{')
+    if start < 0:
+        return None
+    end = find_json_object_end(text, start)
+    try:
+        return json.loads(text[start:end] if end > 0 else text[start:])
+    except ValueError:
+        return None
+
+def parse_partial_fields(text):
+    """Các trường cấp ngoài cùng đã sinh xong (giá trị chuỗi/số hoàn chỉnh) trong JSON đang sinh dở."""
+    fields = {}
+    start = text.find('{')
+    if start < 0:
+        return fields
+    depth = 0
+    index = start
+    key = None
+    expecting_value = False
+    while index < len(text):
+        char = text[index]
+        if char == '"':
+            # Đọc trọn một chuỗi JSON, dừng nếu chuỗi chưa đóng
+            end = index + 1
+            while end < len(text) and text[end] != '"':
+                end += 2 if text[end] == '\\' else 1
+            if end >= len(text):
+                break
+            try:
+                value = json.loads(text[index:end + 1])
+            except ValueError:
+                value = text[index + 1:end]
+            if depth == 1:
+                if expecting_value and key is not None:
+                    fields[key] = value
+                    key, expecting_value = None, False
+                else:
+                    key = value
+            index = end + 1
+            continue
+        if char in '{[':
+            depth += 1
+            if depth == 2:
+                key, expecting_value = None, False
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                break
+        elif depth == 1:
+            if char == ':':
+                expecting_value = key is not None
+            elif char == ',':
+                key, expecting_value = None, False
+            elif expecting_value and (char.isdigit() or char == '-'):
+                # Số chỉ được coi là hoàn chỉnh khi đã gặp ký tự kết thúc phía sau
+                end = index
+                while end < len(text) and (text[end].isdigit() or text[end] in '-+.eE'):
+                    end += 1
+                if end >= len(text):
+                    break
+                try:
+                    fields[key] = json.loads(text[index:end])
+                except ValueError:
+                    fields[key] = text[index:end]
+                key, expecting_value = None, False
+                index = end
+                continue
+        index += 1
+    return fields
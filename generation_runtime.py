@@ -0,0 +1,56 @@
+"""
+Phần generation chạy cùng model (cần torch/transformers, import lúc load model)
+- to_generate_kwargs: chuyển profile thành generation_config cho model.chat/batch_chat
+- JsonObjectStoppingCriteria: dừng generate ngay khi object JSON cấp ngoài cùng đã đóng
+- QueueTextStreamer: stream text đã decode vào queue (endpoint SSE)
+"""
+import time
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, TextStreamer
+
+from generation import find_json_object_end
+
+def to_generate_kwargs(profile_config, tokenizer):
+    """Chuyển cấu hình profile thành generation_config truyền cho model.chat/batch_chat."""
+    generation_config = dict(profile_config)
+    if generation_config.pop("json_early_stop", False):
+        generation_config["stopping_criteria"] = StoppingCriteriaList([JsonObjectStoppingCriteria(tokenizer)])
+    return generation_config
+
+class JsonObjectStoppingCriteria(StoppingCriteria):
+    """Dừng từng sequence khi object JSON cấp ngoài cùng đã cân bằng và đóng.
+
+    Chỉ decode lại cả sequence khi token vừa sinh có chứa '}', nên chi phí mỗi bước rất nhỏ.
+    InternVL generate bằng inputs_embeds nên input_ids ở đây chỉ gồm các token đã sinh.
+    """
+
+    def __init__(self, tokenizer, prompt_length=0):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if input_ids.shape[1] <= self.prompt_length:
+            return done
+        last_tokens = input_ids[:, -1].tolist()
+        for row, token_id in enumerate(last_tokens):
+            if '}' not in self.tokenizer.decode([token_id], skip_special_tokens=True):
+                continue
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+            done[row] = find_json_object_end(text) > 0
+        return done
+
+class QueueTextStreamer(TextStreamer):
+    """Streamer đẩy từng đoạn text đã decode vào queue (dùng cho endpoint SSE).
+
+    Mỗi phần tử là ("token", text, thời điểm monotonic).
+    """
+
+    def __init__(self, tokenizer, channel, **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True, **decode_kwargs)
+        self.channel = channel
+
+    def on_finalized_text(self, text, stream_end=False):
+        if text:
+            self.channel.put(("token", text, time.monotonic()))
@@ -0,0 +1,226 @@
+"""
+Tải ảnh từ image_url
+- Dùng chung connection pool (requests.Session) giữa các request
+- Giới hạn dung lượng khi đang stream (không buffer toàn bộ response trước khi kiểm tra)
+- Giới hạn số lượt tải đồng thời, các request cùng URL đang tải dùng chung một lượt tải
+- Cache trên đĩa theo URL, revalidate bằng ETag/Last-Modified (304 thì dùng lại bytes đã lưu)
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+class ImageTooLarge(Exception):
+    """Ảnh vượt dung lượng tối đa cho phép."""
+
+class ImageFetcher:
+    """Tải ảnh qua HTTP với connection pool, giới hạn dung lượng và cache trên đĩa (nếu có cache_dir)."""
+
+    def __init__(self, max_bytes=20 * 1024 * 1024, timeout=10.0, pool_size=16, max_concurrent=8,
+                 cache_dir=None, cache_max_bytes=512 * 1024 * 1024, chunk_size=64 * 1024):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.max_concurrent = max_concurrent
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._inflight = {}  # url -> (Event, [bytes hoặc exception])
+        self.downloads = 0
+        self.downloaded_bytes = 0
+        self.cache_hits = 0
+        self.shared = 0
+        self.rejected_too_large = 0
+        self.slot_timeouts = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._cache_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir)
+                                    if entry.name.endswith(".body"))
+        else:
+            self._cache_bytes = 0
+
+    def fetch(self, url):
+        """Trả về bytes ảnh. Raise ImageTooLarge hoặc requests.exceptions.RequestException."""
+        with self._lock:
+            inflight = self._inflight.get(url)
+            owner = inflight is None
+            if owner:
+                inflight = self._inflight[url] = (threading.Event(), [])
+            else:
+                self.shared += 1
+        event, outcome = inflight
+        if not owner:
+            # Cùng URL đang được tải bởi request khác: chờ kết quả thay vì tải lại
+            event.wait()
+            if isinstance(outcome[0], Exception):
+                raise outcome[0]
+            return outcome[0]
+
+        try:
+            # Chờ lượt tải tối đa timeout: host chậm không làm request xếp hàng chờ mãi
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.slot_timeouts += 1
+                raise requests.exceptions.Timeout(
+                    f"Chờ lượt tải ảnh quá {self.timeout:.0f}s (đang tải tối đa {self.max_concurrent} ảnh)")
+            try:
+                outcome.append(self._fetch(url))
+            finally:
+                self._slots.release()
+            return outcome[0]
+        except Exception as e:
+            outcome.append(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(url, None)
+            event.set()
+
+    def _fetch(self, url, revalidate=True):
+        """revalidate=False: tải lại không kèm If-None-Match/If-Modified-Since (bỏ qua metadata đã cache)."""
+        headers = {}
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        meta = self._read_meta(key) if revalidate else None
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        deadline = time.monotonic() + self.timeout
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 304:
+                body = self._read_body(key) if meta is not None else None
+                if body is not None:
+                    with self._lock:
+                        self.cache_hits += 1
+                    return body
+                if meta is None:
+                    # 304 cho request không kèm điều kiện: response không có bytes ảnh
+                    raise requests.exceptions.HTTPError(f"304 Not Modified không mong đợi: {url}", response=response)
+                # Metadata còn nhưng body đã bị xóa khỏi cache: bỏ metadata, tải lại đầy đủ
+                response.close()
+                self._remove(key)
+                return self._fetch(url, revalidate=False)
+            response.raise_for_status()
+
+            # Từ chối sớm khi server báo trước dung lượng
+            length = response.headers.get("Content-Length")
+            if length is not None and length.isdigit() and int(length) > self.max_bytes:
+                self._reject_too_large()
+            chunks = []
+            received = 0
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                received += len(chunk)
+                if received > self.max_bytes:
+                    self._reject_too_large()
+                if time.monotonic() > deadline:
+                    # timeout của requests chỉ áp dụng cho từng lần đọc, giới hạn thêm tổng thời gian tải
+                    raise requests.exceptions.Timeout(f"Tải ảnh quá {self.timeout:.0f}s")
+                chunks.append(chunk)
+            body = b"".join(chunks)
+
+            with self._lock:
+                self.downloads += 1
+                self.downloaded_bytes += len(body)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if self.cache_dir and (etag or last_modified):
+                self._store(key, body, {"url": url, "etag": etag, "last_modified": last_modified})
+            return body
+
+    def _reject_too_large(self):
+        with self._lock:
+            self.rejected_too_large += 1
+        raise ImageTooLarge(f"Ảnh vượt quá dung lượng tối đa {self.max_bytes} bytes")
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def _read_meta(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key, ".json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _read_body(self, key):
+        path = self._path(key, ".body")
+        try:
+            with open(path, "rb") as f:
+                body = f.read()
+            # Cập nhật mtime để dọn cache theo thứ tự ít dùng nhất
+            os.utime(path)
+            return body
+        except OSError:
+            return None
+
+    def _store(self, key, body, meta):
+        """Ghi body + metadata (ghi file tạm rồi rename để không đọc phải file ghi dở)."""
+        if len(body) > self.cache_max_bytes:
+            return
+        try:
+            body_path = self._path(key, ".body")
+            old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+            for suffix, data in ((".body", body), (".json", json.dumps(meta).encode("utf-8"))):
+                tmp_path = self._path(key, f"{suffix}.{threading.get_ident()}.tmp")
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, self._path(key, suffix))
+            with self._lock:
+                self._cache_bytes += len(body) - old_size
+                over_limit = self._cache_bytes > self.cache_max_bytes
+            if over_limit:
+                self._trim()
+        except OSError as e:
+            print(f"⚠️  Lỗi ghi cache ảnh xuống đĩa: {e}")
+
+    def _remove(self, key):
+        """Xóa metadata + body của 1 URL khỏi cache (metadata trước để không revalidate với body đã mất)."""
+        for suffix in (".json", ".body"):
+            try:
+                os.remove(self._path(key, suffix))
+            except OSError:
+                pass
+
+    def _trim(self):
+        """Xóa ảnh ít dùng nhất (mtime cũ nhất) đến khi cache dưới cache_max_bytes."""
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.name[:-len(".body")])
+                         for entry in os.scandir(self.cache_dir) if entry.name.endswith(".body"))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.cache_max_bytes:
+                break
+            self._remove(key)
+            total -= size
+        with self._lock:
+            self._cache_bytes = total
+
+    def stats(self):
+        """Thống kê cho /health."""
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "timeout_s": self.timeout,
+                "cache_enabled": bool(self.cache_dir),
+                "cache_bytes": self._cache_bytes,
+                "cache_max_bytes": self.cache_max_bytes,
+                "downloads": self.downloads,
+                "downloaded_bytes": self.downloaded_bytes,
+                "cache_hits": self.cache_hits,
+                "shared_inflight": self.shared,
+                "rejected_too_large": self.rejected_too_large,
+                "slot_timeouts": self.slot_timeouts,
+                "in_flight": len(self._inflight)
+            }
@@ -0,0 +1,234 @@
+"""
+Tiền xử lý ảnh cho InternVL (dùng chung cho app.py và create_dataset.py)
+- load_image: engine vector hóa - decode 1 lần, resize 1 lần, cắt tile bằng reshape tensor,
+  normalize cả stack trong 1 phép tính
+- load_image_reference: cách làm cũ (PIL crop + torchvision transform từng tile), giữ lại để
+  so sánh độ chính xác và benchmark
+- tile_image_adaptive: cắt bỏ nền quanh hóa đơn (find_content_box trên ảnh thu nhỏ) rồi chọn số tile
+  theo độ phân giải vùng cắt và mật độ chữ, ít tile hơn = ít token ảnh hơn = prefill ngắn hơn
+"""
+import math
+import io
+from functools import lru_cache
+
+import numpy as np
+import torch
+from PIL import Image
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# (x / 255 - mean) / std == x * scale + bias, tính sẵn cho từng kênh màu
+_NORM_SCALE = tuple(1.0 / (255.0 * s) for s in IMAGENET_STD)
+_NORM_BIAS = tuple(-m / s for m, s in zip(IMAGENET_MEAN, IMAGENET_STD))
+
+def build_transform(input_size):
+    """Xây dựng pipeline chuyển đổi ảnh (chỉ dùng cho load_image_reference, import torchvision lúc cần)."""
+    import torchvision.transforms as T
+    from torchvision.transforms.functional import InterpolationMode
+
+    transform = T.Compose([
+        T.Lambda(lambda img: img.convert('RGB') if img.mode != 'RGB' else img),
+        T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
+        T.ToTensor(),
+        T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)
+    ])
+    return transform
+
+def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
+    """Tìm tỷ lệ khung hình gần nhất với ảnh gốc."""
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    area = width * height
+    for ratio in target_ratios:
+        target_aspect_ratio = ratio[0] / ratio[1]
+        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+    return best_ratio
+
+@lru_cache(maxsize=64)
+def get_target_ratios(min_num, max_num):
+    """Bảng các tỷ lệ (cột, hàng) hợp lệ, sắp theo số tile. Cache theo (min_num, max_num)."""
+    target_ratios = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= max_num and i * j >= min_num)
+    return tuple(sorted(target_ratios, key=lambda x: x[0] * x[1]))
+
+def get_tile_grid(width, height, min_num=1, max_num=12, image_size=448):
+    """Chọn lưới tile (cột, hàng) cho ảnh kích thước width x height."""
+    return find_closest_aspect_ratio(
+        width / height, get_target_ratios(min_num, max_num), width, height, image_size)
+
+def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=False):
+    """Tiền xử lý ảnh động, chia ảnh thành các patches."""
+    orig_width, orig_height = image.size
+
+    # Tìm tỷ lệ khung hình gần nhất
+    target_aspect_ratio = get_tile_grid(orig_width, orig_height, min_num, max_num, image_size)
+
+    # Tính toán kích thước mục tiêu
+    target_width = image_size * target_aspect_ratio[0]
+    target_height = image_size * target_aspect_ratio[1]
+    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
+
+    # Resize ảnh
+    resized_img = image.resize((target_width, target_height))
+    processed_images = []
+    for i in range(blocks):
+        box = (
+            (i % (target_width // image_size)) * image_size,
+            (i // (target_width // image_size)) * image_size,
+            ((i % (target_width // image_size)) + 1) * image_size,
+            ((i // (target_width // image_size)) + 1) * image_size
+        )
+        # Chia ảnh thành các phần
+        split_img = resized_img.crop(box)
+        processed_images.append(split_img)
+    assert len(processed_images) == blocks
+    if use_thumbnail and len(processed_images) != 1:
+        thumbnail_img = image.resize((image_size, image_size))
+        processed_images.append(thumbnail_img)
+    return processed_images
+
+def open_image(image_data):
+    """Decode ảnh từ bytes, đường dẫn hoặc file object sang PIL Image RGB."""
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(image_data))
+    elif isinstance(image_data, Image.Image):
+        image = image_data
+    else:
+        image = Image.open(image_data)
+    return image.convert('RGB') if image.mode != 'RGB' else image
+
+def normalize_tiles(tiles):
+    """Normalize stack tile uint8 (N, 3, H, W) sang float32 theo ImageNet.
+
+    Nhân-cộng in-place với hằng số của từng kênh trên cả stack; broadcast tensor (1, 3, 1, 1)
+    chậm hơn nhiều lần trên CPU nên không dùng.
+    """
+    pixel_values = tiles.to(torch.float32)
+    for channel in range(3):
+        pixel_values[:, channel].mul_(_NORM_SCALE[channel]).add_(_NORM_BIAS[channel])
+    return pixel_values
+
+def tile_image(image, input_size=448, min_num=1, max_num=6, use_thumbnail=True):
+    """Resize 1 lần rồi cắt tile bằng reshape, trả về tensor uint8 (N, 3, input_size, input_size)."""
+    width, height = image.size
+    cols, rows = get_tile_grid(width, height, min_num, max_num, input_size)
+    blocks = cols * rows
+    with_thumbnail = use_thumbnail and blocks != 1
+
+    tiles = np.empty((blocks + int(with_thumbnail), 3, input_size, input_size), dtype=np.uint8)
+    resized = np.asarray(image.resize((input_size * cols, input_size * rows)))
+    # (rows*S, cols*S, 3) -> (rows, S, cols, S, 3) -> (rows, cols, 3, S, S): thứ tự tile theo hàng
+    tiles[:blocks] = resized.reshape(rows, input_size, cols, input_size, 3).transpose(0, 2, 4, 1, 3).reshape(
+        blocks, 3, input_size, input_size)
+
+    if with_thumbnail:
+        tiles[blocks] = np.asarray(image.resize((input_size, input_size))).transpose(2, 0, 1)
+    return torch.from_numpy(tiles)
+
+# Ảnh thu nhỏ dùng để tìm vùng hóa đơn (cạnh dài, pixel)
+CONTENT_SCAN_SIZE = 256
+# Pixel có gradient độ sáng lớn hơn ngưỡng này (0-255) được tính là cạnh (nét chữ, viền)
+EDGE_THRESHOLD = 24
+# Bỏ phần nền chứa ít hơn tỷ lệ này của tổng cạnh ở mỗi phía
+EDGE_TRIM_FRACTION = 0.01
+# Lề thêm quanh vùng cắt (tỷ lệ kích thước vùng cắt)
+CROP_MARGIN = 0.04
+# Chỉ cắt khi bỏ được ít nhất tỷ lệ diện tích này (cắt ít hơn không giảm được tile)
+MIN_CROP_SAVING = 0.1
+# Mật độ cạnh dưới mức này là chữ thưa/to: dùng một nửa số tile
+SPARSE_TEXT_DENSITY = 0.04
+
+def find_content_box(image, scan_size=CONTENT_SCAN_SIZE):
+    """Tìm vùng chứa nội dung (chữ) trong ảnh dựa trên mật độ cạnh trên ảnh xám thu nhỏ.
+
+    Trả về (box, text_density): box (left, top, right, bottom) theo tọa độ ảnh gốc,
+    text_density là tỷ lệ pixel cạnh trong vùng box (0-1).
+    """
+    width, height = image.size
+    scale = scan_size / max(width, height)
+    small = image.convert('L') if scale >= 1 else image.convert('L').resize(
+        (max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR)
+    gray = np.asarray(small, dtype=np.int16)
+    edges = np.zeros(gray.shape, dtype=bool)
+    edges[:, 1:] |= np.abs(np.diff(gray, axis=1)) > EDGE_THRESHOLD
+    edges[1:, :] |= np.abs(np.diff(gray, axis=0)) > EDGE_THRESHOLD
+    total = int(edges.sum())
+    if total == 0:
+        return (0, 0, width, height), 0.0
+
+    def span(profile):
+        # Bỏ 2 đầu chứa ít hơn EDGE_TRIM_FRACTION tổng số cạnh (nền, vân mặt bàn lẻ tẻ)
+        cumulative = np.cumsum(profile)
+        start = int(np.searchsorted(cumulative, total * EDGE_TRIM_FRACTION, side='right'))
+        end = int(np.searchsorted(cumulative, total * (1 - EDGE_TRIM_FRACTION), side='left')) + 1
+        margin = max(1, round((end - start) * CROP_MARGIN))
+        return max(0, start - margin), min(len(profile), end + margin)
+
+    top, bottom = span(edges.sum(axis=1))
+    left, right = span(edges.sum(axis=0))
+    density = float(edges[top:bottom, left:right].mean())
+    small_height, small_width = gray.shape
+    box = (left * width // small_width, top * height // small_height,
+           -(-right * width // small_width), -(-bottom * height // small_height))
+    return box, density
+
+def choose_tile_budget(width, height, text_density, input_size=448, min_num=1, max_num=6):
+    """Số tile cho vùng width x height: đủ giữ độ phân giải gốc (nhiều tile hơn chỉ phóng to ảnh,
+    không thêm thông tin cho model), giảm một nửa khi chữ thưa."""
+    budget = math.ceil(width * height / (input_size * input_size))
+    if text_density < SPARSE_TEXT_DENSITY:
+        budget = math.ceil(budget / 2)
+    return max(min_num, min(max_num, budget))
+
+def tile_image_adaptive(image, input_size=448, min_num=1, max_num=6, use_thumbnail=True):
+    """Cắt nền quanh hóa đơn rồi chia tile với số tile theo vùng cắt.
+
+    Trả về (tensor uint8 như tile_image, info) với info gồm kích thước gốc, vùng cắt,
+    mật độ chữ, số tile tối đa được chọn và số tile thực tế (gồm thumbnail).
+    """
+    width, height = image.size
+    box, density = find_content_box(image)
+    crop_width, crop_height = box[2] - box[0], box[3] - box[1]
+    cropped = crop_width * crop_height <= (1 - MIN_CROP_SAVING) * width * height
+    if cropped:
+        image = image.crop(box)
+    else:
+        box, crop_width, crop_height = (0, 0, width, height), width, height
+    budget = choose_tile_budget(crop_width, crop_height, density, input_size, min_num, max_num)
+    # Không dùng nhiều tile hơn cách chia cố định trên cùng vùng ảnh
+    fixed_cols, fixed_rows = get_tile_grid(crop_width, crop_height, min_num, max_num, input_size)
+    budget = min(budget, fixed_cols * fixed_rows)
+    # Lưới tile từ budget / 2 đến budget tile: không thu nhỏ vùng cắt quá 2 lần so với độ phân giải gốc
+    tiles = tile_image(image, input_size=input_size, min_num=max(min_num, (budget + 1) // 2), max_num=budget,
+                       use_thumbnail=use_thumbnail)
+    return tiles, {
+        "original_size": [width, height],
+        "crop_box": list(box),
+        "cropped": cropped,
+        "text_density": round(density, 4),
+        "max_tiles": budget,
+        "tiles": int(tiles.size(0))
+    }
+
+def load_image(image_data, input_size=448, max_num=6):
+    """Tải và tiền xử lý ảnh từ bytes data, đường dẫn hoặc file object."""
+    image = open_image(image_data)
+    tiles = tile_image(image, input_size=input_size, max_num=max_num, use_thumbnail=True)
+    return normalize_tiles(tiles)
+
+def load_image_reference(image_data, input_size=448, max_num=6):
+    """Cách tiền xử lý cũ (PIL crop + transform từng tile), dùng để kiểm tra và benchmark."""
+    image = open_image(image_data)
+    transform = build_transform(input_size=input_size)
+    images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
+    pixel_values = [transform(img) for img in images]
+    pixel_values = torch.stack(pixel_values)
+    return pixel_values
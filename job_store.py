@@ -0,0 +1,195 @@
+"""
+Kho lưu trạng thái job có giới hạn kích thước và thời gian sống (TTL)
+Dùng cho API bất đồng bộ (/jobs) và endpoint đồng bộ /extract_invoice
+"""
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+JOB_QUEUED = "queued"
+JOB_PROCESSING = "processing"
+JOB_DONE = "done"
+
+class JobStoreFull(Exception):
+    """Kho job đã đầy các job chưa xong, không nhận thêm."""
+
+class Job:
+    """Một job trích xuất: trạng thái, kết quả và Event để chờ."""
+
+    __slots__ = ("job_id", "status", "result", "created_at", "started_at",
+                 "finished_at", "expires_at", "event", "callbacks")
+
+    def __init__(self, job_id, ttl):
+        now = time.time()
+        self.job_id = job_id
+        self.status = JOB_QUEUED
+        self.result = None
+        self.created_at = now
+        self.started_at = None
+        self.finished_at = None
+        self.expires_at = now + ttl
+        self.event = threading.Event()
+        self.callbacks = []
+
+    def wait(self, timeout=None):
+        """Chờ job xong, trả về True nếu đã xong trong thời gian chờ."""
+        return self.event.wait(timeout=timeout)
+
+    def to_dict(self):
+        """Thông tin job trả về cho client."""
+        info = {
+            "job_id": self.job_id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "expires_at": self.expires_at
+        }
+        if self.status == JOB_DONE:
+            info["result"] = self.result
+        return info
+
+class JobStore:
+    """Lưu job theo thứ tự tạo, tự loại bỏ job hết hạn và job cũ nhất khi đầy."""
+
+    def __init__(self, max_size=10000, ttl=900, sweep_interval=1.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self.evicted = 0
+        self.dropped_results = 0
+        self._evicted_callbacks = []  # (job, callbacks) của job bị loại khi chưa xong, gọi sau khi nhả lock
+
+    def create(self):
+        """Tạo job mới. Raise JobStoreFull nếu kho đầy job chưa xong."""
+        try:
+            with self._lock:
+                self._sweep(force=len(self._jobs) >= self.max_size)
+                if len(self._jobs) >= self.max_size and not self._evict_oldest_done():
+                    raise JobStoreFull(f"Đã có {len(self._jobs)} job đang chờ xử lý")
+                job = Job(str(uuid.uuid4()), self.ttl)
+                self._jobs[job.job_id] = job
+                return job
+        finally:
+            self._run_evicted_callbacks()
+
+    def get(self, job_id):
+        """Lấy job theo id, None nếu không tồn tại hoặc đã hết hạn."""
+        try:
+            with self._lock:
+                self._sweep()
+                job = self._jobs.get(job_id)
+                if job is not None and job.expires_at <= time.time():
+                    self._remove(job_id)
+                    return None
+                return job
+        finally:
+            self._run_evicted_callbacks()
+
+    def pop(self, job_id):
+        """Lấy và xóa job khỏi kho."""
+        with self._lock:
+            return self._jobs.pop(job_id, None)
+
+    def discard(self, job_id):
+        """Xóa job (vd: client timeout). Kết quả ghi sau đó sẽ bị bỏ qua."""
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def mark_processing(self, job_id):
+        """Đánh dấu job bắt đầu chạy. Trả về False nếu job không còn trong kho."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False
+            job.status = JOB_PROCESSING
+            job.started_at = time.time()
+            return True
+
+    def finish(self, job_id, result):
+        """Lưu kết quả và signal job. Trả về False nếu job đã bị xóa/hết hạn."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                self.dropped_results += 1
+                return False
+            now = time.time()
+            job.status = JOB_DONE
+            job.result = result
+            job.finished_at = now
+            # Kết quả được giữ thêm một TTL để client kịp lấy
+            job.expires_at = now + self.ttl
+            job.event.set()
+            callbacks, job.callbacks = job.callbacks or [], None
+        for callback in callbacks:
+            callback(job)
+        return True
+
+    def add_done_callback(self, job, callback):
+        """Gọi callback(job) khi job xong (ngay lập tức nếu đã xong), trong thread ghi kết quả.
+
+        Job bị loại khỏi kho trước khi xong (hết TTL, kho đầy) cũng gọi callback, với job.status chưa phải
+        done và job.result None. Job bị xóa bằng discard/pop thì không gọi.
+        """
+        with self._lock:
+            if job.callbacks is not None:
+                job.callbacks.append(callback)
+                return
+        callback(job)
+
+    def stats(self):
+        """Thống kê kho job cho /health."""
+        with self._lock:
+            pending = sum(1 for job in self._jobs.values() if job.status != JOB_DONE)
+            return {
+                "size": len(self._jobs),
+                "pending": pending,
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "evicted": self.evicted,
+                "dropped_results": self.dropped_results
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def _remove(self, job_id):
+        job = self._jobs.pop(job_id, None)
+        if job is not None:
+            self.evicted += 1
+            # Đánh thức client đang chờ để nó nhận ra job đã bị loại bỏ
+            job.event.set()
+            if job.callbacks:
+                self._evicted_callbacks.append((job, job.callbacks))
+            job.callbacks = None
+
+    def _run_evicted_callbacks(self):
+        """Gọi callback của các job vừa bị loại (ngoài lock, callback có thể gọi lại JobStore)."""
+        with self._lock:
+            pending, self._evicted_callbacks = self._evicted_callbacks, []
+        for job, callbacks in pending:
+            for callback in callbacks:
+                callback(job)
+
+    def _sweep(self, force=False):
+        """Loại bỏ job hết hạn (tối đa mỗi sweep_interval giây một lần)."""
+        now = time.time()
+        if not force and now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        expired = [job_id for job_id, job in self._jobs.items() if job.expires_at <= now]
+        for job_id in expired:
+            self._remove(job_id)
+
+    def _evict_oldest_done(self):
+        """Loại bỏ job đã xong cũ nhất để lấy chỗ, False nếu tất cả đều chưa xong."""
+        for job_id, job in self._jobs.items():
+            if job.status == JOB_DONE:
+                self._remove(job_id)
+                return True
+        return False
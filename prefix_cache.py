@@ -0,0 +1,90 @@
+"""
+KV cache của phần prompt cố định trước nội dung ảnh (system message + đầu lượt user + <img>)
+- Tính 1 lần khi load model (trước khi fork replica nên các replica dùng chung), mỗi request bắt đầu prefill
+  từ trạng thái đã cache: generate của transformers chỉ chạy phần prompt chưa có trong cache
+- Truyền qua generation_config["past_key_values"]: model.chat của InternVL chuyển nguyên xuống
+  language_model.generate, template hội thoại và chèn token ảnh vẫn do code của model làm
+- Chỉ dùng cho lượt 1 ảnh: batch_chat đệm trái nên prompt trong batch không còn bắt đầu ở vị trí 0
+"""
+import sys
+import copy
+import time
+import statistics
+
+import torch
+
+IMG_START_TOKEN = '<img>'
+IMG_END_TOKEN = '</img>'
+IMG_CONTEXT_TOKEN = '<IMG_CONTEXT>'
+
+def internvl_query(model, question, num_patches=1):
+    """Prompt mà InternVL.chat tạo cho question (template hội thoại của model, 1 ảnh num_patches tile)."""
+    module = sys.modules[type(model).__module__]
+    template = module.get_conv_template(model.template)
+    template.system_message = model.system_message
+    if '<image>' not in question:
+        question = '<image>\n' + question
+    template.append_message(template.roles[0], question)
+    template.append_message(template.roles[1], None)
+    image_tokens = IMG_START_TOKEN + IMG_CONTEXT_TOKEN * model.num_image_token * num_patches + IMG_END_TOKEN
+    return template.get_prompt().replace('<image>', image_tokens, 1)
+
+def prompt_prefix_ids(model, tokenizer, question):
+    """Token id của phần prompt trước token ảnh đầu tiên, None nếu không tách được đúng ranh giới token."""
+    if hasattr(model, "prompt_prefix"):
+        return tokenizer.encode(model.prompt_prefix(question), add_special_tokens=False)
+    query = internvl_query(model, question)
+    prefix_ids = tokenizer(query[:query.index(IMG_START_TOKEN) + len(IMG_START_TOKEN)])["input_ids"]
+    # Tokenize riêng phần đầu phải ra đúng các token đầu của prompt đầy đủ thì KV cache mới khớp
+    if tokenizer(query)["input_ids"][:len(prefix_ids)] != prefix_ids:
+        return None
+    return prefix_ids
+
+def prefill(model, prefix_ids):
+    """Chạy language model trên phần prompt cố định, trả về KV cache."""
+    if hasattr(model, "prefill_prefix"):
+        return model.prefill_prefix(prefix_ids)
+    language_model = model.language_model
+    embed_tokens = language_model.get_input_embeddings()
+    input_ids = torch.tensor([prefix_ids], dtype=torch.long, device=embed_tokens.weight.device)
+    return language_model(inputs_embeds=embed_tokens(input_ids), use_cache=True).past_key_values
+
+class PrefixCache:
+    """KV cache của phần prompt cố định và thời gian prefill phần đó (ước tính thời gian tiết kiệm mỗi request)."""
+
+    def __init__(self, token_ids, past_key_values, prefill_seconds):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.prefill_seconds = prefill_seconds
+
+    @classmethod
+    def build(cls, model, tokenizer, question, repeats=3):
+        """Tính KV cache cho phần đầu prompt của question. None nếu model/tokenizer không tách được prefix."""
+        prefix_ids = prompt_prefix_ids(model, tokenizer, question)
+        if not prefix_ids:
+            return None
+        timings = []
+        with torch.no_grad():
+            for _ in range(max(1, repeats)):
+                started_at = time.perf_counter()
+                past_key_values = prefill(model, prefix_ids)
+                timings.append(time.perf_counter() - started_at)
+        return cls(prefix_ids, past_key_values, statistics.median(timings))
+
+    def __len__(self):
+        return len(self.token_ids)
+
+    def for_generation(self, num_beams=1):
+        """Bản sao KV cache cho 1 lượt generate (generate ghi thêm vào cache), nhân theo số beam."""
+        past_key_values = copy.deepcopy(self.past_key_values)
+        if num_beams > 1 and hasattr(past_key_values, "batch_repeat_interleave"):
+            past_key_values.batch_repeat_interleave(num_beams)
+        return past_key_values
+
+    def report(self):
+        """Số token prefill được bỏ qua và thời gian ước tính tiết kiệm cho 1 request."""
+        return {"prefix_tokens_reused": len(self), "prefix_saved_ms": round(1000 * self.prefill_seconds, 2)}
+
+    def stats(self):
+        """Thống kê cho /health."""
+        return dict(self.report(), enabled=True)
@@ -0,0 +1,60 @@
+"""
+Lượng tử hóa động int8 cho inference trên CPU
+- Linear của language model -> int8 (trọng số int8, activation lượng tử hóa lúc chạy)
+- Tùy chọn lượng tử hóa cả MLP projector của vision (mlp1)
+- Giữ nguyên đầu ra (lm_head/output) và vision encoder để hạn chế sai lệch
+Import torch trong hàm: app.py đọc QUANTIZE_MODES khi khởi động mà chưa cần torch
+"""
+
+QUANTIZE_MODES = ("none", "int8")
+
+# Tên lớp đầu ra của các language model InternVL dùng (Qwen2: lm_head, InternLM2: output)
+OUTPUT_HEAD_NAMES = ("lm_head", "output")
+
+def module_size_bytes(module):
+    """Dung lượng tham số + buffer (kể cả trọng số đã đóng gói của Linear int8)."""
+    import torch
+
+    size = sum(t.numel() * t.element_size() for t in module.parameters())
+    size += sum(t.numel() * t.element_size() for t in module.buffers())
+    for child in module.modules():
+        if isinstance(child, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = child._packed_params._weight_bias()
+            size += weight.numel() * weight.element_size()
+            if bias is not None:
+                size += bias.numel() * bias.element_size()
+    return size
+
+def quantize_linear_layers(module, skip_names=()):
+    """Lượng tử hóa động int8 các nn.Linear trong module (in-place), trừ các lớp có tên trong skip_names.
+
+    Trả về số Linear đã lượng tử hóa.
+    """
+    import torch
+    import torch.nn as nn
+    from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+    names = [name for name, child in module.named_modules()
+             if isinstance(child, nn.Linear) and name.split('.')[-1] not in skip_names]
+    if names:
+        quantize_dynamic(module, {name: default_dynamic_qconfig for name in names}, dtype=torch.qint8, inplace=True)
+    return len(names)
+
+def quantize_model(model, mode="int8", vision_projector=False):
+    """Lượng tử hóa model InternVL theo mode (in-place). Trả về thông tin cho /health."""
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"Chế độ lượng tử hóa không hợp lệ: '{mode}'. Chọn một trong: {', '.join(QUANTIZE_MODES)}")
+    size_before = module_size_bytes(model)
+    info = {"mode": mode, "vision_projector": False, "quantized_linear": 0}
+    if mode == "none":
+        info["model_size_mb"] = size_before / 1024**2
+        return info
+
+    info["quantized_linear"] += quantize_linear_layers(model.language_model, skip_names=OUTPUT_HEAD_NAMES)
+    if vision_projector and getattr(model, "mlp1", None) is not None:
+        info["quantized_linear"] += quantize_linear_layers(model.mlp1)
+        info["vision_projector"] = True
+    size_after = module_size_bytes(model)
+    info["model_size_mb"] = size_after / 1024**2
+    info["fp32_size_mb"] = size_before / 1024**2
+    return info
@@ -0,0 +1,140 @@
+"""
+Phục vụ nhiều replica inference trên CPU (fork sau khi load model)
+- Process chính load model 1 lần rồi fork N process con: weights dùng chung theo copy-on-write
+- Mỗi replica có số thread torch riêng (torch.set_num_threads) để không tranh core với nhau
+- Giao tiếp qua Pipe: process chính gửi pixel_values (numpy), nhận token (khi stream) và kết quả
+"""
+import gc
+import threading
+import multiprocessing
+
+class ReplicaError(RuntimeError):
+    """Replica lỗi khi chạy hoặc đã dừng."""
+
+class PipeChannel:
+    """Thay cho queue stream trong process con: đẩy sự kiện về process chính qua pipe."""
+
+    def __init__(self, conn, task_id):
+        self.conn = conn
+        self.task_id = task_id
+
+    def put(self, item):
+        self.conn.send(("event", self.task_id, item))
+
+def _replica_main(conn, num_threads, handler):
+    """Vòng lặp của process replica: nhận task, chạy handler(pixel_values_list, profile, channel, **kwargs)."""
+    import torch
+
+    torch.set_num_threads(num_threads)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        task_id, pixel_arrays, profile, stream, kwargs = message
+        try:
+            pixel_values_list = [torch.from_numpy(array) for array in pixel_arrays]
+            channel = PipeChannel(conn, task_id) if stream else None
+            conn.send(("result", task_id, handler(pixel_values_list, profile, channel, **kwargs)))
+        except Exception as e:
+            conn.send(("error", task_id, f"{type(e).__name__}: {e}"))
+    conn.close()
+
+class Replica:
+    """Một process inference con, mỗi lúc chạy một task (gọi từ một worker thread của process chính)."""
+
+    def __init__(self, index, num_threads, handler, context):
+        self.index = index
+        self.num_threads = num_threads
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_replica_main, args=(child_conn, num_threads, handler),
+                                       name=f"replica-{index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self._lock = threading.Lock()
+        self._next_task_id = 0
+        self.busy = False
+        self.tasks = 0
+        self.errors = 0
+
+    def call(self, pixel_values_list, profile, channel=None, **kwargs):
+        """Chạy handler trên replica, chuyển token về channel (nếu có). Raise ReplicaError nếu lỗi."""
+        with self._lock:
+            self._next_task_id += 1
+            task_id = self._next_task_id
+            self.busy = True
+            try:
+                self.conn.send((task_id, [pv.numpy() for pv in pixel_values_list], profile, channel is not None,
+                                kwargs))
+                while True:
+                    kind, reply_id, payload = self.conn.recv()
+                    if reply_id != task_id:
+                        continue
+                    if kind == "event":
+                        channel.put(payload)
+                    elif kind == "result":
+                        self.tasks += 1
+                        return payload
+                    else:
+                        self.errors += 1
+                        raise ReplicaError(payload)
+            except (EOFError, OSError) as e:
+                self.errors += 1
+                raise ReplicaError(f"Replica {self.index} đã dừng (exit code {self.process.exitcode}): {e}")
+            finally:
+                self.busy = False
+
+    def close(self, timeout=5):
+        """Dừng process replica."""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+    def stats(self):
+        return {
+            "index": self.index,
+            "pid": self.process.pid,
+            "alive": self.process.is_alive(),
+            "threads": self.num_threads,
+            "busy": self.busy,
+            "tasks": self.tasks,
+            "errors": self.errors
+        }
+
+class ReplicaPool:
+    """N replica fork từ process chính sau khi model đã load.
+
+    Phải tạo trước khi process chính chạy inference/khởi động thread worker: OpenMP
+    và các lock đang bị giữ không an toàn khi fork.
+    """
+
+    def __init__(self, num_replicas, threads_per_replica, handler):
+        # Đưa các object hiện có ra khỏi GC để GC của process con không ghi vào các trang bộ nhớ
+        # dùng chung (giữ copy-on-write); dữ liệu tensor không bị refcount chạm vào
+        gc.collect()
+        gc.freeze()
+        context = multiprocessing.get_context("fork")
+        self.replicas = [Replica(index, threads_per_replica, handler, context) for index in range(num_replicas)]
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def __iter__(self):
+        return iter(self.replicas)
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
+        gc.unfreeze()
+
+    def stats(self):
+        """Thống kê cho /health."""
+        return [replica.stats() for replica in self.replicas]
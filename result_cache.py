@@ -0,0 +1,141 @@
+"""
+Cache kết quả trích xuất theo nội dung ảnh
+Tầng 1: LRU trong bộ nhớ (giới hạn số mục và dung lượng)
+Tầng 2 (tùy chọn): SQLite trên đĩa, giữ qua các lần restart và dùng chung giữa các replica cùng máy
+"""
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+def make_cache_key(image_data, question, generation_config):
+    """Tạo key từ hash của bytes ảnh + câu hỏi + cấu hình generation."""
+    hasher = hashlib.sha256()
+    hasher.update(image_data)
+    hasher.update(b"\0")
+    hasher.update(question.encode("utf-8"))
+    hasher.update(b"\0")
+    hasher.update(json.dumps(generation_config, sort_keys=True, default=str).encode("utf-8"))
+    return hasher.hexdigest()
+
+class ResultCache:
+    """Cache 2 tầng: LRU trong bộ nhớ + SQLite trên đĩa (nếu có db_path)."""
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, db_path=None, disk_max_entries=100000):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.db_path = db_path
+        self.disk_max_entries = disk_max_entries
+        self._memory = OrderedDict()  # key -> (value, size)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        if db_path:
+            self._open_db()
+
+    def _open_db(self):
+        """Mở SQLite ở chế độ WAL để nhiều process đọc/ghi đồng thời."""
+        self._db = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_results_created_at ON results(created_at)")
+        self._db.commit()
+
+    def get(self, key):
+        """Tìm kết quả theo key, None nếu không có."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return json.loads(entry[0])
+
+        if self._db is not None:
+            try:
+                with self._db_lock:
+                    row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"⚠️  Lỗi đọc cache trên đĩa: {e}")
+                row = None
+            if row is not None:
+                # Đưa lên tầng bộ nhớ cho lần sau
+                with self._lock:
+                    self.disk_hits += 1
+                    self._put_memory(key, row[0])
+                return json.loads(row[0])
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Lưu kết quả (phải serialize được sang JSON) vào cả hai tầng."""
+        serialized = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self.stores += 1
+            self._put_memory(key, serialized)
+
+        if self._db is not None:
+            try:
+                with self._db_lock:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO results (key, value, created_at) VALUES (?, ?, ?)",
+                        (key, serialized, time.time())
+                    )
+                    # Đếm số mục trên đĩa tốn O(n), chỉ kiểm tra định kỳ
+                    if self.stores % 100 == 0:
+                        self._trim_disk()
+                    self._db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️  Lỗi ghi cache xuống đĩa: {e}")
+
+    def _put_memory(self, key, serialized):
+        size = len(serialized.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= old[1]
+        self._memory[key] = (serialized, size)
+        self._memory_bytes += size
+        # Loại bỏ mục ít dùng nhất khi vượt giới hạn
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+            _, (_, old_size) = self._memory.popitem(last=False)
+            self._memory_bytes -= old_size
+
+    def _trim_disk(self):
+        """Giữ số mục trên đĩa không vượt disk_max_entries (xóa mục cũ nhất)."""
+        count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.disk_max_entries:
+            self._db.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY created_at LIMIT ?)",
+                (count - self.disk_max_entries,)
+            )
+
+    def stats(self):
+        """Thống kê hit/miss cho /health."""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "disk_enabled": self._db is not None,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,157 @@
+"""
+Sinh JSON theo schema hóa đơn (decoding="schema")
+- Phần cấu trúc cố định của output (key, ngoặc, dấu nháy, dấu phẩy) được thêm thẳng vào chuỗi: các token cấu trúc
+  liên tiếp đi qua language model trong 1 lượt forward (chỉ để cập nhật KV cache) thay vì mỗi token 1 bước decode
+- Model chỉ sinh giá trị: greedy trong các token không chứa dấu nháy, backslash, ký tự điều khiển; giá trị kết thúc
+  khi token tốt nhất bắt đầu bằng dấu nháy (hoặc là EOS). Mảng thêm phần tử hay đóng lại do model chọn
+- Kết quả dựng lại bằng json.dumps nên luôn parse được
+- Chạy từng ảnh (batch 1) với KV cache riêng, bắt đầu được từ KV cache của prefix prompt (prefix_cache.py)
+- Model chạy qua session của decode_session.py (prefill 1 lần, sau đó đưa thêm token với KV cache)
+"""
+import json
+
+import torch
+
+class SchemaDecoder:
+    """Sinh object JSON theo schema: dict key -> "string" hoặc [schema của phần tử] (mảng object).
+
+    max_value_tokens: số token tối đa của 1 giá trị, max_items: số phần tử tối đa của 1 mảng.
+    """
+
+    def __init__(self, tokenizer, schema, max_value_tokens=96, max_items=50):
+        self.tokenizer = tokenizer
+        self.schema = schema
+        self.max_value_tokens = max_value_tokens
+        self.max_items = max_items
+        self._value_mask = None
+        self._closing_mask = None
+
+    def prepare(self):
+        """Phân loại token của vocab (decode từng token, ~1-2 giây với vocab 150k): token dùng được trong giá trị
+        chuỗi và token kết thúc giá trị (bắt đầu bằng dấu nháy hoặc là token đặc biệt)."""
+        if self._value_mask is not None:
+            return
+        try:
+            vocab_size = len(self.tokenizer)
+        except TypeError:
+            vocab_size = self.tokenizer.vocab_size
+        special_ids = set(getattr(self.tokenizer, "all_special_ids", None) or [])
+        special_ids.update(getattr(self.tokenizer, "added_tokens_decoder", None) or {})
+        special_ids.update(token_id for token_id in (self.tokenizer.eos_token_id, self.tokenizer.pad_token_id)
+                           if token_id is not None)
+        value_mask = torch.zeros(vocab_size, dtype=torch.bool)
+        closing_mask = torch.zeros(vocab_size, dtype=torch.bool)
+        for token_id in range(vocab_size):
+            if token_id in special_ids:
+                closing_mask[token_id] = True
+                continue
+            text = self.tokenizer.decode([token_id])
+            if text.startswith('"'):
+                closing_mask[token_id] = True
+            elif '"' not in text and '\\' not in text and all(char >= ' ' for char in text):
+                value_mask[token_id] = True
+        self._value_mask = value_mask
+        self._closing_mask = closing_mask
+
+    def is_closing(self, token_id):
+        """Token kết thúc giá trị chuỗi."""
+        return token_id < self._closing_mask.size(0) and bool(self._closing_mask[token_id])
+
+    def value_mask(self, size, device):
+        """Mask token dùng được trong giá trị cho logits dài size (lm_head có thể đệm vocab dài hơn tokenizer:
+        phần đệm không bao giờ được chọn)."""
+        mask = self._value_mask
+        if mask.size(0) < size:
+            mask = torch.cat([mask, mask.new_zeros(size - mask.size(0))])
+        return mask[:size].to(device)
+
+    def decode(self, session):
+        """Sinh object theo schema tiếp sau prompt đã prefill trong session (decode_session.py).
+
+        Trả về (dict kết quả, thống kê: forward_passes = số lượt forward sau prefill, forced_tokens = token cấu trúc,
+        sampled_tokens = token giá trị; decode tự do cùng output cần forced_tokens + sampled_tokens lượt forward).
+        """
+        self.prepare()
+        run = _SchemaRun(self, session)
+        result = run.object(self.schema)
+        return result, {
+            "forward_passes": run.forward_passes,
+            "forced_tokens": run.forced_tokens,
+            "sampled_tokens": run.sampled_tokens
+        }
+
+class _SchemaRun:
+    """Trạng thái của 1 lượt SchemaDecoder.decode: phần cấu trúc chưa đưa vào model và số token/lượt forward."""
+
+    def __init__(self, decoder, session):
+        self.decoder = decoder
+        self.tokenizer = decoder.tokenizer
+        self.session = session
+        self.pending = ""
+        self.forward_passes = 0
+        self.forced_tokens = 0
+        self.sampled_tokens = 0
+
+    def feed(self, token_ids):
+        self.session.feed(token_ids)
+        self.forward_passes += 1
+
+    def flush(self):
+        """Đưa phần cấu trúc đang chờ vào model trong 1 lượt forward (cần trước khi model chọn token tiếp)."""
+        if not self.pending:
+            return
+        token_ids = self.tokenizer.encode(self.pending, add_special_tokens=False)
+        self.pending = ""
+        if token_ids:
+            self.feed(token_ids)
+            self.forced_tokens += len(token_ids)
+
+    def object(self, schema):
+        self.pending += "{"
+        result = {}
+        for index, (key, value_schema) in enumerate(schema.items()):
+            self.pending += (", " if index else "") + json.dumps(key, ensure_ascii=False) + ": "
+            result[key] = self.value(value_schema)
+        self.pending += "}"
+        return result
+
+    def value(self, schema):
+        if isinstance(schema, list):
+            return self.array(schema[0])
+        self.pending += '"'
+        text = self.string()
+        self.pending += '"'
+        return text
+
+    def array(self, item_schema):
+        self.pending += "["
+        items = []
+        while len(items) < self.decoder.max_items and self.choose(", " if items else "{", "]"):
+            if items:
+                self.pending += ", "
+            items.append(self.object(item_schema))
+        self.pending += "]"
+        return items
+
+    def choose(self, option, alternative):
+        """Model chọn giữa 2 cách viết tiếp (so sánh logits của token đầu tiên). True nếu chọn option."""
+        self.flush()
+        logits = self.session.logits
+        option_id, alternative_id = (self.tokenizer.encode(text, add_special_tokens=False)[0]
+                                     for text in (option, alternative))
+        return bool(logits[option_id] >= logits[alternative_id])
+
+    def string(self):
+        """Sinh 1 giá trị chuỗi (không gồm dấu nháy)."""
+        self.flush()
+        token_ids = []
+        for _ in range(self.decoder.max_value_tokens):
+            logits = self.session.logits.float()
+            if self.decoder.is_closing(int(torch.argmax(logits))):
+                break
+            allowed = self.decoder.value_mask(logits.size(0), logits.device)
+            token_id = int(torch.argmax(logits.masked_fill(~allowed, float('-inf'))))
+            token_ids.append(token_id)
+            self.feed([token_id])
+            self.sampled_tokens += 1
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True).strip()
@@ -0,0 +1,187 @@
+"""
+Speculative decoding với draft lấy từ kết quả trích xuất gần đây (decoding="speculative")
+- Hóa đơn cùng cửa hàng cho output gần giống nhau (tên, địa chỉ, tên món): NgramIndex giữ token của các kết quả
+  gần đây, đề xuất đoạn tiếp theo sau n-gram cuối của chuỗi đang sinh
+- Mỗi lượt forward kiểm tra cả đoạn draft: giữ các token draft trùng với token greedy của model (có repetition
+  penalty như generate), thêm 1 token của model; token draft bị từ chối được cắt khỏi KV cache.
+  Output giống hệt greedy không có draft
+- Tỉ lệ chấp nhận thấp (sau min_drafted token draft) thì ngừng đề xuất draft cho phần còn lại của request
+- Token của kết quả được thêm thẳng vào index (không tokenize lại text)
+"""
+import time
+import threading
+from collections import OrderedDict
+
+import torch
+
+from generation import find_json_object_end
+
+class NgramIndex:
+    """Index n-gram -> lần xuất hiện gần nhất trong các chuỗi token kết quả gần đây (tối đa max_sequences chuỗi)."""
+
+    def __init__(self, n=3, max_sequences=256):
+        self.n = n
+        self.max_sequences = max_sequences
+        self._sequences = OrderedDict()  # seq_id -> token ids
+        self._index = {}  # n-gram -> (seq_id, vị trí token ngay sau n-gram)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _ngrams(self, token_ids):
+        for end in range(self.n, len(token_ids)):
+            yield tuple(token_ids[end - self.n:end]), end
+
+    def add(self, token_ids):
+        """Thêm chuỗi token của 1 kết quả, loại chuỗi cũ nhất khi vượt max_sequences."""
+        token_ids = list(token_ids)
+        if len(token_ids) <= self.n:
+            return
+        with self._lock:
+            seq_id = self._next_id
+            self._next_id += 1
+            self._sequences[seq_id] = token_ids
+            for ngram, end in self._ngrams(token_ids):
+                self._index[ngram] = (seq_id, end)
+            while len(self._sequences) > self.max_sequences:
+                old_id, old_ids = self._sequences.popitem(last=False)
+                for ngram, _ in self._ngrams(old_ids):
+                    if self._index.get(ngram, (None,))[0] == old_id:
+                        del self._index[ngram]
+
+    def propose(self, context_ids, max_tokens):
+        """Tối đa max_tokens token tiếp theo sau n-gram cuối của context_ids, [] nếu chưa gặp n-gram này."""
+        if max_tokens <= 0 or len(context_ids) < self.n:
+            return []
+        with self._lock:
+            entry = self._index.get(tuple(context_ids[-self.n:]))
+            if entry is None:
+                return []
+            seq_id, end = entry
+            return self._sequences[seq_id][end:end + max_tokens]
+
+    def __len__(self):
+        return len(self._sequences)
+
+    def stats(self):
+        """Thống kê cho /health."""
+        with self._lock:
+            return {"sequences": len(self._sequences), "ngrams": len(self._index),
+                    "max_sequences": self.max_sequences, "n": self.n}
+
+def apply_repetition_penalty(logits, ids, penalty):
+    """Repetition penalty như transformers: logits của token đã sinh (ids: tensor id không trùng) chia penalty
+    (nhân nếu âm)."""
+    if penalty == 1.0 or ids is None or ids.numel() == 0:
+        return logits
+    scores = logits[ids]
+    logits = logits.clone()
+    logits[ids] = torch.where(scores < 0, scores * penalty, scores / penalty)
+    return logits
+
+class _PenalizedIds:
+    """Các token id đã sinh (không trùng) cho repetition penalty, thêm dần khi token được giữ.
+
+    Tensor cấp sẵn max_tokens phần tử trên device của logits: mỗi token mới chỉ ghi 1 phần tử, không dựng lại
+    tensor từ cả chuỗi cho mỗi dòng logits.
+    """
+
+    def __init__(self, max_tokens, device):
+        self._seen = set()
+        self._ids = torch.empty(max_tokens, dtype=torch.long, device=device)
+        self._count = 0
+
+    def add(self, token_id):
+        if token_id in self._seen or self._count >= self._ids.size(0):
+            return
+        self._seen.add(token_id)
+        self._ids[self._count] = token_id
+        self._count += 1
+
+    def tensor(self):
+        return self._ids[:self._count]
+
+class SpeculativeDecoder:
+    """Greedy decode có draft từ NgramIndex, kiểm tra tối đa draft_tokens token draft mỗi lượt forward.
+
+    min_acceptance / min_drafted: sau min_drafted token draft mà tỉ lệ chấp nhận dưới min_acceptance thì
+    decode tiếp như greedy thường (không tốn thêm tính toán cho draft bị từ chối).
+    """
+
+    def __init__(self, tokenizer, index, draft_tokens=8, min_acceptance=0.3, min_drafted=32):
+        self.tokenizer = tokenizer
+        self.index = index
+        self.draft_tokens = draft_tokens
+        self.min_acceptance = min_acceptance
+        self.min_drafted = min_drafted
+
+    def _next_token(self, logits, penalized, repetition_penalty):
+        ids = penalized.tensor() if penalized is not None else None
+        return int(torch.argmax(apply_repetition_penalty(logits.float(), ids, repetition_penalty)))
+
+    def _closes_brace(self, token_ids):
+        """Có token nào chứa '}' (như JsonObjectStoppingCriteria: chỉ khi đó mới cần kiểm tra lại cả chuỗi)."""
+        return any('}' in self.tokenizer.decode([token_id], skip_special_tokens=True) for token_id in token_ids)
+
+    def decode(self, session, max_new_tokens=1024, repetition_penalty=1.0, json_early_stop=True):
+        """Sinh tiếp sau prompt đã prefill trong session (decode_session.py), thêm token kết quả vào index.
+
+        Trả về (text, thống kê)."""
+        started_at = time.perf_counter()
+        eos_token_id = self.tokenizer.eos_token_id
+        generated = []
+        forward_passes = drafted = accepted = 0
+        drafting = True
+        penalized = _PenalizedIds(max_new_tokens, session.device) if repetition_penalty != 1.0 else None
+        accepted_draft = []
+        next_token = self._next_token(session.logits, penalized, repetition_penalty)
+        while True:
+            generated.append(next_token)
+            if penalized is not None:
+                penalized.add(next_token)
+            if next_token == eos_token_id or len(generated) >= max_new_tokens:
+                break
+            # Chỉ decode lại cả chuỗi khi token mới thêm (draft được giữ + token của model) có '}'
+            if (json_early_stop and self._closes_brace(accepted_draft + [next_token])
+                    and find_json_object_end(self.tokenizer.decode(generated, skip_special_tokens=True)) > 0):
+                break
+            draft = []
+            if drafting:
+                draft = self.index.propose(generated, min(self.draft_tokens, max_new_tokens - len(generated) - 1))
+            # 1 lượt forward: token vừa chọn + draft; logits dòng i dự đoán token sau draft[:i]
+            rows = session.verify([next_token] + draft)
+            forward_passes += 1
+            count = 0
+            while True:
+                next_token = self._next_token(rows[count], penalized, repetition_penalty)
+                if count < len(draft) and next_token == draft[count]:
+                    if penalized is not None:
+                        penalized.add(next_token)
+                    count += 1
+                    continue
+                break
+            if count < len(draft):
+                session.crop(len(draft) - count)
+            accepted_draft = draft[:count]
+            generated.extend(accepted_draft)
+            drafted += len(draft)
+            accepted += count
+            if drafting and drafted >= self.min_drafted and accepted < self.min_acceptance * drafted:
+                drafting = False
+        # Index giữ token của text kết quả như remember_responses của decode tự do (không có EOS)
+        self.index.add(generated[:-1] if generated[-1] == eos_token_id else generated)
+        text = self.tokenizer.decode(generated, skip_special_tokens=True)
+        if json_early_stop:
+            # Draft được chấp nhận có thể đi quá dấu '}' đóng object: cắt như khi generate dừng sớm
+            end = find_json_object_end(text)
+            if end > 0:
+                text = text[:end]
+        seconds = time.perf_counter() - started_at
+        return text, {
+            "forward_passes": forward_passes,
+            "generated_tokens": len(generated),
+            "drafted_tokens": drafted,
+            "accepted_tokens": accepted,
+            "acceptance_rate": accepted / drafted if drafted else 0.0,
+            "tokens_per_s": len(generated) / seconds if seconds > 0 else 0.0,
+            "drafting_stopped": not drafting
+        }
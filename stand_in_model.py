@@ -0,0 +1,314 @@
+"""
+Model thay thế nhỏ (khởi tạo ngẫu nhiên) để benchmark/kiểm thử khi không có checkpoint Vintern-1B
+- Cùng giao diện model.chat / model.batch_chat / extract_feature và hợp đồng tokenizer (encode/decode, eos)
+  mà app.py dùng, chạy được trên CPU không cần mạng
+- Tính toán thật: vision encoder (256 token/tile như InternVL) + language model vài lớp, prefill cả prompt
+  rồi sinh từng token với KV cache, beam search nhân số dòng chạy song song
+- Token sinh ra được ép theo câu trả lời JSON mẫu để parse JSON, dừng sớm và stream chạy như với model thật
+- generation_config["visual_features"]: dùng đặc trưng ảnh đã tính sẵn thay vì chạy vision encoder (như InternVL)
+- Prompt theo template hội thoại (system message + lượt user) như InternVL; generation_config["past_key_values"]:
+  KV cache của phần prompt trước ảnh (prefill_prefix), chỉ prefill phần còn lại
+- decode_session: prefill rồi decode theo token do schema_decoding.py / speculative.py đưa vào, logits được cộng
+  thêm ở token tiếp theo của câu trả lời mẫu để các cách decode này ra cùng kết quả
+"""
+import json
+import zlib
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+EOS_TOKEN_ID = 256
+PAD_TOKEN_ID = 257
+VOCAB_SIZE = 258
+
+# Câu trả lời mẫu (giá trị thay đổi theo ảnh để kết quả các ảnh khác nhau)
+SAMPLE_RESPONSE = {
+    "Tên người bán": "Cửa hàng Tiện lợi Mẫu",
+    "Địa chỉ": "12 Nguyễn Văn Linh, Đà Nẵng",
+    "Ngày giao dịch": "2024-01-15",
+    "Tổng tiền thanh toán": "125000",
+    "Danh sách món": [
+        {"Tên món": "Nước suối", "Đơn giá": "10000", "Số lượng": "2"},
+        {"Tên món": "Bánh mì", "Đơn giá": "25000", "Số lượng": "1"}
+    ]
+}
+
+# Template hội thoại kiểu InternVL: phần trước ảnh giống nhau cho mọi request
+SYSTEM_MESSAGE = ("Bạn là một mô hình trí tuệ nhân tạo đa phương thức Tiếng Việt có tên gọi là Vintern, "
+                  "được phát triển bởi người Việt. Bạn là một trợ lý trí tuệ nhân tạo hữu ích và không gây hại.")
+PROMPT_HEADER = f"<|im_start|>system\n{SYSTEM_MESSAGE}<|im_end|>\n<|im_start|>user\n"
+PROMPT_FOOTER = "<|im_end|>\n<|im_start|>assistant\n"
+
+class StandInTokenizer:
+    """Tokenizer theo byte UTF-8 (256 byte + eos + pad), cùng các hàm app.py/transformers streamer gọi."""
+
+    eos_token_id = EOS_TOKEN_ID
+    pad_token_id = PAD_TOKEN_ID
+    vocab_size = VOCAB_SIZE
+
+    def encode(self, text, add_special_tokens=True):
+        ids = list(text.encode("utf-8"))
+        return ids + [EOS_TOKEN_ID] if add_special_tokens else ids
+
+    def decode(self, ids, skip_special_tokens=False, **kwargs):
+        if hasattr(ids, "tolist"):
+            ids = ids.tolist()
+        if isinstance(ids, int):
+            ids = [ids]
+        data = bytes(i for i in ids if i < 256)
+        # Ký tự UTF-8 chưa sinh đủ byte bị bỏ qua (streamer decode lại khi có thêm token)
+        text = data.decode("utf-8", errors="ignore")
+        if not skip_special_tokens:
+            text += "".join("</s>" if i == EOS_TOKEN_ID else "<pad>" for i in ids if i >= 256)
+        return text
+
+class StandInBlock(nn.Module):
+    """Khối transformer (attention + MLP) có KV cache."""
+
+    def __init__(self, hidden_size, num_heads):
+        super().__init__()
+        self.num_heads = num_heads
+        self.norm1 = nn.LayerNorm(hidden_size)
+        self.qkv = nn.Linear(hidden_size, 3 * hidden_size)
+        self.proj = nn.Linear(hidden_size, hidden_size)
+        self.norm2 = nn.LayerNorm(hidden_size)
+        self.fc1 = nn.Linear(hidden_size, 4 * hidden_size)
+        self.fc2 = nn.Linear(4 * hidden_size, hidden_size)
+
+    def forward(self, x, attn_mask=None, past=None):
+        batch, length, hidden = x.shape
+        q, k, v = self.qkv(self.norm1(x)).view(batch, length, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        if past is not None:
+            k = torch.cat([past[0], k], dim=2)
+            v = torch.cat([past[1], v], dim=2)
+        attn = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        x = x + self.proj(attn.transpose(1, 2).reshape(batch, length, hidden))
+        x = x + self.fc2(F.gelu(self.fc1(self.norm2(x))))
+        return x, (k, v)
+
+class StandInLanguageModel(nn.Module):
+    """Language model nhỏ: embedding + các khối transformer + lm_head."""
+
+    def __init__(self, hidden_size, num_layers, num_heads, vocab_size=VOCAB_SIZE):
+        super().__init__()
+        self.embed_tokens = nn.Embedding(vocab_size, hidden_size)
+        self.layers = nn.ModuleList([StandInBlock(hidden_size, num_heads) for _ in range(num_layers)])
+        self.norm = nn.LayerNorm(hidden_size)
+        self.lm_head = nn.Linear(hidden_size, vocab_size)
+
+    def forward(self, inputs_embeds, attn_mask=None, past_key_values=None):
+        x = inputs_embeds
+        presents = []
+        for index, layer in enumerate(self.layers):
+            x, present = layer(x, attn_mask, None if past_key_values is None else past_key_values[index])
+            presents.append(present)
+        return self.lm_head(self.norm(x)), presents
+
+class StandInModel(nn.Module):
+    """Model thay thế có cùng giao diện chat/batch_chat với InternVL (trọng số ngẫu nhiên, seed cố định).
+
+    Tên module vision projector (mlp1) và language_model giống InternVL để quantization.py dùng được.
+    """
+
+    def __init__(self, hidden_size=128, num_layers=2, num_heads=4, image_size=448, patch_size=28, seed=0):
+        super().__init__()
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            # 448 / 28 = 16 x 16 = 256 token mỗi tile như InternVL sau pixel shuffle
+            self.vision_model = nn.Conv2d(3, hidden_size, kernel_size=patch_size, stride=patch_size)
+            self.mlp1 = nn.Sequential(
+                nn.LayerNorm(hidden_size),
+                nn.Linear(hidden_size, hidden_size),
+                nn.GELU(),
+                nn.Linear(hidden_size, hidden_size)
+            )
+            self.language_model = StandInLanguageModel(hidden_size, num_layers, num_heads)
+        self.image_size = image_size
+        self.num_image_token = (image_size // patch_size) ** 2
+
+    def prompt_prefix(self, question):
+        """Phần prompt trước token ảnh đầu tiên (system message, đầu lượt user, <img>)."""
+        before_image = question.split("<image>")[0] if "<image>" in question else ""
+        return PROMPT_HEADER + before_image + "<img>"
+
+    def prompt_suffix(self, question):
+        """Phần prompt sau token ảnh."""
+        after_image = question.split("<image>", 1)[1] if "<image>" in question else "\n" + question
+        return "</img>" + after_image + PROMPT_FOOTER
+
+    def prefill_prefix(self, prefix_ids):
+        """KV cache (batch 1) của phần prompt cố định, dùng làm generation_config["past_key_values"]."""
+        embeds = self.language_model.embed_tokens(
+            torch.tensor(prefix_ids, dtype=torch.long, device=self.mlp1[1].weight.device))[None]
+        causal = torch.ones(len(prefix_ids), len(prefix_ids), dtype=torch.bool, device=embeds.device).tril()
+        return self.language_model(embeds, causal[None, None])[1]
+
+    def extract_feature(self, pixel_values):
+        """(số tile, 3, 448, 448) -> (số tile, 256, hidden)."""
+        features = self.vision_model(pixel_values.to(self.vision_model.weight.dtype))
+        return self.mlp1(features.flatten(2).transpose(1, 2))
+
+    def chat(self, tokenizer, pixel_values, question, generation_config, history=None, return_history=False,
+             num_patches_list=None, verbose=False, **kwargs):
+        num_patches_list = num_patches_list or [pixel_values.size(0)]
+        response = self.batch_chat(tokenizer, pixel_values, [question], generation_config,
+                                   num_patches_list=num_patches_list)[0]
+        return (response, []) if return_history else response
+
+    def batch_chat(self, tokenizer, pixel_values, questions, generation_config, num_patches_list=None,
+                   history=None, return_history=False, verbose=False, **kwargs):
+        num_patches_list = num_patches_list or [pixel_values.size(0)]
+        generation_config = dict(generation_config)
+        visual_features = generation_config.pop("visual_features", None)
+        if visual_features is None:
+            visual_features = self.extract_feature(pixel_values)
+        image_embeds = visual_features.to(self.mlp1[1].weight.dtype).split(num_patches_list, dim=0)
+        prompts = [self.prompt_embeds(tokenizer, embeds, question) for embeds, question in zip(image_embeds, questions)]
+        targets = [self.sample_response(embeds, tokenizer) for embeds in image_embeds]
+        generated = self.generate_forced(prompts, targets, **generation_config)
+        return [tokenizer.decode(ids, skip_special_tokens=True) for ids in generated]
+
+    def prompt_embeds(self, tokenizer, image_embeds, question):
+        """Embedding của prompt 1 ảnh: prefix + token ảnh + phần sau ảnh, (độ dài, hidden)."""
+        prefix_ids, suffix_ids = (
+            torch.tensor(tokenizer.encode(text, add_special_tokens=False), dtype=torch.long, device=image_embeds.device)
+            for text in (self.prompt_prefix(question), self.prompt_suffix(question)))
+        return torch.cat([
+            self.language_model.embed_tokens(prefix_ids),
+            image_embeds.reshape(-1, image_embeds.size(-1)),
+            self.language_model.embed_tokens(suffix_ids)
+        ])
+
+    def decode_session(self, tokenizer, pixel_values, question, past_key_values=None):
+        """Prefill prompt 1 ảnh, trả về session decode từng bước cho schema_decoding.py."""
+        image_embeds = self.extract_feature(pixel_values).to(self.mlp1[1].weight.dtype)
+        return StandInSession(self, self.prompt_embeds(tokenizer, image_embeds, question),
+                              self.sample_response(image_embeds, tokenizer), past_key_values)
+
+    @staticmethod
+    def sample_response(image_embeds, tokenizer):
+        """Token của câu trả lời mẫu cho ảnh (tổng tiền thay đổi theo đặc trưng ảnh).
+
+        Đặc trưng được làm tròn để kết quả giống nhau khi tính theo batch hay lấy từ cache.
+        """
+        sample = torch.round(image_embeds[:, ::32, :8].float() * 10).to(torch.int32)
+        checksum = zlib.crc32(sample.cpu().numpy().tobytes())
+        response = dict(SAMPLE_RESPONSE, **{"Tổng tiền thanh toán": str(1000 * (checksum % 1000 + 1))})
+        return tokenizer.encode(json.dumps(response, ensure_ascii=False), add_special_tokens=False) + [EOS_TOKEN_ID]
+
+    def generate_forced(self, prompts, targets, max_new_tokens=1024, num_beams=1, stopping_criteria=None,
+                        streamer=None, past_key_values=None, **kwargs):
+        """Prefill prompt (đệm trái) rồi sinh từng token với KV cache, token lấy theo targets.
+
+        Beam search được mô phỏng bằng num_beams dòng mỗi prompt (chi phí tính toán như beam thật).
+        past_key_values: KV cache (batch 1) của các token đầu prompt, chỉ dùng khi có 1 prompt.
+        """
+        num_beams = max(1, num_beams or 1)
+        length = max(prompt.size(0) for prompt in prompts)
+        hidden_size = prompts[0].size(-1)
+        rows = len(prompts) * num_beams
+        embeds = prompts[0].new_zeros(rows, length, hidden_size)
+        valid = torch.zeros(rows, length, dtype=torch.bool, device=embeds.device)
+        for index, prompt in enumerate(prompts):
+            rows_slice = slice(index * num_beams, (index + 1) * num_beams)
+            embeds[rows_slice, length - prompt.size(0):] = prompt
+            valid[rows_slice, length - prompt.size(0):] = True
+
+        if past_key_values is not None:
+            if len(prompts) != 1:
+                raise ValueError("past_key_values chỉ dùng được với 1 prompt (batch đệm trái lệch vị trí)")
+            # Prefill phần prompt sau prefix đã cache: vị trí i nhìn thấy prefix + các vị trí <= i
+            cached = past_key_values[0][0].size(2)
+            past = [(k.expand(rows, -1, -1, -1), v.expand(rows, -1, -1, -1)) for k, v in past_key_values]
+            mask = torch.ones(length - cached, length, dtype=torch.bool, device=embeds.device).tril(diagonal=cached)
+            logits, past = self.language_model(embeds[:, cached:], mask[None, None], past)
+        else:
+            # Prefill: causal + bỏ vị trí đệm (luôn giữ đường chéo để dòng đệm không toàn -inf)
+            causal = torch.ones(length, length, dtype=torch.bool, device=embeds.device).tril()
+            eye = torch.eye(length, dtype=torch.bool, device=embeds.device)
+            mask = (causal & valid[:, None, :]) | eye
+            logits, past = self.language_model(embeds, mask[:, None])
+
+        if streamer is not None:
+            # Prompt là inputs_embeds: streamer nhận input_ids rỗng như generate của InternVL
+            streamer.put(torch.zeros((1, 0), dtype=torch.long))
+        generated = torch.zeros(len(prompts), 0, dtype=torch.long)
+        finished = torch.zeros(len(prompts), dtype=torch.bool)
+        for step in range(max_new_tokens):
+            next_tokens = torch.tensor([target[step] if step < len(target) else PAD_TOKEN_ID for target in targets])
+            next_tokens[finished] = PAD_TOKEN_ID
+            generated = torch.cat([generated, next_tokens[:, None]], dim=1)
+            finished |= next_tokens == EOS_TOKEN_ID
+            if streamer is not None:
+                streamer.put(next_tokens[:1])
+            if stopping_criteria is not None:
+                for criteria in stopping_criteria:
+                    finished |= criteria(generated, logits[::num_beams, -1]).cpu()
+            if bool(finished.all()):
+                break
+            # Bước decode: 1 token mới mỗi dòng, attention tới toàn bộ KV cache
+            valid = torch.cat([valid, torch.ones(rows, 1, dtype=torch.bool, device=valid.device)], dim=1)
+            step_embeds = self.language_model.embed_tokens(
+                next_tokens.repeat_interleave(num_beams).to(embeds.device))[:, None]
+            logits, past = self.language_model(step_embeds, valid[:, None, None], past)
+        if streamer is not None:
+            streamer.end()
+        return [[int(i) for i in row if i != PAD_TOKEN_ID] for row in generated]
+
+class StandInSession:
+    """Decode 1 chuỗi với KV cache (giao diện như decode_session.TransformersSession).
+
+    Logits được cộng thêm ở token tiếp theo của câu trả lời mẫu (theo số token đã thêm sau prompt).
+    """
+
+    def __init__(self, model, prompt_embeds, target, past_key_values=None):
+        self.model = model
+        self.target = target
+        self.position = 0
+        self.device = prompt_embeds.device
+        cached = past_key_values[0][0].size(2) if past_key_values is not None else 0
+        length = prompt_embeds.size(0)
+        mask = torch.ones(length - cached, length, dtype=torch.bool, device=self.device).tril(diagonal=cached)
+        logits, self.past = model.language_model(prompt_embeds[None, cached:], mask[None, None], past_key_values)
+        self.logits = self._bias(logits[0, -1:], 0)[-1]
+
+    def _bias(self, logits, start):
+        """Cộng thêm vào token mẫu: dòng i là logits sau start + i token đã thêm."""
+        logits = logits.float().clone()
+        for row in range(logits.size(0)):
+            if start + row < len(self.target):
+                logits[row, self.target[start + row]] += 1000.0
+        return logits
+
+    def _forward(self, token_ids):
+        cached = self.past[0][0].size(2)
+        embeds = self.model.language_model.embed_tokens(
+            torch.tensor(token_ids, dtype=torch.long, device=self.device))[None]
+        mask = torch.ones(len(token_ids), cached + len(token_ids), dtype=torch.bool,
+                          device=self.device).tril(diagonal=cached)
+        logits, self.past = self.model.language_model(embeds, mask[None, None], self.past)
+        start = self.position + 1
+        self.position += len(token_ids)
+        return self._bias(logits[0], start)
+
+    def feed(self, token_ids):
+        """Thêm các token vào chuỗi trong 1 lượt forward."""
+        self.logits = self._forward(token_ids)[-1]
+
+    def verify(self, token_ids):
+        """Như feed nhưng trả về logits của từng vị trí."""
+        logits = self._forward(token_ids)
+        self.logits = logits[-1]
+        return logits
+
+    def crop(self, num_tokens):
+        """Bỏ num_tokens token cuối khỏi KV cache."""
+        length = self.past[0][0].size(2) - num_tokens
+        self.past = [(k[:, :, :length], v[:, :, :length]) for k, v in self.past]
+        self.position -= num_tokens
+        self.logits = None
+
+def load_stand_in_model(**kwargs):
+    """Trả về (model, tokenizer) thay thế, model ở chế độ eval."""
+    return StandInModel(**kwargs).eval(), StandInTokenizer()
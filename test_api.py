@@ -3,15 +3,20 @@
 Script test API InternVL Invoice Extraction
 Test tất cả endpoints và hiển thị response đầy đủ
 Tự động lấy ngẫu nhiên ảnh từ UnBoundingDATASET
+Chế độ --load: tạo tải đồng thời (open-loop theo tốc độ đến hoặc theo số request đồng thời) trong
+một khoảng thời gian, đo p50/p90/p99, throughput, tỷ lệ 429/503/504 và xuất histogram độ trễ
 """
 
 import requests
 import json
 import sys
+import time
 import argparse
 import random
 import os
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # Màu sắc cho terminal (nếu hỗ trợ)
 class Colors:
@@ -123,12 +128,11 @@ def test_extract_invoice_with_file(base_url, image_path):
         print_colored(f"❌ Lỗi: {e}", Colors.RED)
         return False
 
-def find_random_image(dataset_path):
-    """Tìm ảnh ngẫu nhiên từ thư mục dataset"""
+def find_image_files(dataset_path):
+    """Tìm tất cả file ảnh trong thư mục dataset"""
     if not os.path.exists(dataset_path):
-        return None
+        return []
     
-    # Tìm tất cả file ảnh
     image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.webp'}
     image_files = []
     
@@ -136,13 +140,226 @@ def find_random_image(dataset_path):
         for file in files:
             if any(file.lower().endswith(ext) for ext in image_extensions):
                 image_files.append(os.path.join(root, file))
-    
+    return sorted(image_files)
+
+def find_random_image(dataset_path):
+    """Tìm ảnh ngẫu nhiên từ thư mục dataset"""
+    image_files = find_image_files(dataset_path)
     if not image_files:
         return None
     
     # Chọn ngẫu nhiên
     return random.choice(image_files)
 
+# Biên histogram độ trễ (giây), bucket cuối là +Inf
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300]
+
+def percentile(values, q):
+    """Phân vị q (0-100) theo nearest-rank, None nếu không có giá trị"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))]
+
+def latency_histogram(latencies, buckets=LATENCY_BUCKETS):
+    """Đếm số request theo bucket độ trễ (không cộng dồn): [{"le": biên trên, "count": n}, ...]"""
+    counts = [0] * (len(buckets) + 1)
+    for latency in latencies:
+        index = next((i for i, bound in enumerate(buckets) if latency <= bound), len(buckets))
+        counts[index] += 1
+    return [{"le": bound, "count": count} for bound, count in zip(buckets + ["+Inf"], counts)]
+
+class LoadGenerator:
+    """Gửi request tới endpoint trích xuất với ảnh lặp vòng từ danh sách, ghi lại (status, độ trễ) từng request.
+
+    Open-loop (rate): request đến theo tiến trình Poisson với tốc độ trung bình rate req/s, không phụ thuộc
+    request trước đã xong chưa; độ trễ tính từ thời điểm lẽ ra được gửi để không che giấu hàng đợi phía client.
+    Closed-loop (concurrency): mỗi luồng gửi request kế tiếp ngay khi request trước xong.
+    """
+
+    def __init__(self, base_url, images, endpoint="/extract_invoice", timeout=310, profile=None, no_cache=True,
+                 max_inflight=256):
+        self.url = f"{base_url}{endpoint}"
+        self.images = images
+        self.timeout = timeout
+        self.params = {}
+        if profile:
+            self.params["profile"] = profile
+        if no_cache:
+            self.params["no_cache"] = "1"
+        self.max_inflight = max_inflight
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._next_image = 0
+        self.records = []
+
+    def _session(self):
+        # Mỗi thread một Session để dùng lại kết nối
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def send(self, scheduled_at=None):
+        """Gửi 1 request; scheduled_at: thời điểm (perf_counter) request lẽ ra được gửi"""
+        with self._lock:
+            name, data = self.images[self._next_image % len(self.images)]
+            self._next_image += 1
+        started_at = time.perf_counter()
+        start = scheduled_at if scheduled_at is not None else started_at
+        retry_after = None
+        try:
+            response = self._session().post(self.url, params=self.params, files={'image': (name, data, 'image/jpeg')},
+                                            timeout=self.timeout)
+            status = response.status_code
+            retry_after = response.headers.get("Retry-After")
+        except requests.exceptions.Timeout:
+            status = "timeout"
+        except requests.exceptions.RequestException:
+            status = "connection_error"
+        finished_at = time.perf_counter()
+        with self._lock:
+            self.records.append({
+                "status": status,
+                "latency_s": finished_at - start,
+                "client_wait_s": started_at - start,
+                "finished_at": finished_at,
+                "retry_after": retry_after
+            })
+
+    def run_open_loop(self, rate, duration):
+        """Gửi request với tốc độ đến trung bình rate req/s trong duration giây"""
+        executor = ThreadPoolExecutor(max_workers=self.max_inflight)
+        start = time.perf_counter()
+        next_at = start
+        while next_at < start + duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(self.send, next_at)
+            next_at += random.expovariate(rate)
+        executor.shutdown(wait=True)
+        return start
+
+    def run_closed_loop(self, concurrency, duration):
+        """concurrency luồng, mỗi luồng gửi liên tục trong duration giây"""
+        start = time.perf_counter()
+        
+        def worker():
+            while time.perf_counter() < start + duration:
+                self.send()
+        
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return start
+
+    def summary(self, start, duration):
+        """Thống kê tổng hợp từ các request đã ghi (duration: thời gian phát tải đã cấu hình)"""
+        records = self.records
+        elapsed = max(record["finished_at"] for record in records) - start if records else 0.0
+        status_counts = {}
+        for record in records:
+            status_counts[str(record["status"])] = status_counts.get(str(record["status"]), 0) + 1
+        success = [record["latency_s"] for record in records if record["status"] == 200]
+        total = len(records)
+        
+        def rate_of(*statuses):
+            return sum(status_counts.get(str(s), 0) for s in statuses) / total if total else 0.0
+        
+        return {
+            "requests": total,
+            "duration_s": elapsed,
+            "throughput_rps": len(success) / elapsed if elapsed else 0.0,
+            "offered_rps": total / duration if duration else 0.0,
+            "status_codes": status_counts,
+            "success_rate": rate_of(200),
+            "rate_429": rate_of(429),
+            "rate_503": rate_of(503),
+            "rate_504": rate_of(504, "timeout"),
+            "error_rate": 1.0 - rate_of(200),
+            "latency_success_s": {
+                "p50": percentile(success, 50),
+                "p90": percentile(success, 90),
+                "p99": percentile(success, 99),
+                "max": max(success) if success else None
+            },
+            "latency_all_s": {
+                "p50": percentile([r["latency_s"] for r in records], 50),
+                "p90": percentile([r["latency_s"] for r in records], 90),
+                "p99": percentile([r["latency_s"] for r in records], 99)
+            },
+            "client_wait_p99_s": percentile([r["client_wait_s"] for r in records], 99)
+        }
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:.3f}s"
+
+def run_load_test(base_url, args):
+    """Chế độ --load: chạy tải, in thống kê + histogram, ghi kết quả ra JSON (nếu có --output)"""
+    print_section("🔥 Load Test")
+    image_files = [args.image_file] if args.image_file else find_image_files(args.dataset_path)
+    if args.max_images:
+        image_files = image_files[:args.max_images]
+    if not image_files:
+        print_colored(f"❌ Không tìm thấy ảnh trong {args.dataset_path} (dùng --image-file hoặc --dataset-path)", Colors.RED)
+        return 1
+    images = []
+    for path in image_files:
+        with open(path, 'rb') as f:
+            images.append((os.path.basename(path), f.read()))
+    
+    generator = LoadGenerator(base_url, images, endpoint=args.endpoint, timeout=args.timeout,
+                              profile=args.profile, no_cache=not args.allow_cache, max_inflight=args.max_inflight)
+    if args.rate:
+        mode = f"open-loop {args.rate} req/s"
+    else:
+        mode = f"closed-loop {args.concurrency} request đồng thời"
+    print_colored(f"   {mode}, {args.duration:.0f}s, {len(images)} ảnh, endpoint {args.endpoint}", Colors.YELLOW)
+    
+    if args.rate:
+        start = generator.run_open_loop(args.rate, args.duration)
+    else:
+        start = generator.run_closed_loop(args.concurrency, args.duration)
+    summary = generator.summary(start, args.duration)
+    success_latencies = [r["latency_s"] for r in generator.records if r["status"] == 200]
+    histogram = latency_histogram(success_latencies)
+    
+    print_colored(f"\n   Requests: {summary['requests']}  trong {summary['duration_s']:.1f}s", Colors.BLUE)
+    print_colored(f"   Throughput: {summary['throughput_rps']:.2f} req/s thành công "
+                  f"(gửi {summary['offered_rps']:.2f} req/s)", Colors.BLUE)
+    print_colored(f"   Status: {summary['status_codes']}", Colors.BLUE)
+    print_colored(f"   429: {100 * summary['rate_429']:.1f}%  503: {100 * summary['rate_503']:.1f}%  "
+                  f"504/timeout: {100 * summary['rate_504']:.1f}%",
+                  Colors.GREEN if summary['error_rate'] == 0 else Colors.YELLOW)
+    latency = summary['latency_success_s']
+    print_colored(f"   Độ trễ (200): p50 {format_seconds(latency['p50'])}  p90 {format_seconds(latency['p90'])}  "
+                  f"p99 {format_seconds(latency['p99'])}  max {format_seconds(latency['max'])}", Colors.BLUE)
+    
+    print_colored("\n   Histogram độ trễ (request thành công):", Colors.YELLOW)
+    peak = max((bucket["count"] for bucket in histogram), default=0)
+    for bucket in histogram:
+        if bucket["count"]:
+            bar = "█" * max(1, int(40 * bucket["count"] / peak))
+            label = f"≤ {bucket['le']}s" if bucket["le"] != "+Inf" else "> 300s"
+            print(f"      {label:>9} {bucket['count']:6d} {bar}")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                "server": base_url,
+                "endpoint": args.endpoint,
+                "mode": {"rate": args.rate, "concurrency": None if args.rate else args.concurrency,
+                         "duration_s": args.duration},
+                "summary": summary,
+                "histogram": histogram,
+                "samples": [{"status": r["status"], "latency_s": r["latency_s"]} for r in generator.records]
+            }, f, ensure_ascii=False, indent=2)
+        print_colored(f"\n💾 Đã ghi kết quả vào {args.output}", Colors.GREEN)
+    return 0 if summary['requests'] and summary['success_rate'] > 0 else 1
+
 def main():
     parser = argparse.ArgumentParser(
         description='Test API InternVL Invoice Extraction',
@@ -160,6 +377,12 @@ Ví dụ:
   
   # Chỉ định đường dẫn dataset
   python test_api.py --url http://localhost:8000 --dataset-path ./UnBoundingDATASET
+  
+  # Load test open-loop: trung bình 2 req/s trong 60 giây, ghi kết quả + histogram ra JSON
+  python test_api.py --load --rate 2 --duration 60 --output load.json
+  
+  # Load test closed-loop: 8 request đồng thời trong 60 giây
+  python test_api.py --load --concurrency 8 --duration 60
         """
     )
     
@@ -191,10 +414,30 @@ Ví dụ:
         help='Không tự động lấy ảnh ngẫu nhiên từ dataset'
     )
     
+    load = parser.add_argument_group('load test (--load)')
+    load.add_argument('--load', action='store_true', help='Chạy load test thay vì test từng endpoint')
+    load.add_argument('--rate', type=float, help='Tốc độ đến trung bình (req/s, open-loop)')
+    load.add_argument('--concurrency', type=int, default=4,
+                      help='Số request đồng thời khi không có --rate (closed-loop, default: 4)')
+    load.add_argument('--duration', type=float, default=60, help='Thời gian chạy tải (giây, default: 60)')
+    load.add_argument('--endpoint', default='/extract_invoice', help='Endpoint (default: /extract_invoice)')
+    load.add_argument('--profile', help='Profile generation (fast / balanced / accurate)')
+    load.add_argument('--allow-cache', action='store_true',
+                      help='Cho phép server trả kết quả từ cache (mặc định gửi no_cache=1)')
+    load.add_argument('--timeout', type=float, default=310, help='Timeout mỗi request (giây, default: 310)')
+    load.add_argument('--max-inflight', type=int, default=256,
+                      help='Số request đang gửi tối đa ở chế độ open-loop (default: 256)')
+    load.add_argument('--max-images', type=int, help='Số ảnh tối đa lấy từ dataset')
+    load.add_argument('--output', help='File JSON ghi thống kê, histogram và từng request')
+    
     args = parser.parse_args()
     
     base_url = args.url.rstrip('/')
     
+    if args.load:
+        print_colored(f"\n📍 Server: {base_url}", Colors.BLUE)
+        return run_load_test(base_url, args)
+    
     print_colored("\n" + "="*60, Colors.CYAN)
     print_colored("  🧪 TEST API INTERNVL INVOICE EXTRACTION", Colors.BOLD + Colors.CYAN)
     print_colored("="*60, Colors.CYAN)